@@ -1,44 +1,292 @@
+from math import ceil
+
 from django.contrib import admin
-from .models import ChaiVariety, ChaiReview, Store, ChaiCertificate, Favorite, ReviewComment, StoreRating
+from django.contrib.admin import helpers
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.forms.models import BaseInlineFormSet
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import reverse
+
+from . import jobs
+from .branches import branch_databases
+from .forms import BulkRepriceForm, ConfirmForm, StoreSelectionForm
+from .models import (
+    ChaiVariety, ChaiReview, Store, StoreInventory, ChaiCertificate, Favorite, ReviewComment, StoreRating, BackgroundJob,
+    Order, OrderLine, Branch, CommentVoteShard,
+)
+from .pagination import EstimatedCountPaginator
+
+
+class PaginatedInlineFormSet(BaseInlineFormSet):
+    """Inline formset that only loads one page of related objects"""
+    per_page = 20
+    page = 1
+    page_param = 'page'
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = super().get_queryset()
+            self.total_count = queryset.count()
+            self.page_count = max(1, ceil(self.total_count / self.per_page))
+            self.page = min(max(self.page, 1), self.page_count)
+            start = (self.page - 1) * self.per_page
+            self._queryset = queryset[start:start + self.per_page]
+        return self._queryset
+
+    def page_range(self):
+        return range(1, self.page_count + 1)
+
+
+class PaginatedTabularInline(admin.TabularInline):
+    """Tabular inline that pages its rows instead of rendering every related object"""
+    formset = PaginatedInlineFormSet
+    template = 'admin/chai/paginated_tabular.html'
+    per_page = 20
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.per_page = self.per_page
+        formset.page_param = f"{self.opts.model_name}_page"
+        try:
+            formset.page = int(request.GET.get(formset.page_param, 1))
+        except ValueError:
+            formset.page = 1
+        return formset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables that grow without bound"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+def bulk_job_action(modeladmin, request, queryset, form_class, title, start_job):
+    """Show ``form_class`` for the selection, then queue the job built by ``start_job``.
+
+    ``start_job(ids, cleaned_data, user)`` returns the queued BackgroundJob;
+    the admin is redirected to its status page. Declare ``permissions=`` on
+    every action that uses this: the admin only offers, and only runs, actions
+    the user holds those model permissions for.
+    """
+    form = form_class(request.POST if 'apply' in request.POST else None)
+    if form.is_valid():
+        ids = list(queryset.values_list('pk', flat=True))
+        job = start_job(ids, form.cleaned_data, request.user)
+        modeladmin.message_user(request, f"Queued “{job.description}” for {len(ids)} items.")
+        return HttpResponseRedirect(reverse('admin:chai_backgroundjob_change', args=[job.pk]))
+
+    context = {
+        **modeladmin.admin_site.each_context(request),
+        'title': title,
+        'form': form,
+        'opts': modeladmin.model._meta,
+        'count': queryset.count(),
+        'action': request.POST['action'],
+        'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+        'select_across': request.POST.get('select_across', '0'),
+        'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+    }
+    return TemplateResponse(request, 'admin/chai/bulk_action.html', context)
+
+
+def _change_store_listings(modeladmin, request, queryset, action):
+    verb = 'Add to' if action == 'add' else 'Remove from'
+
+    def start_job(ids, data, user):
+        stores = data['stores']
+        return jobs.enqueue(
+            'store_chais',
+            {'ids': ids, 'store_ids': [store.pk for store in stores], 'action': action},
+            total=len(ids),
+            description=f"{verb} {len(stores)} stores",
+            user=user,
+        )
+    return bulk_job_action(modeladmin, request, queryset, StoreSelectionForm, f"{verb} stores", start_job)
+
+
+@admin.action(description="Reprice selected chais", permissions=['change'])
+def reprice_chais(modeladmin, request, queryset):
+    def start_job(ids, data, user):
+        value = data['value']
+        description = f"Change prices by {value}%" if data['mode'] == 'percent' else f"Set prices to ₹{value}"
+        return jobs.enqueue('reprice', {'ids': ids, 'mode': data['mode'], 'value': str(value)},
+                            total=len(ids), description=description, user=user)
+    return bulk_job_action(modeladmin, request, queryset, BulkRepriceForm, "Reprice chais", start_job)
+
+
+@admin.action(description="Add selected chais to stores", permissions=['change'])
+def add_to_stores(modeladmin, request, queryset):
+    return _change_store_listings(modeladmin, request, queryset, 'add')
+
+
+@admin.action(description="Remove selected chais from stores", permissions=['change'])
+def remove_from_stores(modeladmin, request, queryset):
+    return _change_store_listings(modeladmin, request, queryset, 'remove')
 
-class ChaiReviewAdmin(admin.TabularInline):
+
+@admin.action(description="Reprocess images of selected chais", permissions=['change'])
+def reprocess_images(modeladmin, request, queryset):
+    def start_job(ids, data, user):
+        return jobs.enqueue('reprocess_images', {'ids': ids}, total=len(ids),
+                            description="Reprocess chai images", user=user)
+    return bulk_job_action(modeladmin, request, queryset, ConfirmForm, "Reprocess images", start_job)
+
+
+@admin.action(description="Delete all reviews by the authors of selected reviews", permissions=['delete'])
+def delete_reviews_by_authors(modeladmin, request, queryset):
+    def start_job(ids, data, user):
+        user_ids = list(ChaiReview.objects.filter(pk__in=ids).values_list('user_id', flat=True).distinct())
+        # The job deletes their reviews at every branch, whichever database holds them
+        total = sum(
+            ChaiReview.all_branches.using(alias).filter(user_id__in=user_ids).count() for alias in branch_databases()
+        )
+        return jobs.enqueue('delete_reviews', {'user_ids': user_ids}, total=total,
+                            description=f"Delete reviews by {len(user_ids)} users", user=user)
+    return bulk_job_action(modeladmin, request, queryset, ConfirmForm, "Delete reviews by author", start_job)
+
+
+class ChaiReviewInline(PaginatedTabularInline):
     model = ChaiReview
     extra = 2
+    raw_id_fields = ('user',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user', 'chai_variety')
 
 class ChaiVarietyAdmin(admin.ModelAdmin):
     list_display = ('name', 'chai_type', 'date_added', 'price')
-    inlines = [ChaiReviewAdmin]
+    inlines = [ChaiReviewInline]
+    actions = [reprice_chais, add_to_stores, remove_from_stores, reprocess_images]
     search_fields = ('name', 'description')
     list_filter = ('chai_type', 'date_added')
 
+class ChaiReviewAdmin(LargeTableAdmin):
+    list_display = ('user', 'chai_variety', 'rating', 'date_added')
+    list_select_related = ('user', 'chai_variety')
+    autocomplete_fields = ('user', 'chai_variety')
+    actions = [delete_reviews_by_authors]
+    search_fields = ('user__username', 'chai_variety__name')
+    list_filter = ('branch', 'rating', 'date_added')
+
+class StoreInventoryInline(PaginatedTabularInline):
+    model = StoreInventory
+    extra = 1
+    autocomplete_fields = ('chai_variety',)
+    fields = ('chai_variety', 'price', 'stock', 'is_available')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('chai_variety')
+
 class StoreAdmin(admin.ModelAdmin):
-    list_display = ('name', 'store_location', 'date_added')
-    filter_horizontal = ('chai_varieties',)
+    list_display = ('name', 'store_location', 'branch', 'date_added')
+    list_select_related = ('branch',)
+    list_filter = ('branch',)
+    inlines = [StoreInventoryInline]
     search_fields = ('name', 'store_location')
 
-class ChaiCertificateAdmin(admin.ModelAdmin):
-    list_display = ('user', 'certificate_number', 'date_issued', 'valid_until')
+class BranchAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'date_added')
+    prepopulated_fields = {'slug': ('name',)}
+    search_fields = ('name',)
+
+class ChaiCertificateAdmin(LargeTableAdmin):
+    list_display = ('user', 'certificate_number', 'date_issued', 'valid_until', 'status')
+    list_select_related = ('user',)
+    autocomplete_fields = ('user', 'chai_variety')
     search_fields = ('certificate_number', 'user__username')
+    list_filter = ('status',)
 
-class FavoriteAdmin(admin.ModelAdmin):
+class FavoriteAdmin(LargeTableAdmin):
     list_display = ('user', 'chai_variety', 'date_added')
+    list_select_related = ('user', 'chai_variety')
+    autocomplete_fields = ('user', 'chai_variety')
     search_fields = ('user__username', 'chai_variety__name')
-    list_filter = ('date_added',)
+    list_filter = ('branch', 'date_added')
 
-class ReviewCommentAdmin(admin.ModelAdmin):
-    list_display = ('user', 'review', 'date_added', 'is_helpful')
+class ReviewCommentAdmin(LargeTableAdmin):
+    list_display = ('user', 'review', 'date_added', 'helpful_votes')
+    # ReviewComment.__str__ goes through review.__str__, which needs both of these
+    list_select_related = ('user', 'review__user', 'review__chai_variety')
+    autocomplete_fields = ('user',)
+    raw_id_fields = ('review',)
     search_fields = ('user__username', 'comment_text')
     list_filter = ('date_added',)
 
-class StoreRatingAdmin(admin.ModelAdmin):
+    def get_queryset(self, request):
+        # is_helpful only holds the compacted votes; add the shards not yet folded in
+        shards = CommentVoteShard.objects.filter(comment=OuterRef('pk')).order_by().values('comment')
+        return super().get_queryset(request).annotate(
+            helpful_total=F('is_helpful') + Coalesce(Subquery(shards.annotate(total=Sum('count')).values('total')), 0),
+        )
+
+    @admin.display(description='Helpful votes')
+    def helpful_votes(self, comment):
+        return comment.helpful_total
+
+class StoreRatingAdmin(LargeTableAdmin):
     list_display = ('store', 'user', 'rating', 'date_added')
+    list_select_related = ('store', 'user')
+    autocomplete_fields = ('store', 'user')
     search_fields = ('store__name', 'user__username')
-    list_filter = ('rating', 'date_added')
+    list_filter = ('branch', 'rating', 'date_added')
+
+class OrderLineInline(admin.TabularInline):
+    model = OrderLine
+    fields = ('chai_variety', 'quantity', 'unit_price')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('chai_variety')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class OrderAdmin(LargeTableAdmin):
+    """Orders arrive from store POS systems, so they are read-only here"""
+    list_display = ('external_id', 'store', 'placed_at', 'total')
+    list_select_related = ('store',)
+    inlines = [OrderLineInline]
+    fields = ('store', 'external_id', 'placed_at', 'total', 'received')
+    readonly_fields = fields
+    search_fields = ('external_id', 'store__name')
+    list_filter = ('placed_at',)
+
+    def has_add_permission(self, request):
+        return False
+
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'status', 'progress', 'throughput', 'created_by', 'created')
+    list_select_related = ('created_by',)
+    list_filter = ('status', 'kind')
+    fields = ('kind', 'description', 'status', 'progress', 'throughput', 'total', 'processed',
+              'created_by', 'created', 'started', 'heartbeat', 'finished', 'error', 'params')
+    readonly_fields = fields
+    change_form_template = 'admin/chai/backgroundjob/change_form.html'
+
+    @admin.display(description='Progress')
+    def progress(self, job):
+        return f"{job.processed} / {job.total} ({job.get_progress()}%)"
+
+    @admin.display(description='Throughput')
+    def throughput(self, job):
+        rate = job.get_throughput()
+        return f"{rate} items/s" if rate is not None else '-'
+
+    def has_add_permission(self, request):
+        return False
 
 admin.site.register(ChaiVariety, ChaiVarietyAdmin)
-admin.site.register(ChaiReview)
+admin.site.register(ChaiReview, ChaiReviewAdmin)
 admin.site.register(Store, StoreAdmin)
 admin.site.register(ChaiCertificate, ChaiCertificateAdmin)
 admin.site.register(Favorite, FavoriteAdmin)
 admin.site.register(ReviewComment, ReviewCommentAdmin)
 admin.site.register(StoreRating, StoreRatingAdmin)
+admin.site.register(Order, OrderAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
+admin.site.register(Branch, BranchAdmin)
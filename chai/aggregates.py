@@ -0,0 +1,148 @@
+"""Write-behind buffer for the denormalized review counters on ChaiVariety.
+
+Every review write used to leave the rating aggregates to be recomputed on
+read. Instead, review saves and deletes now record ``(count, rating)`` deltas
+here and the buffer applies them to ``ChaiVariety.rating_count`` and
+``ChaiVariety.rating_sum`` in batches: one UPDATE statement per flush, however
+many chais and reviews it covers.
+
+The buffer lives in process memory, so a crash can lose unflushed deltas;
+``python manage.py recount_reviews`` rebuilds the counters from scratch.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class AggregateBuffer:
+    """Collects per-chai review counter deltas and applies them in batches"""
+
+    def __init__(self, max_pending=None, max_age=None):
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._events = 0
+        self._oldest = None
+
+    def _limits(self):
+        max_pending = self.max_pending or getattr(settings, 'REVIEW_AGGREGATE_FLUSH_SIZE', 100)
+        max_age = self.max_age or getattr(settings, 'REVIEW_AGGREGATE_FLUSH_SECONDS', 2.0)
+        return max_pending, max_age
+
+    def add(self, chai_id, count, rating):
+        """Record a change of ``count`` reviews totalling ``rating`` stars for a chai"""
+        self._record(chai_id, (count, rating))
+
+    def _record(self, key, delta):
+        with self._lock:
+            self._merge(key, delta)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+        self.flush_if_due()
+
+    def _merge(self, key, delta):
+        """Fold ``delta`` into the pending one for ``key``; called with the lock held"""
+        pending = self._pending.get(key, (0, 0))
+        self._pending[key] = (pending[0] + delta[0], pending[1] + delta[1])
+        self._events += 1
+
+    def _is_empty(self, delta):
+        return delta == (0, 0)
+
+    def _apply(self, pending):
+        from .models import ChaiVariety
+
+        count_cases = [When(pk=chai_id, then=Value(count)) for chai_id, (count, _) in pending.items()]
+        rating_cases = [When(pk=chai_id, then=Value(rating)) for chai_id, (_, rating) in pending.items()]
+        ChaiVariety.objects.filter(pk__in=pending).update(
+            rating_count=F('rating_count') + Case(*count_cases, default=Value(0), output_field=IntegerField()),
+            rating_sum=F('rating_sum') + Case(*rating_cases, default=Value(0), output_field=IntegerField()),
+            updated=timezone.now(),
+        )
+
+    def is_due(self):
+        max_pending, max_age = self._limits()
+        with self._lock:
+            if not self._events:
+                return False
+            return self._events >= max_pending or time.monotonic() - self._oldest >= max_age
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        """Apply every pending delta in a single transaction; returns the number of rows touched"""
+        with self._lock:
+            pending = {key: delta for key, delta in self._pending.items() if not self._is_empty(delta)}
+            self._pending = {}
+            self._events = 0
+            self._oldest = None
+        if not pending:
+            return 0
+
+        try:
+            with transaction.atomic():
+                self._apply(pending)
+        except Exception:
+            # Put the deltas back so the next flush retries them
+            with self._lock:
+                for key, delta in pending.items():
+                    self._merge(key, delta)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            logger.exception("Failed to flush %s for %d rows", type(self).__name__, len(pending))
+            raise
+        logger.debug("Flushed %s for %d rows", type(self).__name__, len(pending))
+        # The homepage snapshot shows these counters; the write that queued
+        # them marked it stale before they landed
+        from .homepage import mark_stale
+        mark_stale()
+        return len(pending)
+
+
+review_aggregates = AggregateBuffer()
+
+
+def recount_review_aggregates():
+    """Rebuild every chai's review counters from the reviews table of every database"""
+    from .branches import branch_aliases
+    from .models import ChaiReview, ChaiVariety
+
+    per_chai = ChaiReview.all_branches.filter(chai_variety=OuterRef('pk')).order_by().values('chai_variety')
+    with transaction.atomic():
+        updated = ChaiVariety.objects.update(
+            rating_count=Coalesce(Subquery(per_chai.annotate(n=Count('pk')).values('n')), Value(0), output_field=IntegerField()),
+            rating_sum=Coalesce(Subquery(per_chai.annotate(total=Sum('rating')).values('total')), Value(0), output_field=IntegerField()),
+        )
+        # A branch with its own database keeps its reviews there, out of reach
+        # of the subqueries above; add its totals on top
+        for alias in branch_aliases():
+            totals = (
+                ChaiReview.all_branches.using(alias).order_by().values('chai_variety')
+                .annotate(n=Count('pk'), total=Sum('rating')).values_list('chai_variety', 'n', 'total')
+            )
+            pending = {chai_id: (count, rating) for chai_id, count, rating in totals}
+            if pending:
+                review_aggregates._apply(pending)
+    return updated
+
+
+def _flush_at_exit():
+    try:
+        review_aggregates.flush()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,207 @@
+"""Daily review, rating and favorite rollups per chai and per chai type.
+
+Dashboards read ``DailyChaiStats`` and ``DailyChaiTypeStats`` instead of
+scanning ``ChaiReview`` and ``Favorite``. ``rollup`` keeps them current
+incrementally: a checkpoint records the highest review and favorite ids it
+has seen (review ids per database, see chai.branches), and each run
+recomputes the days touched by newer rows. Per chai-type rows are rebuilt
+from the per-chai rows of those days, never from the raw tables.
+
+Ids are handed out when a row is inserted, not when it commits, so a row can
+become visible after a run has already moved the checkpoint past its id.
+Such rows are dated when they were written, so every run also recomputes
+the last ANALYTICS_RESCAN_DAYS days, which picks them up as long as their
+transaction was shorter than that.
+
+Deleting a review or favorite doesn't create a new row, so its day is only
+corrected when that day is recomputed again. ``rollup(full=True)`` rebuilds
+everything.
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .branches import branch_databases
+from .models import (
+    ChaiReview, ChaiVariety, Checkpoint, DailyChaiStats, DailyChaiTypeStats, Favorite, PriceHistory,
+)
+
+CHECKPOINT_NAME = 'analytics-rollup'
+
+
+def _day_bounds(first_day, last_day):
+    """Aware datetimes covering ``first_day`` through ``last_day`` in the current time zone"""
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(first_day, time.min), tz)
+    end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), time.min), tz)
+    return start, end
+
+
+def _new_rows_span(model, last_pk, using=DEFAULT_DB_ALIAS):
+    """Return ``(max_pk, first_day, last_day)`` for rows added after ``last_pk``"""
+    span = model.all_branches.using(using).filter(pk__gt=last_pk).order_by().aggregate(
+        max_pk=Max('pk'), first_day=Min(TruncDate('date_added')), last_day=Max(TruncDate('date_added')),
+    )
+    return span['max_pk'], span['first_day'], span['last_day']
+
+
+def _prices_at_day_end(chai_ids, first_day, last_day):
+    """Map ``(chai_id, day)`` to the price in effect at the end of each day"""
+    _, end = _day_bounds(first_day, last_day)
+    history = (
+        PriceHistory.objects.filter(chai_variety__in=chai_ids, changed_at__lt=end)
+        .order_by('chai_variety', 'changed_at')
+        .values_list('chai_variety', 'changed_at', 'price')
+    )
+    changes = {}
+    for chai_id, changed_at, price in history:
+        changes.setdefault(chai_id, []).append((timezone.localdate(changed_at), price))
+
+    prices = {}
+    days = [first_day + timedelta(days=n) for n in range((last_day - first_day).days + 1)]
+    for chai_id, chai_changes in changes.items():
+        index, price = 0, None
+        for day in days:
+            while index < len(chai_changes) and chai_changes[index][0] <= day:
+                price = chai_changes[index][1]
+                index += 1
+            prices[chai_id, day] = price
+    return prices
+
+
+def rebuild_days(first_day, last_day):
+    """Recompute both rollup tables for ``first_day`` through ``last_day``.
+
+    Returns the number of per-chai rows written.
+    """
+    start, end = _day_bounds(first_day, last_day)
+    stats = {}
+
+    for alias in branch_databases():
+        reviews = (
+            ChaiReview.all_branches.using(alias).filter(date_added__gte=start, date_added__lt=end)
+            .annotate(day=TruncDate('date_added'))
+            .values('chai_variety', 'day')
+            .annotate(count=Count('pk'), total=Sum('rating'))
+            .order_by()
+        )
+        for row in reviews:
+            day_stats = stats.setdefault((row['chai_variety'], row['day']), [0, 0, 0])
+            day_stats[0] += row['count']
+            day_stats[1] += row['total']
+
+    favorites = (
+        Favorite.all_branches.using(DEFAULT_DB_ALIAS).filter(date_added__gte=start, date_added__lt=end)
+        .annotate(day=TruncDate('date_added'))
+        .values('chai_variety', 'day')
+        .annotate(count=Count('pk'))
+        .order_by()
+    )
+    for row in favorites:
+        stats.setdefault((row['chai_variety'], row['day']), [0, 0, 0])[2] = row['count']
+
+    prices = _prices_at_day_end({chai_id for chai_id, _ in stats}, first_day, last_day)
+    rows = [
+        DailyChaiStats(
+            chai_variety_id=chai_id, day=day, review_count=count, rating_sum=total,
+            favorite_count=favorite_count, price=prices.get((chai_id, day)),
+        )
+        for (chai_id, day), (count, total, favorite_count) in stats.items()
+    ]
+
+    with transaction.atomic():
+        DailyChaiStats.objects.filter(day__gte=first_day, day__lte=last_day).delete()
+        DailyChaiStats.objects.bulk_create(rows, batch_size=1000)
+
+        per_type = (
+            DailyChaiStats.objects.filter(day__gte=first_day, day__lte=last_day)
+            .values('chai_variety__chai_type', 'day')
+            .annotate(count=Sum('review_count'), total=Sum('rating_sum'), favorites=Sum('favorite_count'))
+            .order_by()
+        )
+        DailyChaiTypeStats.objects.filter(day__gte=first_day, day__lte=last_day).delete()
+        DailyChaiTypeStats.objects.bulk_create(
+            DailyChaiTypeStats(
+                chai_type=row['chai_variety__chai_type'], day=row['day'], review_count=row['count'],
+                rating_sum=row['total'], favorite_count=row['favorites'],
+            )
+            for row in per_type
+        )
+    return len(rows)
+
+
+def rollup(full=False):
+    """Bring the rollup tables up to date; returns ``(first_day, last_day, rows)`` or None"""
+    position = {} if full else Checkpoint.load(CHECKPOINT_NAME)
+    # Each database hands out its own review ids, so each gets its own checkpoint
+    review_keys = {alias: 'review' if alias == DEFAULT_DB_ALIAS else f'review:{alias}' for alias in branch_databases()}
+    checkpoint = {'favorite': position.get('favorite', 0)}
+    firsts, lasts = [], []
+    for alias, key in review_keys.items():
+        review_pk, review_first, review_last = _new_rows_span(ChaiReview, position.get(key, 0), alias)
+        checkpoint[key] = review_pk or position.get(key, 0)
+        firsts.append(review_first)
+        lasts.append(review_last)
+    favorite_pk, favorite_first, favorite_last = _new_rows_span(Favorite, checkpoint['favorite'])
+    checkpoint['favorite'] = favorite_pk or checkpoint['favorite']
+    firsts = [day for day in (*firsts, favorite_first) if day]
+    lasts = [day for day in (*lasts, favorite_last) if day]
+    if settings.ANALYTICS_RESCAN_DAYS > 0:
+        today = timezone.localdate()
+        firsts.append(today - timedelta(days=settings.ANALYTICS_RESCAN_DAYS - 1))
+        lasts.append(today)
+    if not firsts:
+        return None
+    first_day, last_day = min(firsts), max(lasts)
+
+    with transaction.atomic():
+        if full:
+            DailyChaiStats.objects.all().delete()
+            DailyChaiTypeStats.objects.all().delete()
+        rows = rebuild_days(first_day, last_day)
+        Checkpoint.store(CHECKPOINT_NAME, checkpoint)
+    return first_day, last_day, rows
+
+
+def chai_daily_stats(chai_id, days=30):
+    """Daily rollup rows for one chai over the last ``days`` days, oldest first"""
+    since = timezone.localdate() - timedelta(days=days)
+    return DailyChaiStats.objects.filter(chai_variety=chai_id, day__gt=since).order_by('day')
+
+
+def chai_type_daily_stats(chai_type, days=30):
+    """Daily rollup rows for one chai type over the last ``days`` days, oldest first"""
+    since = timezone.localdate() - timedelta(days=days)
+    return DailyChaiTypeStats.objects.filter(chai_type=chai_type, day__gt=since).order_by('day')
+
+
+def price_change_impact(chai_id, window_days=14):
+    """Compare reviews and ratings in the windows before and after each price change.
+
+    Returns one dict per change, newest first, read entirely from the rollups.
+    """
+    chai = ChaiVariety.objects.only('pk').get(pk=chai_id)
+    history = list(chai.price_history.order_by('changed_at').values_list('changed_at', 'price'))
+    impact = []
+    for (_, old_price), (changed_at, new_price) in zip(history, history[1:]):
+        day = timezone.localdate(changed_at)
+        windows = {}
+        for label, first, last in (
+            ('before', day - timedelta(days=window_days), day - timedelta(days=1)),
+            ('after', day, day + timedelta(days=window_days - 1)),
+        ):
+            totals = DailyChaiStats.objects.filter(chai_variety=chai, day__gte=first, day__lte=last).aggregate(
+                reviews=Sum('review_count'), ratings=Sum('rating_sum'), favorites=Sum('favorite_count'),
+            )
+            reviews = totals['reviews'] or 0
+            windows[label] = {
+                'reviews_per_day': round(reviews / window_days, 2),
+                'average_rating': round(totals['ratings'] / reviews, 2) if reviews else None,
+                'favorites': totals['favorites'] or 0,
+            }
+        impact.append({'changed_at': changed_at, 'old_price': old_price, 'new_price': new_price, **windows})
+    return impact[::-1]
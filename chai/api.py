@@ -0,0 +1,222 @@
+"""Read-only JSON API (v1) for chais, stores, reviews and store ratings.
+
+Rows are read with ``values_list`` over only the columns the client asked for
+(``?fields=``) and turned straight into dicts; no model instances are built.
+Lists page by keyset on ``(-date_added, -pk)`` using the same opaque cursors
+as the HTML history pages, so deep pages cost the same as the first. ``?ids=``
+fetches up to API_MAX_IDS rows in one ``IN`` query, in the order asked for.
+
+Every response carries an ETag built, like the HTML pages' (chai.conditional),
+from version columns rather than the body: the ids of the rows it holds, in
+order, and the newest of their ``updated`` timestamps, plus whether a list
+has a next page. A client that sends it back in If-None-Match is checked
+against the ``*_version`` functions, which read only those columns, and gets
+``304 Not Modified`` without the rows being read or serialized.
+"""
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Value, When
+
+from .models import ChaiReview, ChaiVariety, Store, StoreRating
+from .pagination import encode_cursor, keyset_filter
+
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+API_MAX_IDS = 100
+
+
+class ApiError(ValueError):
+    """A bad request, reported to the client as a 400 response"""
+
+
+def _image_url(name):
+    return ChaiVariety._meta.get_field('image').storage.url(name) if name else None
+
+
+_average_rating = Case(
+    When(rating_count=0, then=Value(None)),
+    default=ExpressionWrapper(F('rating_sum') * Value(1.0) / F('rating_count'), output_field=FloatField()),
+)
+
+# For each resource: its query parameter filters as name -> (lookup, cast), and
+# its public fields as name -> (column or expression, converter for the value)
+RESOURCES = {
+    'chais': {
+        'model': ChaiVariety,
+        'filters': {'chai_type': ('chai_type', str)},
+        'fields': {
+            'id': ('pk', None),
+            'name': ('name', None),
+            'chai_type': ('chai_type', None),
+            'description': ('description', None),
+            'price': ('price', None),
+            'image': ('image', _image_url),
+            'rating_count': ('rating_count', None),
+            'average_rating': (_average_rating, lambda value: None if value is None else round(value, 2)),
+            'date_added': ('date_added', None),
+            'updated': ('updated', None),
+        },
+    },
+    'stores': {
+        'model': Store,
+        'filters': {},
+        'fields': {
+            'id': ('pk', None),
+            'name': ('name', None),
+            'location': ('store_location', None),
+            'date_added': ('date_added', None),
+            'updated': ('updated', None),
+        },
+    },
+    'reviews': {
+        'model': ChaiReview,
+        'filters': {'chai': ('chai_variety', int), 'user': ('user__username', str)},
+        'fields': {
+            'id': ('pk', None),
+            'chai': ('chai_variety_id', None),
+            'user': ('user__username', None),
+            'rating': ('rating', None),
+            'review_text': ('review_text', None),
+            'comment_count': ('comment_count', None),
+            'date_added': ('date_added', None),
+        },
+    },
+    'store-ratings': {
+        'model': StoreRating,
+        'filters': {'store': ('store', int), 'user': ('user__username', str)},
+        'fields': {
+            'id': ('pk', None),
+            'store': ('store_id', None),
+            'user': ('user__username', None),
+            'rating': ('rating', None),
+            'comment': ('comment', None),
+            'date_added': ('date_added', None),
+        },
+    },
+}
+
+
+def parse_fields(resource, value):
+    """Return the public field names requested by ``?fields=``, or all of them"""
+    available = RESOURCES[resource]['fields']
+    if not value:
+        return list(available)
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        raise ApiError(f"Unknown fields {', '.join(unknown) or '(none)'}; available: {', '.join(available)}")
+    return list(dict.fromkeys(names))
+
+
+def parse_ids(value):
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise ApiError("ids must be a comma-separated list of integers")
+    if not 0 < len(ids) <= API_MAX_IDS:
+        raise ApiError(f"Ask for between 1 and {API_MAX_IDS} ids")
+    return list(dict.fromkeys(ids))
+
+
+def parse_limit(value):
+    if not value:
+        return API_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ApiError("limit must be an integer")
+    if not 0 < limit <= API_MAX_PAGE_SIZE:
+        raise ApiError(f"limit must be between 1 and {API_MAX_PAGE_SIZE}")
+    return limit
+
+
+def _filtered(resource, params):
+    spec = RESOURCES[resource]
+    queryset = spec['model'].objects.all()
+    for param, (lookup, cast) in spec['filters'].items():
+        if params.get(param):
+            try:
+                value = cast(params[param])
+            except ValueError:
+                raise ApiError(f"{param} must be an integer")
+            queryset = queryset.filter(**{lookup: value})
+    return queryset
+
+
+def _rows(queryset, resource, fields, limit=None):
+    """Select ``fields`` plus the keyset and version columns and yield ``(row_dict, date_added, pk, updated)``"""
+    spec = RESOURCES[resource]['fields']
+    columns, expressions, converters = [], {}, []
+    for name in fields:
+        column, converter = spec[name]
+        if isinstance(column, str):
+            columns.append(column)
+        else:
+            # Expressions have to be selected under an alias that isn't a model field
+            alias = f"api_{name}"
+            expressions[alias] = column
+            columns.append(alias)
+        converters.append(converter)
+    rows = queryset.annotate(**expressions).values_list(*columns, 'date_added', 'pk', 'updated')
+    if limit is not None:
+        rows = rows[:limit]
+    for row in rows:
+        data = {
+            name: converter(value) if converter else value
+            for name, converter, value in zip(fields, converters, row)
+        }
+        yield data, row[-3], row[-2], row[-1]
+
+
+def _version(keys, *extra):
+    """ETag parts for rows given as ``(pk, updated)`` pairs: which rows, and their newest edit"""
+    return [pk for pk, _ in keys], max((updated for _, updated in keys), default=None), *extra
+
+
+def _page_queryset(resource, params, cursor):
+    return keyset_filter(_filtered(resource, params), cursor).order_by('-date_added', '-pk')
+
+
+def ids_version(resource, ids, params):
+    keys = _filtered(resource, params).filter(pk__in=ids).order_by('pk').values_list('pk', 'updated')
+    return _version(list(keys))
+
+
+def fetch_ids(resource, ids, fields, params):
+    """Rows with the given ids in one query, in request order, the ids that weren't found, and the version"""
+    found = {
+        pk: (data, updated)
+        for data, _, pk, updated in _rows(_filtered(resource, params).filter(pk__in=ids).order_by(), resource, fields)
+    }
+    version = _version([(pk, found[pk][1]) for pk in sorted(found)])
+    return [found[pk][0] for pk in ids if pk in found], [pk for pk in ids if pk not in found], version
+
+
+def page_version(resource, params, cursor=None, limit=API_PAGE_SIZE):
+    keys = list(_page_queryset(resource, params, cursor).values_list('pk', 'updated')[:limit + 1])
+    return _version(keys[:limit], len(keys) > limit)
+
+
+def fetch_page(resource, fields, params, cursor=None, limit=API_PAGE_SIZE):
+    """One keyset page of rows, newest first, the cursor for the next page, and the version"""
+    rows = list(_rows(_page_queryset(resource, params, cursor), resource, fields, limit + 1))
+    version = _version([(pk, updated) for _, _, pk, updated in rows[:limit]], len(rows) > limit)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        _, date_added, pk, _ = rows[-1]
+        next_cursor = encode_cursor(date_added, 0, pk)
+    return [data for data, _, _, _ in rows], next_cursor, version
+
+
+def row_version(resource, pk):
+    """The row's version, or None if it doesn't exist"""
+    keys = list(RESOURCES[resource]['model'].objects.filter(pk=pk).values_list('pk', 'updated'))
+    return _version(keys) if keys else None
+
+
+def fetch_one(resource, pk, fields):
+    """The row as a dict and its version, or ``(None, None)`` if it doesn't exist"""
+    rows = list(_rows(RESOURCES[resource]['model'].objects.filter(pk=pk), resource, fields))
+    if not rows:
+        return None, None
+    data, _, pk, updated = rows[0]
+    return data, _version([(pk, updated)])
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChaiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chai'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,66 @@
+"""Authentication helpers.
+
+``CachedUserBackend`` loads the signed-in user for each request from the
+cache instead of ``auth_user``; saving or deleting a user drops the cached
+copy (see chai.signals). ``bearer_token_required`` authenticates machine
+clients such as store POS systems.
+"""
+import hmac
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+
+def _bearer_token(request):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' else None
+
+
+def bearer_token_required(view):
+    """Require ``Authorization: Bearer <token>`` with a token from POS_API_TOKENS.
+
+    The ids of the stores the token may write to are set as
+    ``request.pos_store_ids``. Token-authenticated requests carry no session
+    cookie, so the view is exempt from CSRF checks.
+    """
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = _bearer_token(request)
+        # Compare against every token so timing doesn't reveal which one nearly matched
+        store_ids = None
+        for expected, stores in settings.POS_API_TOKENS.items():
+            if bool(token) and hmac.compare_digest(token.encode(), expected.encode()):
+                store_ids = stores
+        if store_ids is None:
+            response = JsonResponse({'success': False, 'error': 'Invalid or missing API token'}, status=401)
+            response['WWW-Authenticate'] = 'Bearer'
+            return response
+        request.pos_store_ids = store_ids
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def user_cache_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+class CachedUserBackend(ModelBackend):
+    """ModelBackend whose per-request user lookup is served from the cache.
+
+    Changes made with ``QuerySet.update()`` skip the save signal, so they show
+    up only once the cached copy expires after USER_CACHE_SECONDS.
+    """
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_SECONDS)
+        return user if user is not None and self.user_can_authenticate(user) else None
@@ -0,0 +1,868 @@
+"""Performance benchmarks for the chai app.
+
+Run with ``python manage.py benchmark <scenario>``. Every scenario runs inside
+a throwaway test database, so it never touches the configured data.
+"""
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import override_settings
+
+from .models import ChaiVariety
+
+SCENARIOS = {}
+
+# Cold-start budget for a production worker or management command: a fresh
+# interpreter running django.setup() and loading the URLconf. The startup
+# scenario fails when the median goes over it.
+STARTUP_BUDGET_MS = 900
+
+
+def scenario(name, description):
+    """Register a benchmark function under ``name``"""
+    def register(func):
+        SCENARIOS[name] = (func, description)
+        return func
+    return register
+
+
+@contextmanager
+def scratch_database():
+    """Create a fresh test database for the duration of a benchmark"""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def timed(func, *args, **kwargs):
+    """Run ``func`` once and return ``(seconds, result)``"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def seed_chais(count, prefix='Bench chai'):
+    """Insert ``count`` chais without going through save() and its image handling"""
+    chai_types = [code for code, _ in ChaiVariety.CHAI_TYPE_CHOICE]
+    ChaiVariety.objects.bulk_create(
+        ChaiVariety(
+            name=f"{prefix} {i}",
+            image='chais/medium_masala.jpeg',
+            chai_type=chai_types[i % len(chai_types)],
+            description='A benchmark chai with a short description.',
+            price=50 + i % 150,
+        )
+        for i in range(count)
+    )
+    return list(ChaiVariety.objects.order_by('pk'))
+
+
+def seed_users(count, prefix='bench'):
+    User.objects.bulk_create(User(username=f"{prefix}{i}") for i in range(count))
+    return list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+
+
+@contextmanager
+def muted(*signals):
+    """Disconnect every receiver of ``signals`` for the duration of the block"""
+    saved = [(signal, signal.receivers) for signal in signals]
+    try:
+        for signal in signals:
+            signal.receivers = []
+            signal.sender_receivers_cache.clear()
+        yield
+    finally:
+        for signal, receivers in saved:
+            signal.receivers = receivers
+            signal.sender_receivers_cache.clear()
+
+
+@scenario('reviews', "Review POST throughput: the original chai_detail JSON path vs the throttled, deduped, write-behind endpoint")
+def bench_reviews(report, size):
+    import json
+
+    from django.db.models.signals import post_delete, post_save, pre_save
+    from django.http import JsonResponse
+    from django.shortcuts import get_object_or_404
+    from django.test import RequestFactory
+
+    from .aggregates import review_aggregates
+    from .models import ChaiReview, Favorite
+    from .trending import trending_events
+    from .views import submit_review
+
+    chais = seed_chais(20)
+    users = seed_users(50)
+    factory = RequestFactory()
+
+    def requests(label):
+        for i in range(size):
+            body = json.dumps({'rating': i % 5 + 1, 'review_text': f"Lovely cup number {i} ({label})"})
+            chai = chais[i % len(chais)]
+            request = factory.post(f'/chai/{chai.pk}/reviews/', body, content_type='application/json')
+            request.user = users[i % len(users)]
+            yield request, chai.pk
+
+    def legacy_view(request, chai_id):
+        # The POST half of chai_detail as the baseline shipped it, unchanged:
+        # the page context it built before looking at the method, then the
+        # JSON branch
+        chai = get_object_or_404(ChaiVariety, pk=chai_id)
+        chai.reviews.all()
+        chai.get_average_rating()
+        chai.get_review_count()
+        chai.get_favorite_count()
+        Favorite.objects.filter(user=request.user, chai_variety=chai).exists()
+        try:
+            data = json.loads(request.body)
+            review = ChaiReview(
+                user=request.user, chai_variety=chai, rating=data.get('rating'), review_text=data.get('review_text'),
+            )
+            review.full_clean()
+            review.save()
+            return JsonResponse({'success': True, 'message': 'Review posted successfully!'})
+        except Exception as e:
+            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+    def legacy():
+        # The baseline had no receivers on review writes
+        with muted(pre_save, post_save, post_delete):
+            for request, chai_id in legacy_requests:
+                assert legacy_view(request, chai_id).status_code == 200
+
+    def buffered():
+        for request, chai_id in buffered_requests:
+            assert submit_review(request, chai_id).status_code == 201
+        review_aggregates.flush()
+        trending_events.flush()
+
+    legacy_requests = list(requests('legacy'))
+    buffered_requests = list(requests('buffered'))
+    with override_settings(REVIEW_RATE_LIMIT_BURST=size + 1):
+        legacy_seconds, _ = timed(legacy)
+        # on_commit callbacks run immediately outside a transaction, so the
+        # buffers see every event exactly as they would in production
+        buffered_seconds, _ = timed(buffered)
+
+    report(f"original path: {size / legacy_seconds:8.0f} reviews/s ({legacy_seconds:.3f}s for {size})")
+    report(f"buffered path: {size / buffered_seconds:8.0f} reviews/s ({buffered_seconds:.3f}s for {size})")
+
+
+@scenario('cards', "Chai card rendering: cold vs warm fragment cache for 12/48/96-card pages")
+def bench_cards(report, size):
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.cache import cache
+    from django.template import engines
+    from django.test.utils import CaptureQueriesContext
+
+    seed_chais(96)
+    page = engines['django'].from_string(
+        '{% for chai in chais %}{% include "chai/chai_card.html" %}{% endfor %}'
+    )
+
+    for count in (12, 48, 96):
+        chais = list(ChaiVariety.objects.all()[:count])
+        for chai in chais:
+            chai.avg_rating = chai.get_cached_average_rating()
+            chai.review_count = chai.rating_count
+        context = {'chais': chais, 'user': AnonymousUser()}
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as cold_queries:
+            cold_seconds, _ = timed(page.render, context)
+        warm_runs = []
+        with CaptureQueriesContext(connection) as warm_queries:
+            for _ in range(5):
+                warm_runs.append(timed(page.render, context)[0])
+        warm_seconds = min(warm_runs)
+
+        report(
+            f"{count:3} cards: cold {cold_seconds * 1000:7.2f} ms ({len(cold_queries)} queries), "
+            f"warm {warm_seconds * 1000:7.2f} ms ({len(warm_queries) // 5} queries)"
+        )
+
+
+@scenario('logging', "Request latency with logging off, a synchronous file handler and the queued JSON pipeline")
+def bench_logging(report, size):
+    import logging
+    import statistics
+    import tempfile
+    from logging.handlers import RotatingFileHandler
+    from pathlib import Path
+
+    from django.test import Client
+
+    from .log import JsonFormatter, QueueListenerHandler, RequestContextFilter, SampleFilter
+
+    chai = seed_chais(12)[0]
+    client = Client()
+    url = f"/chai/{chai.pk}/"
+    names = ['', 'django', 'chai']
+    saved = {name: (logging.getLogger(name).handlers[:], logging.getLogger(name).level) for name in names}
+
+    def use(handler, level=logging.INFO):
+        for name in names:
+            logger = logging.getLogger(name)
+            logger.handlers = [handler] if handler else []
+            logger.setLevel(level)
+
+    def measure():
+        client.get(url)
+        latencies = []
+        for _ in range(size):
+            seconds, _ = timed(client.get, url)
+            latencies.append(seconds * 1000)
+        latencies.sort()
+        return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+    with tempfile.TemporaryDirectory() as tmp, override_settings(ALLOWED_HOSTS=['*']):
+        sync = RotatingFileHandler(Path(tmp) / 'sync.log', maxBytes=15 * 1024 * 1024)
+        sync.setFormatter(logging.Formatter('{levelname} {asctime} {module} {process:d} {thread:d} {message}', style='{'))
+        target = RotatingFileHandler(Path(tmp) / 'queued.log', maxBytes=15 * 1024 * 1024)
+        target.setFormatter(JsonFormatter())
+        queued = QueueListenerHandler([target])
+        queued.addFilter(RequestContextFilter())
+        queued.addFilter(SampleFilter(rate=0.01))
+
+        modes = [('off', None), ('sync file', sync), ('queued json', queued)]
+        try:
+            for label, handler in modes:
+                use(handler)
+                logging.disable(logging.CRITICAL if handler is None else logging.NOTSET)
+                p50, p95 = measure()
+                report(f"{label:12} p50 {p50:6.2f} ms  p95 {p95:6.2f} ms")
+
+            # Per-record cost on the calling thread, where request latency is paid
+            logger = logging.getLogger('chai.benchmark')
+            for label, handler in modes[1:]:
+                use(handler)
+                seconds, _ = timed(lambda: [logger.info("event %s of %s", i, size) for i in range(size * 10)])
+                report(f"{label:12} {seconds / (size * 10) * 1e6:6.1f} µs per INFO record on the caller")
+        finally:
+            logging.disable(logging.NOTSET)
+            queued.close()
+            sync.close()
+            target.close()
+            for name, (handlers, level) in saved.items():
+                logging.getLogger(name).handlers = handlers
+                logging.getLogger(name).setLevel(level)
+
+
+def _import_times(stderr):
+    """Sum ``-X importtime`` self time in microseconds per top-level package"""
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(own)
+    return totals
+
+
+@scenario('startup', "Cold start: django.setup() import time in production and development mode vs STARTUP_BUDGET_MS")
+def bench_startup(report, size):
+    import os
+    import statistics
+    import subprocess
+    import sys
+
+    from django.conf import settings
+    from django.core.management.base import CommandError
+
+    code = "import django; django.setup(); from django.urls import get_resolver; get_resolver().url_patterns"
+    runs = max(1, min(size, 10))
+
+    def start(debug, *flags):
+        env = dict(os.environ, DEBUG=str(debug), DEV_TOOLS=str(debug))
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'chaiaurDjango.settings')
+        seconds, proc = timed(
+            subprocess.run, [sys.executable, *flags, '-c', code],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        return seconds * 1000, proc.stderr
+
+    results = {}
+    for label, debug in (('production', False), ('development', True)):
+        start(debug)
+        results[label] = statistics.median(start(debug)[0] for _ in range(runs))
+        totals = _import_times(start(debug, '-X', 'importtime')[1])
+        heaviest = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:6]
+        report(f"{label:12} median {results[label]:6.0f} ms over {runs} runs")
+        report("             heaviest imports: " + ', '.join(f"{name} {us / 1000:.0f} ms" for name, us in heaviest))
+
+    if results['production'] > STARTUP_BUDGET_MS:
+        raise CommandError(f"Production cold start {results['production']:.0f} ms is over the {STARTUP_BUDGET_MS} ms budget")
+    report(f"production cold start is within the {STARTUP_BUDGET_MS} ms budget")
+
+
+@scenario('homepage', "Homepage: live section aggregates vs serving the cached snapshot as the tables grow")
+def bench_homepage(report, size):
+    import statistics
+    from datetime import timedelta
+
+    from django.core.cache import cache
+    from django.db import reset_queries
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.utils import timezone
+
+    from .analytics import rollup
+    from .homepage import build_snapshot
+    from .models import ChaiReview, Favorite, Store, StoreRating
+
+    client = Client()
+    now = timezone.now()
+    for factor in (1, 4, 16):
+        # Grow every table by the same proportion each round
+        chais = seed_chais(50 * factor, prefix=f"Home chai x{factor}")
+        chais = chais[-50 * factor:]
+        users = seed_users(size * factor // 50 or 1, prefix=f"home{factor}-")
+        stores = Store.objects.bulk_create(
+            Store(name=f"Home store {factor}-{i}", store_location='Pune') for i in range(20 * factor)
+        )
+        ChaiReview.objects.bulk_create(
+            ChaiReview(
+                user=users[i % len(users)], chai_variety=chais[i % len(chais)], rating=i % 5 + 1,
+                review_text='Benchmark review', date_added=now - timedelta(hours=i % 240),
+            )
+            for i in range(size * factor)
+        )
+        Favorite.objects.bulk_create(
+            Favorite(user=user, chai_variety=chai, date_added=now - timedelta(hours=i % 240))
+            for i, (user, chai) in enumerate((user, chai) for user in users for chai in chais[:10])
+        )
+        StoreRating.objects.bulk_create(
+            StoreRating(user=user, store=store, rating=(i + j) % 5 + 1)
+            for i, user in enumerate(users) for j, store in enumerate(stores[:10])
+        )
+        rollup(full=True)
+
+        # With DEBUG on, seeding fills the capped query log and capturing would count nothing
+        reset_queries()
+        cache.clear()
+        with CaptureQueriesContext(connection) as build_queries:
+            build_seconds = min(timed(build_snapshot)[0] for _ in range(3))
+        build_query_count = len(build_queries) // 3
+
+        latencies = []
+        with override_settings(ALLOWED_HOSTS=['*']):
+            client.get('/')
+            reset_queries()
+            with CaptureQueriesContext(connection) as served_queries:
+                for _ in range(50):
+                    latencies.append(timed(client.get, '/')[0] * 1000)
+            served_query_count = len(served_queries) // 50
+
+        report(
+            f"{ChaiReview.objects.count():6} reviews, {StoreRating.objects.count():5} store ratings: "
+            f"live build {build_seconds * 1000:7.2f} ms ({build_query_count} queries), "
+            f"served page p50 {statistics.median(latencies):5.2f} ms ({served_query_count} queries)"
+        )
+
+
+@contextmanager
+def sqlite_file_copy(path):
+    """Point the default connection at a file copy of the in-memory scratch database.
+
+    Journal modes only matter for databases on disk. The in-memory database
+    lives as long as its connection, so that connection is set aside rather
+    than closed and put back afterwards.
+    """
+    import sqlite3
+
+    connection.ensure_connection()
+    memory, memory_name = connection.connection, connection.settings_dict['NAME']
+    target = sqlite3.connect(path)
+    try:
+        memory.backup(target)
+    finally:
+        target.close()
+    connection.connection = None
+    connection.settings_dict['NAME'] = path
+    try:
+        yield
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = memory_name
+        connection.connection = memory
+
+
+@scenario('orders', "POS order ingestion: per-line lookups and saves vs cached price maps and bulk writes, by journal mode")
+def bench_orders(report, size):
+    import os
+    import random
+    import tempfile
+    from datetime import datetime, timedelta
+    from decimal import Decimal
+
+    from django.core.cache import cache
+    from django.db import transaction
+    from django.db.models import F
+    from django.utils import timezone
+
+    from .models import DailyStoreSales, Order, OrderLine, Store, StoreInventory
+    from .orders import ingest_orders
+
+    batch_size = 100
+    chais = seed_chais(40)
+    stores = Store.objects.bulk_create(Store(name=f"Counter {i}", store_location='Pune') for i in range(10))
+    StoreInventory.objects.bulk_create(StoreInventory(store=store, chai_variety=chai) for store in stores for chai in chais)
+
+    rng = random.Random(41)
+    start = timezone.now() - timedelta(days=2)
+
+    def make_orders(prefix):
+        orders = []
+        for n in range(size):
+            lines = [
+                {'chai': chai.pk, 'quantity': rng.randint(1, 3), 'unit_price': str(chai.price)}
+                for chai in rng.sample(chais, rng.randint(1, 4))
+            ]
+            orders.append({
+                'store': stores[n % len(stores)].pk,
+                'id': f"{prefix}-{n}",
+                'placed_at': (start + timedelta(seconds=n * 30)).isoformat(),
+                'lines': lines,
+            })
+        return orders
+
+    def per_row(orders):
+        # One transaction per order, a price lookup and an INSERT per line, and
+        # a read-modify-write of the day's rollup row
+        for data in orders:
+            with transaction.atomic():
+                placed_at = datetime.fromisoformat(data['placed_at'])
+                order = Order.objects.create(
+                    store_id=data['store'], external_id=data['id'], placed_at=placed_at, total=0,
+                )
+                cups = 0
+                for line in data['lines']:
+                    listing = StoreInventory.objects.select_related('chai_variety').get(
+                        store_id=data['store'], chai_variety_id=line['chai'],
+                    )
+                    assert listing.get_price() == Decimal(line['unit_price'])
+                    OrderLine.objects.create(
+                        order=order, chai_variety_id=line['chai'], quantity=line['quantity'],
+                        unit_price=line['unit_price'],
+                    )
+                    order.total += listing.get_price() * line['quantity']
+                    cups += line['quantity']
+                order.save(update_fields=['total'])
+                sales, _ = DailyStoreSales.objects.get_or_create(
+                    store_id=data['store'], day=timezone.localdate(placed_at),
+                )
+                DailyStoreSales.objects.filter(pk=sales.pk).update(
+                    order_count=F('order_count') + 1, cup_count=F('cup_count') + cups,
+                    revenue=F('revenue') + order.total,
+                )
+
+    def batched(orders):
+        for first in range(0, len(orders), batch_size):
+            created, _, rejected = ingest_orders(orders[first:first + batch_size])
+            assert created == len(orders[first:first + batch_size]) and not rejected
+
+    def measure(label):
+        for path_label, func in (('per-row', per_row), ('batched', batched)):
+            orders = make_orders(f"{label}-{path_label}")
+            lines = sum(len(order['lines']) for order in orders)
+            cache.clear()
+            seconds, _ = timed(func, orders)
+            report(
+                f"{label:18} {path_label:8} {size / seconds:8.0f} orders/s {lines / seconds:8.0f} lines/s "
+                f"({seconds:.2f}s for {size} orders)"
+            )
+
+    if connection.vendor != 'sqlite':
+        measure(connection.vendor)
+        return
+
+    modes = (('rollback journal', 'DELETE', 'FULL'), ('WAL', 'WAL', 'NORMAL'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, journal_mode, synchronous in modes:
+            with sqlite_file_copy(os.path.join(tmp, f"{journal_mode.lower()}.sqlite3")):
+                with connection.cursor() as cursor:
+                    cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+                    cursor.execute(f"PRAGMA synchronous={synchronous}")
+                measure(f"SQLite {label}")
+
+
+@scenario('api', "Payload size and latency: HTML pages vs the v1 JSON API (full, sparse and 304 revalidation)")
+def bench_api(report, size):
+    import statistics
+
+    from django.test import Client
+
+    from .models import ChaiReview, Store, StoreRating
+
+    chais = seed_chais(200)
+    users = seed_users(100)
+    chai = chais[0]
+    ChaiReview.objects.bulk_create(
+        ChaiReview(user=user, chai_variety=chai, rating=i % 5 + 1, review_text=f"Review {i} of a fine cup of chai")
+        for i, user in enumerate(users)
+    )
+    store = Store.objects.create(name='Benchmark counter', store_location='Pune')
+    StoreRating.objects.bulk_create(
+        StoreRating(store=store, user=user, rating=i % 5 + 1, comment='Quick service') for i, user in enumerate(users)
+    )
+
+    client = Client()
+    runs = max(size // 10, 10)
+    cases = [
+        ('catalogue page', '/chai/'),
+        ('api chais', '/chai/api/v1/chais/?limit=12'),
+        ('api chais sparse', '/chai/api/v1/chais/?limit=12&fields=id,name,price,average_rating'),
+        ('chai page', f"/chai/{chai.pk}/"),
+        ('api chai', f"/chai/api/v1/chais/{chai.pk}/"),
+        ('api chai reviews', f"/chai/api/v1/reviews/?chai={chai.pk}&limit=100&fields=user,rating,review_text"),
+        ('store page', f"/chai/stores/{store.pk}/"),
+        ('api store ratings', f"/chai/api/v1/store-ratings/?store={store.pk}&limit=100&fields=user,rating,comment"),
+        ('api batch of 100', '/chai/api/v1/chais/?fields=id,name,price&ids=' + ','.join(str(c.pk) for c in chais[:100])),
+    ]
+    with override_settings(ALLOWED_HOSTS=['*']):
+        for label, url in cases:
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            latencies = sorted(timed(client.get, url)[0] * 1000 for _ in range(runs))
+            line = f"{label:18} {len(response.content):7} bytes  p50 {statistics.median(latencies):6.2f} ms"
+            if response.has_header('ETag'):
+                revalidations = [
+                    timed(client.get, url, HTTP_IF_NONE_MATCH=response['ETag'])[0] * 1000 for _ in range(runs)
+                ]
+                line += f"  304 p50 {statistics.median(revalidations):6.2f} ms"
+            report(line)
+
+
+@scenario('comment_votes', "Helpful votes on one hot comment: single counter row vs sharded counters, 1/4/8 threads")
+def bench_comment_votes(report, size):
+    import os
+    import tempfile
+    import threading
+
+    from django.db import transaction
+    from django.db.models import F
+
+    from .models import ChaiReview, CommentVote, ReviewComment
+    from .votes import compact_votes, helpful_counts, vote
+
+    users = seed_users(size)
+    chai = seed_chais(1)[0]
+    review = ChaiReview.objects.create(user=users[0], chai_variety=chai, review_text='Benchmark review', rating=4)
+
+    def single_row(user, comment_id):
+        with transaction.atomic():
+            CommentVote.objects.create(user=user, comment_id=comment_id)
+            ReviewComment.objects.filter(pk=comment_id).update(is_helpful=F('is_helpful') + 1)
+
+    def run(func, comment_id, threads):
+        errors = []
+
+        def worker(chunk):
+            try:
+                for user in chunk:
+                    func(user, comment_id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(users[i::threads],)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def measure(label):
+        for threads in (1, 4, 8):
+            for path_label, func in (('single row', single_row), ('sharded', vote)):
+                comment = ReviewComment.objects.create(review=review, user=users[0], comment_text=path_label)
+                seconds, _ = timed(run, func, comment.pk, threads)
+                if func is vote:
+                    compact_votes()
+                comment.refresh_from_db()
+                assert comment.is_helpful == size == helpful_counts([comment.pk])[comment.pk]
+                report(f"{label:10} {threads} threads  {path_label:10} {size / seconds:8.0f} votes/s ({seconds:.2f}s)")
+
+    if connection.vendor != 'sqlite':
+        measure(connection.vendor)
+        return
+
+    # Threads need their own connections, which an in-memory database can't share
+    with tempfile.TemporaryDirectory() as tmp:
+        with sqlite_file_copy(os.path.join(tmp, 'votes.sqlite3')):
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+            measure('SQLite WAL')
+
+
+@scenario('trending', "Top 10 trending chais: brute-force decay over every event vs the indexed log score")
+def bench_trending(report, size):
+    import random
+    import statistics
+    from datetime import timedelta
+
+    from django.conf import settings
+    from django.utils import timezone
+
+    from .models import ChaiReview, Favorite
+    from .trending import FAVORITE_WEIGHT, REVIEW_WEIGHT, rebuild_scores, trending, trending_events
+
+    chais = seed_chais(500)
+    users = seed_users(max(size, 50))
+    rng = random.Random(44)
+    now = timezone.now()
+    # Bulk inserts skip the signals; the scores are built by the rebuild below
+    ChaiReview.objects.bulk_create(
+        (
+            ChaiReview(
+                user=rng.choice(users), chai_variety=rng.choice(chais), review_text='Benchmark review', rating=4,
+                date_added=now - timedelta(minutes=rng.randrange(60 * 24 * 60)),
+            )
+            for _ in range(size * 20)
+        ),
+        batch_size=500,
+    )
+    Favorite.objects.bulk_create(
+        (
+            Favorite(user=user, chai_variety=chai, date_added=now - timedelta(minutes=rng.randrange(60 * 24 * 60)))
+            for user in users for chai in rng.sample(chais, 5)
+        ),
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    events = ChaiReview.objects.count() + Favorite.objects.count()
+    seconds, _ = timed(rebuild_scores)
+    report(f"rebuild_trending over {events} events: {seconds * 1000:.0f} ms")
+
+    half_life = timedelta(hours=settings.TRENDING_HALF_LIFE_HOURS)
+
+    def brute_force():
+        scores = {}
+        for model, weight in ((ChaiReview, REVIEW_WEIGHT), (Favorite, FAVORITE_WEIGHT)):
+            for chai_id, when in model.objects.values_list('chai_variety_id', 'date_added').iterator():
+                scores[chai_id] = scores.get(chai_id, 0.0) + weight * 0.5 ** ((now - when) / half_life)
+        return sorted(scores, key=scores.get, reverse=True)[:10]
+
+    def indexed():
+        return [chai.pk for chai in trending(ChaiVariety.objects.all(), now=now)]
+
+    assert brute_force() == indexed()
+    runs = 20
+    for label, func in (('brute force', brute_force), ('indexed score', indexed)):
+        latencies = [timed(func)[0] * 1000 for _ in range(runs)]
+        report(f"{label:14} p50 {statistics.median(latencies):8.2f} ms")
+
+    # Events are buffered in memory; a flush folds a batch in with one UPDATE
+    batch = [rng.choice(chais).pk for _ in range(100)]
+
+    def add_and_flush():
+        for chai_id in batch:
+            trending_events.add(ChaiVariety, chai_id, FAVORITE_WEIGHT, now)
+        trending_events.flush()
+
+    latencies = [timed(add_and_flush)[0] * 1000 for _ in range(runs)]
+    report(f"{'100 events':14} p50 {statistics.median(latencies):8.2f} ms (buffered, one UPDATE)")
+
+
+@scenario('static', "Static bytes per page: plain files vs collectstatic's precompressed gzip/brotli variants")
+def bench_static(report, size):
+    import os
+    import re
+    import tempfile
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test import Client
+
+    from .models import Store
+    from .staticfiles import CompressedManifestStaticFilesStorage, brotli
+
+    chai = seed_chais(1)[0]
+    store = Store.objects.create(name='Benchmark counter', store_location='Pune')
+    pages = [
+        ('home', '/'),
+        ('catalogue', '/chai/'),
+        ('chai page', f"/chai/{chai.pk}/"),
+        ('store page', f"/chai/stores/{store.pk}/"),
+        ('admin login', '/admin/login/'),
+    ]
+    plain = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    }
+    static_url = re.escape('/' + settings.STATIC_URL.lstrip('/'))
+    client = Client()
+    assets = {}
+    with override_settings(ALLOWED_HOSTS=['*'], STORAGES=plain):
+        for label, url in pages:
+            html = client.get(url).content.decode()
+            assets[label] = sorted(set(re.findall(rf'(?:href|src)="{static_url}([^"?#]+)"', html)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = {**plain, 'staticfiles': {'BACKEND': 'chai.staticfiles.CompressedManifestStaticFilesStorage'}}
+        with override_settings(STATIC_ROOT=tmp, STORAGES=storage):
+            seconds, _ = timed(call_command, 'collectstatic', interactive=False, verbosity=0)
+            collected = CompressedManifestStaticFilesStorage()
+        variants = sum(name.endswith(('.gz', '.br')) for _, _, files in os.walk(tmp) for name in files)
+        report(f"collectstatic {seconds:.2f}s, {variants} precompressed variants"
+               f"{'' if brotli else ' (gzip only: brotli package not installed)'}")
+
+        def size(path):
+            return os.path.getsize(path) if os.path.exists(path) else None
+
+        for label, names in assets.items():
+            totals = [0, 0, 0]
+            missing = []
+            for name in names:
+                hashed = collected.hashed_files.get(name)
+                if hashed is None:
+                    missing.append(name)
+                    continue
+                path = os.path.join(tmp, hashed)
+                original = size(path)
+                gz = size(path + '.gz') or original
+                totals[0] += original
+                totals[1] += gz
+                totals[2] += size(path + '.br') or gz
+            line = f"{label:12} {len(names) - len(missing):2} assets {totals[0]:7} bytes  gzip {totals[1]:7}"
+            if totals[0]:
+                line += f" (-{100 - 100 * totals[1] / totals[0]:.0f}%)"
+            if brotli:
+                line += f"  br {totals[2]:7} (-{100 - 100 * totals[2] / max(totals[0], 1):.0f}%)"
+            if missing:
+                line += f"  not collected: {', '.join(missing)}"
+            report(line)
+
+
+@scenario('session', "Queries and latency per signed-in page view by session profile, with and without the cached user")
+def bench_session(report, size):
+    import statistics
+
+    from django.db import reset_queries
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    from .models import ChaiReview, Favorite, Store, StoreRating
+
+    chais = seed_chais(24)
+    users = seed_users(max(size // 10, 20))
+    chai, store = chais[0], Store.objects.create(name='Benchmark counter', store_location='Pune')
+    ChaiReview.objects.bulk_create(
+        ChaiReview(user=user, chai_variety=chai, review_text='Benchmark review', rating=4) for user in users
+    )
+    StoreRating.objects.bulk_create(StoreRating(store=store, user=user, rating=4) for user in users)
+    Favorite.objects.bulk_create(Favorite(user=users[0], chai_variety=c) for c in chais[:5])
+
+    pages = [
+        ('chai page', f"/chai/{chai.pk}/"),
+        ('store page', f"/chai/stores/{store.pk}/"),
+        ('activity', '/chai/my-activity/'),
+        ('catalogue', '/chai/'),
+    ]
+    profiles = [
+        ('db, uncached user', 'django.contrib.sessions.backends.db', 'django.contrib.auth.backends.ModelBackend'),
+        ('cached_db, cached user', 'django.contrib.sessions.backends.cached_db', 'chai.auth.CachedUserBackend'),
+        ('signed cookie, cached', 'django.contrib.sessions.backends.signed_cookies', 'chai.auth.CachedUserBackend'),
+    ]
+    runs = max(size // 25, 10)
+    for profile, engine, backend in profiles:
+        with override_settings(ALLOWED_HOSTS=['*'], SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=[backend]):
+            client = Client()
+            client.force_login(users[0])
+            for label, url in pages:
+                # Warm the session, user and fragment caches, then count a steady-state view
+                client.get(url)
+                reset_queries()
+                with CaptureQueriesContext(connection) as ctx:
+                    response = client.get(url)
+                queries = len(ctx)
+                assert response.status_code == 200, (url, response.status_code)
+                latencies = [timed(client.get, url)[0] * 1000 for _ in range(runs)]
+                report(f"{profile:24} {label:11} {queries:3} queries  p50 {statistics.median(latencies):6.2f} ms")
+
+
+@scenario('branches', "One branch's page and report queries as another branch grows, with and without branch-led indexes")
+def bench_branches(report, size):
+    import random
+    import statistics
+    from datetime import timedelta
+
+    from django.db.models import Avg, Count
+    from django.utils import timezone
+
+    from .branches import use_branch
+    from .models import Branch, ChaiReview, Store, StoreRating
+
+    chais = seed_chais(20)
+    users = seed_users(100)
+    quiet, busy = Branch.objects.create(name='Quiet', slug='quiet'), Branch.objects.create(name='Busy', slug='busy')
+    rng = random.Random(47)
+    now = timezone.now()
+
+    def grow(branch, factor):
+        """Add ``factor`` branch-sized batches of stores, ratings and reviews to ``branch``"""
+        for _ in range(factor):
+            stores = Store.objects.bulk_create(
+                Store(name=f"{branch.name} store", store_location='Somewhere', branch=branch) for _ in range(10)
+            )
+            StoreRating.objects.bulk_create(
+                (
+                    StoreRating(
+                        store=store, user=user, branch=branch, rating=rng.randint(1, 5),
+                        date_added=now - timedelta(minutes=rng.randrange(60 * 24 * 90)),
+                    )
+                    for store in stores for user in users
+                ),
+                batch_size=500,
+            )
+            ChaiReview.objects.bulk_create(
+                (
+                    ChaiReview(
+                        user=rng.choice(users), chai_variety=rng.choice(chais), branch=branch, rating=4,
+                        review_text='Benchmark review',
+                        date_added=now - timedelta(minutes=rng.randrange(60 * 24 * 90)),
+                    )
+                    for _ in range(size * 4)
+                ),
+                batch_size=500,
+            )
+
+    queries = [
+        ('store list', lambda: list(Store.objects.order_by('-date_added')[:20])),
+        ('chai reviews', lambda: list(chais[0].reviews.order_by('-date_added')[:20])),
+        ('30-day report', lambda: StoreRating.objects.filter(date_added__gte=now - timedelta(days=30)).aggregate(
+            ratings=Count('pk'), average=Avg('rating'),
+        )),
+    ]
+    runs = 30
+
+    def measure(label):
+        with use_branch(quiet):
+            line = []
+            for name, query in queries:
+                latencies = [timed(query)[0] * 1000 for _ in range(runs)]
+                line.append(f"{name} {statistics.median(latencies):6.2f} ms")
+        report(f"{label:34} " + '  '.join(line))
+
+    grow(quiet, 1)
+    grown = 0
+    for factor in (0, 10, 40):
+        grow(busy, factor - grown)
+        grown = factor
+        rows = ChaiReview.all_branches.count() + StoreRating.all_branches.count()
+        measure(f"busy branch x{factor:<3} ({rows:6} rows)")
+
+    with connection.schema_editor() as editor:
+        for model in (Store, StoreRating, ChaiReview):
+            for index in model._meta.indexes:
+                if index.fields[0] == 'branch':
+                    editor.remove_index(model, index)
+    measure("same, without branch-led indexes")
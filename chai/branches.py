@@ -0,0 +1,180 @@
+"""Branch (tenant) partitioning for a chain of stores.
+
+``Store``, ``StoreRating``, ``ChaiReview`` and ``Favorite`` rows belong to a
+``Branch``. The branch serving the current request is kept in a context
+variable. ``BranchMiddleware`` sets it from the BRANCH_HEADER request header,
+which the front-end proxy sets per site; ``use_branch()`` sets it for code
+running outside a request. While a branch is active, the models' default
+``objects`` manager only returns that branch's rows, and new rows are
+assigned to it (see chai.signals). ``all_branches`` is the unscoped manager.
+With no branch active, which is the default, nothing is filtered. Every such
+model has indexes that start with ``branch``, so one branch's pages and
+reports read only its own index range, however large the other branches
+grow.
+
+A branch can also live in a database of its own: add a ``branch_<slug>``
+alias to DATABASES (SQLite files through BRANCH_DATABASES, or any engine in
+settings). ``BranchRouter`` then sends that branch's stores, ratings,
+reviews and their dependent rows there, so a busy branch's writes don't
+queue behind the others'. Shared tables (users, branches, the chai
+catalogue) stay on ``default``, and so do favorites: a user favorites a chai
+once across the chain, which only a single table can enforce. Shared rows
+are copied into every branch database as they are saved (see chai.signals)
+so that foreign keys resolve there; ``python manage.py
+sync_branch_catalogue`` does a full copy for a new branch database.
+
+A chai's review counters (``rating_count``, ``rating_sum``) and trending
+score count every branch's reviews, while its review list only shows the
+active branch's. Chain-wide recomputes (``recount_reviews``,
+``rebuild_trending``, the analytics rollup and exports) read every database
+in ``branch_databases()`` and add the results up.
+
+Querysets are lazy: one evaluated after the middleware has returned, such as
+a streamed export, is no longer scoped.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, models
+from django.http import HttpResponseNotFound
+
+BRANCHES_CACHE_KEY = 'branches:by-slug'
+# forget_branches() only reaches the local process under a per-process cache,
+# so other workers pick up renamed or deleted branches after this long
+BRANCHES_CACHE_SECONDS = 300
+
+# Models stored in a branch's own database when it has one. The first three carry
+# the branch column; the rest hang off them.
+BRANCH_ROUTED_MODELS = {
+    'store', 'storerating', 'chaireview', 'storeinventory', 'reviewcomment', 'commentvote',
+    'commentvoteshard', 'order', 'orderline', 'dailystoresales',
+}
+
+_current_branch = ContextVar('current_branch', default=None)
+
+
+def current_branch():
+    """The active Branch, or None when queries aren't scoped to one"""
+    return _current_branch.get()
+
+
+@contextmanager
+def use_branch(branch):
+    """Scope queries and new rows inside the block to ``branch`` (None lifts the scope)"""
+    token = _current_branch.set(branch)
+    try:
+        yield
+    finally:
+        _current_branch.reset(token)
+
+
+class BranchManager(models.Manager):
+    """Default manager that only sees the active branch's rows"""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        branch = _current_branch.get()
+        return queryset if branch is None else queryset.filter(branch_id=branch.pk)
+
+
+def branches_by_slug():
+    """Every branch as ``{slug: Branch}``, cached until a branch changes"""
+    from .models import Branch
+
+    branches = cache.get(BRANCHES_CACHE_KEY)
+    if branches is None:
+        branches = {branch.slug: branch for branch in Branch.objects.using(DEFAULT_DB_ALIAS)}
+        cache.set(BRANCHES_CACHE_KEY, branches, BRANCHES_CACHE_SECONDS)
+    return branches
+
+
+def branch_for_slug(slug):
+    """The Branch called ``slug``, or None; a slug missing from the cached map is looked up"""
+    from .models import Branch
+
+    branch = branches_by_slug().get(slug)
+    if branch is None and Branch.objects.using(DEFAULT_DB_ALIAS).filter(slug=slug).exists():
+        # Created since this worker cached the map
+        forget_branches()
+        branch = branches_by_slug().get(slug)
+    return branch
+
+
+def forget_branches():
+    cache.delete(BRANCHES_CACHE_KEY)
+
+
+class BranchMiddleware:
+    """Scope the request to the branch named in the BRANCH_HEADER header, if any"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        slug = request.headers.get(settings.BRANCH_HEADER)
+        if not slug:
+            return self.get_response(request)
+        branch = branch_for_slug(slug)
+        if branch is None:
+            return HttpResponseNotFound("Unknown branch")
+        request.branch = branch
+        with use_branch(branch):
+            return self.get_response(request)
+
+
+def branch_alias(branch):
+    alias = f"branch_{branch.slug}"
+    return alias if alias in settings.DATABASES else None
+
+
+def branch_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('branch_')]
+
+
+def branch_databases():
+    """Every database holding branch-owned rows: ``default`` and each branch's own"""
+    return [DEFAULT_DB_ALIAS, *branch_aliases()]
+
+
+def copy_shared_rows(model, rows, batch_size=500):
+    """Insert or update ``rows`` of a shared model in every branch database"""
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    for alias in branch_aliases():
+        # Fresh instances, since bulk_create ties the ones it saves to the alias
+        copies = [model(pk=row.pk, **{f.attname: getattr(row, f.attname) for f in fields}) for row in rows]
+        model._base_manager.using(alias).bulk_create(
+            copies, batch_size=batch_size, update_conflicts=True, unique_fields=['id'],
+            update_fields=[f.name for f in fields],
+        )
+
+
+def delete_shared_rows(model, pks):
+    """Delete shared rows from every branch database, cascading like on ``default``"""
+    for alias in branch_aliases():
+        model._base_manager.using(alias).filter(pk__in=pks).delete()
+
+
+class BranchRouter:
+    """Send branch-owned models to the active branch's database, when it has one"""
+
+    def _db(self, model):
+        branch = _current_branch.get()
+        if branch is None or model._meta.app_label != 'chai' or model._meta.model_name not in BRANCH_ROUTED_MODELS:
+            return None
+        return branch_alias(branch)
+
+    def db_for_read(self, model, **hints):
+        return self._db(model)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Shared rows are copied into every branch database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Branch databases get the full schema so foreign keys to the shared tables work
+        return True if db.startswith('branch_') else None
@@ -0,0 +1,304 @@
+"""Certificate numbers, bulk issuance and fast verification.
+
+Numbers come from a gap-free ``Sequence`` pushed through a keyed Feistel
+permutation: every sequence value maps to a distinct 40-bit value, so numbers
+never collide and never need an IntegrityError retry loop, yet they don't look
+sequential. They are printed as ``CHAI-XXXX-XXXX-C`` in Crockford base32 with
+a mod-31 check character, so most typos are rejected before any lookup.
+
+Verification goes through a Bloom filter of every issued number kept in the
+cache. A number the filter has never seen is rejected without searching the
+certificate table; only probable hits pay for the indexed lookup and join.
+The cached filter is keyed by a version counter kept in the database
+(a ``Sequence`` row), which issuing a certificate bumps in the same
+transaction. The version itself is cached too, so verifying an unknown
+number makes no query at all: issuance writes the new version to the cache
+once it commits, and otherwise a cached version is re-read after
+CERTIFICATE_FILTER_VERSION_SECONDS. With a shared cache every process sees
+new certificates at once; with a per-process one, other processes may
+reject them for up to that long. A filter is built from numbers read after
+its version, so it can only hold more numbers than its version promises,
+never fewer.
+"""
+import hashlib
+import hmac
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChaiCertificate, Checkpoint
+from .routers import use_primary
+
+CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+HALF_BITS = 20
+HALF_MASK = (1 << HALF_BITS) - 1
+FEISTEL_ROUNDS = 4
+SEQUENCE_NAME = 'certificate'
+
+FILTER_CACHE_KEY = 'certificates:bloom:{}'
+FILTER_VERSION_SEQUENCE = 'certificate-filter'
+FILTER_VERSION_CACHE_KEY = 'certificates:bloom-version'
+FILTER_FALSE_POSITIVE_RATE = 0.01
+
+
+def _round_function(key, round_number, half):
+    digest = hmac.new(key, f"{round_number}:{half}".encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], 'big') & HALF_MASK
+
+
+def permute(value):
+    """Map a sequence value in [0, 2**40) to a unique, scrambled value in the same range"""
+    key = settings.CERTIFICATE_NUMBER_KEY.encode()
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for round_number in range(FEISTEL_ROUNDS):
+        left, right = right, left ^ _round_function(key, round_number, right)
+    return (left << HALF_BITS) | right
+
+
+def format_number(value):
+    """Format a 40-bit value as ``CHAI-XXXX-XXXX-C``"""
+    chars = ''.join(CROCKFORD[(value >> shift) & 31] for shift in range(35, -1, -5))
+    check = CROCKFORD[value % 31]
+    return f"CHAI-{chars[:4]}-{chars[4:]}-{check}"
+
+
+def normalize_number(number):
+    """Return the canonical form of a certificate number, or None if it is malformed"""
+    parts = number.strip().upper().split('-')
+    if [len(part) for part in parts] != [4, 4, 4, 1] or parts[0] != 'CHAI':
+        return None
+    # Crockford base32 reads O as 0 and I/L as 1, so common misreadings still verify
+    body = ''.join(parts[1:]).translate(str.maketrans('OIL', '011'))
+    if any(char not in CROCKFORD for char in body):
+        return None
+    value = 0
+    for char in body[:8]:
+        value = value * 32 + CROCKFORD.index(char)
+    if CROCKFORD[value % 31] != body[8]:
+        return None
+    return format_number(value)
+
+
+def allocate_numbers(count):
+    """Reserve ``count`` fresh, collision-free certificate numbers"""
+    from .models import Sequence
+
+    return [format_number(permute(value)) for value in Sequence.allocate(SEQUENCE_NAME, count)]
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, picklable for the cache"""
+
+    def __init__(self, capacity, error_rate=FILTER_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+def _stored_filter_version():
+    from .models import Sequence
+
+    # A lagging replica would hand out an old version
+    with use_primary():
+        return Sequence.objects.filter(name=FILTER_VERSION_SEQUENCE).values_list('value', flat=True).first() or 0
+
+
+def certificate_filter_version():
+    """The filter version: bumped whenever certificates are issued"""
+    version = cache.get(FILTER_VERSION_CACHE_KEY)
+    if version is None:
+        version = _stored_filter_version()
+        # add, not set: a version read before an issuance committed mustn't
+        # replace the one that issuance just cached
+        cache.add(FILTER_VERSION_CACHE_KEY, version, settings.CERTIFICATE_FILTER_VERSION_SECONDS)
+    return version
+
+
+def build_certificate_filter(version=None):
+    """Build a Bloom filter of every issued certificate number and cache it under its version"""
+    # A lagging replica would leave just-issued numbers out of the filter
+    with use_primary():
+        # Read the version first: numbers read afterwards include everything it covers
+        if version is None:
+            version = _stored_filter_version()
+        numbers = ChaiCertificate.objects.values_list('certificate_number', flat=True)
+        # Leave headroom so issuance between rebuilds doesn't degrade the filter
+        bloom = BloomFilter(capacity=max(ChaiCertificate.objects.count() * 2, 10000))
+        for number in numbers.iterator(chunk_size=5000):
+            bloom.add(number)
+    cache.set(FILTER_CACHE_KEY.format(version), bloom, settings.CERTIFICATE_FILTER_SECONDS)
+    return bloom
+
+
+def get_certificate_filter():
+    version = certificate_filter_version()
+    bloom = cache.get(FILTER_CACHE_KEY.format(version))
+    if bloom is None:
+        bloom = build_certificate_filter(version)
+    return bloom
+
+
+def invalidate_certificate_filter():
+    """Bump the filter version, in the caller's transaction if there is one.
+
+    Every process then rebuilds the filter on its next verification; filters
+    under older versions are left to expire.
+    """
+    from .models import Sequence
+
+    [version] = Sequence.allocate(FILTER_VERSION_SEQUENCE)
+    transaction.on_commit(
+        lambda: cache.set(FILTER_VERSION_CACHE_KEY, version, settings.CERTIFICATE_FILTER_VERSION_SECONDS)
+    )
+
+
+def verify_certificate(number):
+    """Look up a certificate by number, or return None if it doesn't exist"""
+    number = normalize_number(number)
+    if number is None or number not in get_certificate_filter():
+        return None
+    return (
+        ChaiCertificate.objects.select_related('user', 'chai_variety')
+        .filter(certificate_number=number)
+        .first()
+    )
+
+
+def certificate_context(certificate):
+    """Plain, picklable data for rendering a certificate in a worker process"""
+    return {
+        'number': certificate.certificate_number,
+        'holder': certificate.user.get_full_name() or certificate.user.username,
+        'chai': certificate.chai_variety.name,
+        'issued': certificate.date_issued.strftime('%d %b %Y'),
+        'valid_until': certificate.valid_until.strftime('%d %b %Y'),
+    }
+
+
+def issue_certificates(users, chai_variety, valid_days, batch_size=1000):
+    """Bulk-issue certificates to ``users`` that don't already hold one.
+
+    Returns the list of created certificates.
+    """
+    users = list(users)
+    with use_primary():
+        holders = set(
+            ChaiCertificate.objects.filter(user__in=users).values_list('user_id', flat=True)
+        )
+    recipients = [user for user in users if user.pk not in holders]
+    if not recipients:
+        return []
+
+    now = timezone.now()
+    valid_until = now + timedelta(days=valid_days)
+    numbers = allocate_numbers(len(recipients))
+    certificates = [
+        ChaiCertificate(
+            user=user,
+            chai_variety=chai_variety,
+            certificate_number=number,
+            date_issued=now,
+            valid_until=valid_until,
+        )
+        for user, number in zip(recipients, numbers)
+    ]
+    with transaction.atomic():
+        ChaiCertificate.objects.bulk_create(certificates, batch_size=batch_size)
+        # Committed together with the rows, so no filter of the new version can miss them
+        invalidate_certificate_filter()
+    return certificates
+
+
+def _sweep_pass(name, queryset, status, start, batch_size, progress=None):
+    """Move rows of ``queryset`` to ``status`` in ``(valid_until, id)`` keyset chunks.
+
+    With a ``name``, the position after every chunk is committed together
+    with the chunk's UPDATE, so an interrupted sweep resumes exactly where it
+    stopped. Without one, the pass starts from ``start`` every time.
+    """
+    checkpoint = Checkpoint.load(name) if name else None
+    last_until = parse_datetime(checkpoint['valid_until']) if checkpoint else start
+    last_id = checkpoint.get('id', 0) if checkpoint else 0
+    if last_until < start:
+        last_until, last_id = start, 0
+
+    processed = 0
+    while True:
+        chunk = list(
+            queryset.filter(Q(valid_until__gt=last_until) | Q(valid_until=last_until, pk__gt=last_id))
+            .order_by('valid_until', 'pk')
+            .values_list('pk', 'valid_until')[:batch_size]
+        )
+        if not chunk:
+            break
+        last_id, last_until = chunk[-1]
+        with transaction.atomic():
+            ChaiCertificate.objects.filter(pk__in=[pk for pk, _ in chunk]).update(status=status)
+            if name:
+                Checkpoint.store(name, {'valid_until': last_until.isoformat(), 'id': last_id})
+        processed += len(chunk)
+        if progress:
+            progress(processed)
+    return processed
+
+
+def sweep_certificates(now=None, expiring_days=30, batch_size=1000, full=False, progress=None):
+    """Mark certificates expiring within ``expiring_days`` and those already expired.
+
+    The expired pass walks the ``valid_until`` index from its checkpoint,
+    which only ever moves forward: rows behind it were handled by an earlier
+    run. The expiring pass starts at ``now`` on every run instead, because
+    certificates issued for a few days, or renewed and set back to active,
+    land behind any checkpoint; its ``status=active`` filter keeps the
+    rescan cheap. ``full`` discards the checkpoint and rescans everything,
+    e.g. after certificates were backdated. Returns ``{status: rows_updated}``.
+    """
+    now = now or timezone.now()
+    earliest = ChaiCertificate.objects.order_by('valid_until').values_list('valid_until', flat=True).first()
+    if earliest is None:
+        return {ChaiCertificate.STATUS_EXPIRED: 0, ChaiCertificate.STATUS_EXPIRING: 0}
+    floor = earliest - timedelta(microseconds=1)
+    if full:
+        Checkpoint.objects.filter(name__startswith='certificate-sweep:').delete()
+
+    expired = _sweep_pass(
+        'certificate-sweep:expired',
+        ChaiCertificate.objects.filter(valid_until__lte=now).exclude(status=ChaiCertificate.STATUS_EXPIRED),
+        ChaiCertificate.STATUS_EXPIRED,
+        floor,
+        batch_size,
+        progress,
+    )
+    expiring = _sweep_pass(
+        None,
+        ChaiCertificate.objects.filter(
+            valid_until__gt=now,
+            valid_until__lte=now + timedelta(days=expiring_days),
+            status=ChaiCertificate.STATUS_ACTIVE,
+        ),
+        ChaiCertificate.STATUS_EXPIRING,
+        now,
+        batch_size,
+        progress,
+    )
+    return {ChaiCertificate.STATUS_EXPIRED: expired, ChaiCertificate.STATUS_EXPIRING: expiring}
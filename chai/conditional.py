@@ -0,0 +1,103 @@
+"""HTTP conditional GET support for the catalogue and detail pages.
+
+Each page gets a validator function that reads a handful of version columns
+(``updated`` timestamps, newest primary keys and row counts) in one or two
+cheap queries. ``conditional_page`` turns that into ETag/Last-Modified headers
+and answers ``304 Not Modified`` before the view runs its heavy queries or
+renders anything.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from .models import ChaiReview, ChaiVariety, Store
+
+
+def make_etag(request, parts):
+    user_id = request.user.pk if request.user.is_authenticated else 'anon'
+    raw = '|'.join(str(part) for part in (settings.PAGE_ETAG_VERSION, user_id, request.GET.urlencode(), *parts))
+    return hashlib.md5(raw.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+
+def conditional_page(validator):
+    """Answer conditional GETs for a view using ``validator(request, *args, **kwargs)``.
+
+    The validator returns ``(last_modified, parts)`` or None when the object
+    does not exist. The ETag covers ``parts``, the query string and the
+    viewing user, because signed-in pages carry per-user content. For the same
+    reason Last-Modified is only sent to anonymous visitors and signed-in
+    responses are marked private.
+    """
+    def validators(request, *args, **kwargs):
+        if not hasattr(request, '_page_validators'):
+            request._page_validators = validator(request, *args, **kwargs)
+        return request._page_validators
+
+    def etag_func(request, *args, **kwargs):
+        result = validators(request, *args, **kwargs)
+        return make_etag(request, result[1]) if result else None
+
+    def last_modified_func(request, *args, **kwargs):
+        result = validators(request, *args, **kwargs)
+        if result and not request.user.is_authenticated:
+            return result[0]
+        return None
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            response = conditional_view(request, *args, **kwargs)
+            patch_vary_headers(response, ('Cookie',))
+            if request.user.is_authenticated:
+                patch_cache_control(response, private=True, no_cache=True)
+            else:
+                patch_cache_control(response, public=True, max_age=0)
+            return response
+        return wrapper
+    return decorator
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def catalogue_validator(request):
+    """Any chai added, edited, reviewed or favorited changes the catalogue"""
+    stats = ChaiVariety.objects.aggregate(last_updated=Max('updated'), total=Count('pk'))
+    return stats['last_updated'], (stats['last_updated'], stats['total'])
+
+
+def chai_validator(request, chai_id):
+    """A chai page changes with the chai itself and with any review added, edited or deleted"""
+    updated = ChaiVariety.objects.filter(pk=chai_id).values_list('updated', flat=True).first()
+    if updated is None:
+        return None
+    # Reviews may live in a branch database, so they get their own query
+    reviews = ChaiReview.objects.filter(chai_variety=chai_id).aggregate(
+        last_id=Max('pk'), last_edit=Max('updated'), total=Count('pk'),
+    )
+    return _latest(updated, reviews['last_edit']), (updated, reviews['last_id'], reviews['last_edit'], reviews['total'])
+
+
+def store_validator(request, store_id):
+    """A store page changes with the store, its ratings and the chais it lists"""
+    chais = ChaiVariety.objects.filter(stores=OuterRef('pk')).order_by().values('stores')
+    row = Store.objects.filter(pk=store_id).values_list(
+        'updated',
+        Subquery(chais.annotate(latest=Max('updated')).values('latest')),
+        Coalesce(Subquery(chais.annotate(n=Count('pk')).values('n')), 0, output_field=IntegerField()),
+    ).first()
+    if row is None:
+        return None
+    updated, last_chai_update, _ = row
+    return _latest(updated, last_chai_update), row
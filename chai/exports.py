@@ -0,0 +1,147 @@
+"""Streaming exports of review and rating data for analytics.
+
+Rows are read with ``values_list(...).iterator(chunk_size=...)`` so no model
+instances are built and the database cursor is consumed in fixed-size chunks;
+memory stays flat however many rows are exported.
+
+Incremental exports are keyed by id: ``date_added`` can be backdated or
+shared by many rows, so a timestamp watermark could skip or repeat rows. An
+export's watermark is the newest id it read, and is the ``since`` for the
+next one. Ids are handed out when a row is inserted, not when it commits,
+though, so a row can become visible after an export has already read past
+its id. Like the analytics rollup, every incremental export therefore
+rescans a trailing window: it covers ``since - EXPORT_RESCAN_IDS < id <=
+watermark``, which picks such rows up as long as fewer than
+EXPORT_RESCAN_IDS rows were inserted while their transaction was open.
+Rows in the window are sent again, so consumers upsert by
+``(branch_id, id)``.
+
+A chain-wide export reads ``default`` and every branch database (see
+chai.branches) in turn. Each database hands out its own ids, so the
+watermark holds one id per database: a plain integer for ``default``,
+followed by ``alias:id`` pairs, e.g. ``120,branch_goa:45``. Ids can repeat
+across databases; rows are told apart by ``branch_id``.
+
+The rows are read while the response streams, after BranchMiddleware has
+returned, so a branch's export names its branch explicitly rather than
+relying on the scoped managers.
+"""
+import csv
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+
+from .branches import branch_alias, branch_databases
+from .models import ChaiReview, StoreRating
+
+EXPORT_CHUNK_SIZE = 2000
+
+DATASETS = {
+    'reviews': (
+        ChaiReview,
+        ['id', 'branch_id', 'user_id', 'chai_variety_id', 'rating', 'review_text', 'comment_count', 'date_added'],
+    ),
+    'store-ratings': (
+        StoreRating,
+        ['id', 'branch_id', 'user_id', 'store_id', 'rating', 'comment', 'date_added'],
+    ),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Echo:
+    """File-like object whose write() hands the value straight back to the caller"""
+
+    def write(self, value):
+        return value
+
+
+def _sources(model, branch):
+    """Yield ``(alias, queryset)`` for each database an export of ``model`` reads"""
+    if branch is None:
+        for alias in branch_databases():
+            yield alias, model.all_branches.using(alias)
+    else:
+        alias = branch_alias(branch) or DEFAULT_DB_ALIAS
+        yield alias, model.all_branches.using(alias).filter(branch=branch)
+
+
+def export_watermark(dataset, branch=None):
+    """Return ``{alias: newest id}`` for every database holding rows of a dataset"""
+    model, _ = DATASETS[dataset]
+    newest = {alias: queryset.aggregate(Max('id'))['id__max'] for alias, queryset in _sources(model, branch)}
+    return {alias: last_id for alias, last_id in newest.items() if last_id is not None}
+
+
+def format_watermark(watermark):
+    return ','.join(str(last_id) if alias == DEFAULT_DB_ALIAS else f'{alias}:{last_id}' for alias, last_id in watermark.items())
+
+
+def parse_since(value):
+    """Parse a ``since`` watermark into ``{alias: id}``, or None if invalid"""
+    since = {}
+    for part in (value or '').split(','):
+        alias, _, last_id = part.rpartition(':')
+        try:
+            last_id = int(last_id)
+        except ValueError:
+            return None
+        if last_id < 0 or alias and not alias.startswith('branch_'):
+            return None
+        since[alias or DEFAULT_DB_ALIAS] = last_id
+    return since
+
+
+def export_rows(dataset, since=None, until=None, branch=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield raw row tuples for a dataset, one database at a time in id order.
+
+    Covers ``since - EXPORT_RESCAN_IDS < id <= until``. ``branch`` limits the
+    export to that branch's rows; by default it covers the whole chain.
+    """
+    model, fields = DATASETS[dataset]
+    for alias, queryset in _sources(model, branch):
+        if since is not None:
+            queryset = queryset.filter(id__gt=since.get(alias, 0) - settings.EXPORT_RESCAN_IDS)
+        if until is not None:
+            if alias not in until:
+                # Empty when the watermark was taken
+                continue
+            queryset = queryset.filter(id__lte=until[alias])
+        yield from queryset.order_by('id').values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def stream_csv(dataset, rows):
+    """Yield CSV lines, header first"""
+    _, fields = DATASETS[dataset]
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def stream_ndjson(dataset, rows):
+    """Yield one JSON object per line"""
+    _, fields = DATASETS[dataset]
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), default=_json_default, ensure_ascii=False) + '\n'
+
+
+def stream_export(dataset, fmt, since=None, until=None, branch=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield encoded export chunks for ``dataset`` in ``fmt``"""
+    rows = export_rows(dataset, since=since, until=until, branch=branch, chunk_size=chunk_size)
+    if fmt == 'csv':
+        return stream_csv(dataset, rows)
+    return stream_ndjson(dataset, rows)
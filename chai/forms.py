@@ -1,5 +1,5 @@
 from django import forms
-from .models import ChaiVariety, ChaiReview, ReviewComment, StoreRating
+from .models import ChaiVariety, ChaiReview, ReviewComment, Store, StoreRating
 
 class ChaiVarietyForm(forms.Form):
     chai_variety = forms.ModelChoiceField(
@@ -78,3 +78,34 @@ class ChaiFilterForm(forms.Form):
         required=False,
         widget=forms.CheckboxSelectMultiple(attrs={'class': 'form-check-input'})
     )
+
+
+class BulkRepriceForm(forms.Form):
+    """Admin form for repricing a selection of chais"""
+    MODE_CHOICES = [
+        ('percent', 'Change by percentage'),
+        ('set', 'Set to a fixed price'),
+    ]
+
+    mode = forms.ChoiceField(choices=MODE_CHOICES)
+    value = forms.DecimalField(max_digits=10, decimal_places=2,
+                               help_text="Percentage (e.g. -10 or 15) or the new price in ₹")
+
+    def clean(self):
+        cleaned_data = super().clean()
+        mode, value = cleaned_data.get('mode'), cleaned_data.get('value')
+        if value is not None:
+            if mode == 'percent' and value < -100:
+                self.add_error('value', "A price can't drop by more than 100%.")
+            if mode == 'set' and value < 0:
+                self.add_error('value', "Price can't be negative.")
+        return cleaned_data
+
+
+class StoreSelectionForm(forms.Form):
+    """Admin form for picking the stores a bulk listing change applies to"""
+    stores = forms.ModelMultipleChoiceField(queryset=Store.objects.order_by('name'))
+
+
+class ConfirmForm(forms.Form):
+    """Admin confirmation step for bulk actions that need no input"""
@@ -0,0 +1,183 @@
+"""Precomputed homepage snapshot.
+
+The homepage shows trending chais, top-rated stores, the newest additions and
+site totals. Computing those on every visit would mean several aggregates
+over the largest tables on the busiest URL, so ``build_snapshot`` computes
+every section at once and stores the result in the cache as one JSON blob.
+The home view only decodes it and renders, whatever the table sizes.
+
+Serving is stale-while-revalidate: a snapshot older than
+HOMEPAGE_SNAPSHOT_FRESH_SECONDS, or older than the last relevant write
+(``mark_stale``), is still served as is while one background thread builds a
+replacement. Review counters and trending scores are written behind
+(chai.aggregates), so their flushes mark it stale again once they land.
+Rebuilds start at most once per HOMEPAGE_SNAPSHOT_REBUILD_SECONDS, however
+many writes or visitors ask for one. Only a cold cache makes a visitor wait
+for a build. ``python manage.py build_homepage --loop`` keeps the snapshot
+fresh on a schedule so that rarely happens.
+
+Stores, ratings and favorites are scoped to the active branch (chai.branches),
+so each branch has its own snapshot, plus one for unscoped requests. Rebuilds
+run under the branch they were started for.
+"""
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Avg, Count, Sum
+from django.utils import timezone
+
+from .branches import current_branch, use_branch
+from .models import Branch, ChaiVariety, Favorite, Store
+from .trending import current_score
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CACHE_KEY = 'homepage:snapshot:{}'
+STALE_CACHE_KEY = 'homepage:stale-since'
+REBUILD_LOCK_KEY = 'homepage:rebuilding:{}'
+
+SECTION_SIZE = 8
+MIN_STORE_RATINGS = 3
+
+_CARD_FIELDS = ('pk', 'name', 'image', 'chai_type', 'price', 'rating_sum', 'rating_count')
+
+
+def _chai_cards(rows):
+    """Plain card data for chai rows from ``values()``"""
+    storage = ChaiVariety._meta.get_field('image').storage
+    types = dict(ChaiVariety.CHAI_TYPE_CHOICE)
+    return [
+        {
+            'id': row['pk'],
+            'name': row['name'],
+            'image_url': storage.url(row['image']) if row['image'] else '',
+            'chai_type': types.get(row['chai_type'], row['chai_type']),
+            'price': row['price'],
+            'average_rating': round(row['rating_sum'] / row['rating_count'], 1) if row['rating_count'] else 0,
+            'review_count': row['rating_count'],
+        }
+        for row in rows
+    ]
+
+
+def trending_chais(limit=SECTION_SIZE):
+    """Chais with the highest time-decayed review and favorite activity"""
+    rows = ChaiVariety.objects.filter(trending_score__isnull=False).order_by('-trending_score', '-pk')
+    rows = list(rows.values(*_CARD_FIELDS, 'trending_score')[:limit])
+    cards = _chai_cards(rows)
+    for card, row in zip(cards, rows):
+        card['trending_score'] = round(current_score(row['trending_score']), 2)
+    return cards
+
+
+def newest_chais(limit=SECTION_SIZE):
+    return _chai_cards(ChaiVariety.objects.order_by('-date_added', '-pk').values(*_CARD_FIELDS)[:limit])
+
+
+def top_stores(limit=SECTION_SIZE, min_ratings=MIN_STORE_RATINGS):
+    """Best average store ratings among stores with at least ``min_ratings`` ratings"""
+    stores = (
+        Store.objects.annotate(average_rating=Avg('ratings__rating'), rating_count=Count('ratings'))
+        .filter(rating_count__gte=min_ratings)
+        .order_by('-average_rating', '-rating_count', 'pk')
+        .values('pk', 'name', 'store_location', 'average_rating', 'rating_count')[:limit]
+    )
+    return [
+        {
+            'id': row['pk'],
+            'name': row['name'],
+            'location': row['store_location'],
+            'average_rating': round(row['average_rating'], 1),
+            'rating_count': row['rating_count'],
+        }
+        for row in stores
+    ]
+
+
+def site_totals():
+    # Review totals come from the denormalized counters rather than a COUNT(*)
+    chais = ChaiVariety.objects.aggregate(chais=Count('pk'), reviews=Sum('rating_count'))
+    return {
+        'chais': chais['chais'],
+        'reviews': chais['reviews'] or 0,
+        'stores': Store.objects.count(),
+        'favorites': Favorite.objects.count(),
+    }
+
+
+def _branch_key(key, branch):
+    return key.format(branch.slug if branch is not None else '-')
+
+
+def build_snapshot():
+    """Compute the active branch's homepage sections, cache the blob and return the snapshot"""
+    built = time.time()
+    snapshot = {
+        'trending': trending_chais(),
+        'top_stores': top_stores(),
+        'newest': newest_chais(),
+        'totals': site_totals(),
+        'built_at': timezone.now(),
+    }
+    blob = json.dumps(snapshot, cls=DjangoJSONEncoder)
+    cache.set(_branch_key(SNAPSHOT_CACHE_KEY, current_branch()), (built, blob), settings.HOMEPAGE_SNAPSHOT_MAX_AGE_SECONDS)
+    return json.loads(blob)
+
+
+def build_all_snapshots():
+    """Build the unscoped snapshot and every branch's; returns them as ``{slug or None: snapshot}``"""
+    snapshots = {}
+    for branch in [None, *Branch.objects.order_by('pk')]:
+        with use_branch(branch):
+            snapshots[branch.slug if branch is not None else None] = build_snapshot()
+    return snapshots
+
+
+def mark_stale():
+    """Record that homepage data changed; the next visit to each snapshot revalidates it"""
+    cache.set(STALE_CACHE_KEY, time.time(), settings.HOMEPAGE_SNAPSHOT_MAX_AGE_SECONDS)
+
+
+def _rebuild(branch):
+    try:
+        # Threads don't inherit the request's context variables
+        with use_branch(branch):
+            build_snapshot()
+    except Exception:
+        logger.exception("Homepage snapshot rebuild failed")
+    finally:
+        # The thread opened its own connection; don't leak it
+        connection.close()
+
+
+def revalidate():
+    """Rebuild the snapshot on a background thread unless a rebuild started recently.
+
+    Returns True when a rebuild was started.
+    """
+    branch = current_branch()
+    # The lock is left to expire rather than released, which also rate-limits rebuilds
+    if not cache.add(_branch_key(REBUILD_LOCK_KEY, branch), True, settings.HOMEPAGE_SNAPSHOT_REBUILD_SECONDS):
+        return False
+    threading.Thread(target=_rebuild, args=(branch,), name='homepage-snapshot', daemon=True).start()
+    return True
+
+
+def get_snapshot():
+    """The active branch's homepage snapshot, stale or not; builds one only on a cold cache"""
+    snapshot_key = _branch_key(SNAPSHOT_CACHE_KEY, current_branch())
+    values = cache.get_many([snapshot_key, STALE_CACHE_KEY])
+    entry = values.get(snapshot_key)
+    if entry is None:
+        return build_snapshot()
+    built, blob = entry
+    stale_since = values.get(STALE_CACHE_KEY)
+    if time.time() - built > settings.HOMEPAGE_SNAPSHOT_FRESH_SECONDS or (stale_since and stale_since > built):
+        revalidate()
+    return json.loads(blob)
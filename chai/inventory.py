@@ -0,0 +1,144 @@
+"""Store inventory lookups and POS stock sync.
+
+Availability questions ("which stores carry all of these chais, and at what
+price") are answered from ``StoreInventory`` alone, in one statement that
+walks its ``(chai_variety, is_available, store)`` index. Stock updates from
+point-of-sale systems arrive in batches of thousands of rows and are written
+with ``bulk_update``.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Store, StoreInventory
+from .orders import invalidate_price_maps
+
+MATCH_ALL = 'all'
+MATCH_ANY = 'any'
+
+_PRICE_FIELD = StoreInventory._meta.get_field('price')
+# The smallest price with more integer digits than the column holds
+PRICE_LIMIT = Decimal(10) ** (_PRICE_FIELD.max_digits - _PRICE_FIELD.decimal_places)
+
+
+def find_stores(chai_ids, match=MATCH_ALL):
+    """Return stores carrying all (or any) of ``chai_ids`` with what they charge for each.
+
+    Only available listings count. Stores come back ordered by name as dicts
+    with ``id``, ``name``, ``location`` and ``items``, a list of
+    ``{'chai_id', 'price', 'stock'}``.
+    """
+    chai_ids = set(chai_ids)
+    if not chai_ids:
+        return []
+    listings = StoreInventory.objects.filter(chai_variety__in=chai_ids, is_available=True)
+    rows = listings
+    if match == MATCH_ALL:
+        complete = (
+            listings.order_by().values('store')
+            .annotate(n=Count('chai_variety'))
+            .filter(n=len(chai_ids))
+            .values('store')
+        )
+        rows = rows.filter(store__in=complete)
+    rows = rows.order_by('store__name', 'store_id', 'chai_variety_id').values_list(
+        'store_id', 'store__name', 'store__store_location', 'chai_variety_id',
+        Coalesce('price', 'chai_variety__price'), 'stock',
+    )
+
+    stores = []
+    for store_id, name, location, chai_id, price, stock in rows:
+        if not stores or stores[-1]['id'] != store_id:
+            stores.append({'id': store_id, 'name': name, 'location': location, 'items': []})
+        stores[-1]['items'].append({'chai_id': chai_id, 'price': price, 'stock': stock})
+    return stores
+
+
+def _parse_stock_item(item):
+    """Validate one POS row, returning ``(key, changes)`` or raising ValueError"""
+    if not isinstance(item, dict):
+        raise ValueError("Each item must be an object")
+    try:
+        key = (int(item['store']), int(item['chai']))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Each item needs integer 'store' and 'chai' ids")
+
+    changes = {}
+    if 'stock' in item:
+        stock = item['stock']
+        if stock is not None and (not isinstance(stock, int) or isinstance(stock, bool) or stock < 0):
+            raise ValueError("'stock' must be a non-negative integer or null")
+        changes['stock'] = stock
+        changes['is_available'] = stock is None or stock > 0
+    if 'price' in item:
+        try:
+            price = None if item['price'] is None else Decimal(str(item['price']))
+        except InvalidOperation:
+            raise ValueError("'price' must be a decimal or null")
+        # Decimal() also accepts NaN and Infinity, which the column can't store
+        if price is not None and (
+            not price.is_finite() or not 0 <= price < PRICE_LIMIT or -price.as_tuple().exponent > _PRICE_FIELD.decimal_places
+        ):
+            raise ValueError(f"'price' must be non-negative, below {PRICE_LIMIT}, with at most 2 decimal places")
+        changes['price'] = price
+    if 'available' in item:
+        if not isinstance(item['available'], bool):
+            raise ValueError("'available' must be true or false")
+        changes['is_available'] = item['available']
+    if not changes:
+        raise ValueError("Each item needs at least one of 'stock', 'price' or 'available'")
+    return key, changes
+
+
+def apply_stock_updates(items, batch_size=1000, store_ids=None):
+    """Apply a batch of POS inventory updates.
+
+    Returns ``(updated, unknown, errors)``: the number of rows written, the
+    ``(store, chai)`` pairs the store doesn't list, and ``{index: message}``
+    for invalid items and, when ``store_ids`` is given, items for any other
+    store. Nothing is written when any item is invalid.
+    """
+    updates, errors = {}, {}
+    for index, item in enumerate(items):
+        try:
+            key, changes = _parse_stock_item(item)
+            if store_ids is not None and key[0] not in store_ids:
+                raise ValueError(f"Not allowed to update store {key[0]}")
+        except ValueError as e:
+            errors[index] = str(e)
+        else:
+            # A later row for the same listing wins, as it would on the till
+            updates.setdefault(key, {}).update(changes)
+    if errors:
+        return 0, [], errors
+
+    store_ids = {store_id for store_id, _ in updates}
+    chai_ids = {chai_id for _, chai_id in updates}
+    listings = {
+        (row.store_id, row.chai_variety_id): row
+        for row in StoreInventory.objects.filter(store__in=store_ids, chai_variety__in=chai_ids)
+        .only('pk', 'store_id', 'chai_variety_id', 'price', 'stock', 'is_available')
+    }
+
+    now = timezone.now()
+    changed, unknown = [], []
+    for key, changes in updates.items():
+        row = listings.get(key)
+        if row is None:
+            unknown.append(key)
+            continue
+        for field, value in changes.items():
+            setattr(row, field, value)
+        # bulk_update skips auto_now
+        row.updated = now
+        changed.append(row)
+
+    with transaction.atomic():
+        StoreInventory.objects.bulk_update(changed, ['price', 'stock', 'is_available', 'updated'], batch_size=batch_size)
+        # bulk_update sends no signals, so bump the store page versions here
+        Store.objects.filter(pk__in={row.store_id for row in changed}).update(updated=now)
+    invalidate_price_maps({row.store_id for row in changed})
+    return len(changed), unknown, {}
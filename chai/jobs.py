@@ -0,0 +1,227 @@
+"""Background jobs for bulk admin actions.
+
+Repricing a whole chai type or reassigning hundreds of store listings used to
+happen inside the admin request, one save() per object. Admin actions now
+call ``enqueue``, which records a ``BackgroundJob`` and hands it to a small
+thread pool once the transaction commits. Handlers walk the selection in
+chunks of BACKGROUND_JOB_CHUNK_SIZE, write each chunk with one bulk statement
+and record progress on the job row, which the admin shows as a status page.
+
+With BACKGROUND_JOB_THREADS = 0 jobs stay queued until
+``python manage.py run_jobs`` picks them up; that command also finishes jobs
+that were still queued when a web process restarted.
+
+A running job bumps its ``heartbeat`` with every chunk. If its process dies,
+the heartbeat stops, and after BACKGROUND_JOB_STALE_SECONDS
+``requeue_stale_jobs`` (run by ``run_jobs`` before each pass) puts it back in
+the queue. It resumes after the last chunk it recorded: handlers record
+progress in the same transaction as the chunk's writes, so no chunk is
+applied twice.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .aggregates import review_aggregates
+from .branches import branch_databases
+from .models import BackgroundJob, ChaiReview, ChaiVariety, PriceHistory, Store, StoreInventory, compress_image
+from .orders import invalidate_price_maps
+from .routers import use_primary
+from .trending import trending_events
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def job_handler(kind):
+    """Register ``func(params, progress)`` as the handler for jobs of ``kind``"""
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return register
+
+
+def chunked(items, size=None):
+    size = size or settings.BACKGROUND_JOB_CHUNK_SIZE
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_JOB_THREADS, thread_name_prefix='chai-job',
+            )
+        return _executor
+
+
+def enqueue(kind, params, total, description='', user=None):
+    """Queue a job and start it in the background once the current transaction commits"""
+    job = BackgroundJob.objects.create(
+        kind=kind,
+        params=params,
+        total=total,
+        description=description,
+        created_by=user if user is not None and user.is_authenticated else None,
+    )
+    if settings.BACKGROUND_JOB_THREADS > 0:
+        transaction.on_commit(lambda: _get_executor().submit(_run_in_thread, job.pk))
+    return job
+
+
+def _run_in_thread(job_id):
+    try:
+        # Jobs read back what they write, so replica lag would corrupt them
+        with use_primary():
+            run_job(job_id)
+    finally:
+        # Every worker thread opens its own connection; don't leak it
+        connection.close()
+
+
+class JobLost(Exception):
+    """The job was requeued as stale while this worker was still running it"""
+
+
+def requeue_stale_jobs(stale_seconds=None):
+    """Put running jobs whose heartbeat stopped back in the queue; returns how many"""
+    stale_seconds = settings.BACKGROUND_JOB_STALE_SECONDS if stale_seconds is None else stale_seconds
+    cutoff = timezone.now() - timedelta(seconds=stale_seconds)
+    requeued = BackgroundJob.objects.filter(status=BackgroundJob.STATUS_RUNNING, heartbeat__lt=cutoff).update(
+        status=BackgroundJob.STATUS_QUEUED,
+    )
+    if requeued:
+        logger.warning("Requeued %d background jobs that stopped sending heartbeats", requeued)
+    return requeued
+
+
+def run_job(job_id):
+    """Run a queued job to completion; returns False if another worker already claimed it"""
+    claimed_at = timezone.now()
+    claimed = BackgroundJob.objects.filter(pk=job_id, status=BackgroundJob.STATUS_QUEUED).update(
+        status=BackgroundJob.STATUS_RUNNING, started=claimed_at, heartbeat=claimed_at,
+    )
+    if not claimed:
+        return False
+
+    job = BackgroundJob.objects.get(pk=job_id)
+    processed = job.processed
+    params = job.params
+    if processed and 'ids' in params:
+        # Resuming a requeued job: skip the chunks it already committed
+        params = {**params, 'ids': params['ids'][processed:]}
+    # Only this claim may record progress; a requeued job has a new one
+    ours = BackgroundJob.objects.filter(pk=job_id, started=claimed_at, status=BackgroundJob.STATUS_RUNNING)
+
+    def progress(count):
+        nonlocal processed
+        processed += count
+        if not ours.update(processed=processed, heartbeat=timezone.now()):
+            raise JobLost(f"Background job {job_id} was requeued")
+
+    try:
+        JOB_HANDLERS[job.kind](params, progress)
+    except JobLost:
+        logger.warning("Background job %s (%s) was requeued while running; stopping", job_id, job.kind)
+    except Exception as e:
+        logger.exception("Background job %s (%s) failed", job_id, job.kind)
+        ours.update(status=BackgroundJob.STATUS_FAILED, error=str(e), finished=timezone.now())
+    else:
+        ours.update(status=BackgroundJob.STATUS_DONE, finished=timezone.now())
+    return True
+
+
+@job_handler('reprice')
+def reprice_chais(params, progress):
+    """Set the selected chais to a fixed price, or change their prices by a percentage"""
+    value = Decimal(params['value'])
+    for ids in chunked(params['ids']):
+        now = timezone.now()
+        chais = list(ChaiVariety.objects.filter(pk__in=ids).only('pk', 'price'))
+        changed = []
+        for chai in chais:
+            old_price = chai.price
+            if params['mode'] == 'percent':
+                chai.price = max(chai.price * (100 + value) / 100, Decimal(0)).quantize(Decimal('0.01'))
+            else:
+                chai.price = value
+            # bulk_update skips auto_now, and the price is part of the cached card
+            chai.updated = now
+            if chai.price != old_price:
+                changed.append(PriceHistory(chai_variety=chai, price=chai.price, changed_at=now))
+        with transaction.atomic():
+            ChaiVariety.objects.bulk_update(chais, ['price', 'updated'])
+            # bulk_update doesn't send the signals that normally record history
+            PriceHistory.objects.bulk_create(changed)
+            # A percentage applied twice would compound, so the chunk and its
+            # progress commit together
+            progress(len(ids))
+        invalidate_price_maps()
+
+
+@job_handler('store_chais')
+def change_store_chais(params, progress):
+    """Add the selected chais to, or remove them from, a set of stores"""
+    store_ids = params['store_ids']
+    for ids in chunked(params['ids']):
+        with transaction.atomic():
+            if params['action'] == 'add':
+                StoreInventory.objects.bulk_create(
+                    [StoreInventory(store_id=store_id, chai_variety_id=chai_id) for store_id in store_ids for chai_id in ids],
+                    ignore_conflicts=True,
+                )
+            else:
+                StoreInventory.objects.filter(store__in=store_ids, chai_variety__in=ids).delete()
+            # Bulk writes to the inventory table don't send signals
+            Store.objects.filter(pk__in=store_ids).update(updated=timezone.now())
+            progress(len(ids))
+        invalidate_price_maps(store_ids)
+
+
+@job_handler('reprocess_images')
+def reprocess_images(params, progress):
+    """Recompress the selected chais' images"""
+    for ids in chunked(params['ids']):
+        chais = list(ChaiVariety.objects.filter(pk__in=ids).only('pk', 'name', 'image'))
+        now = timezone.now()
+        for chai in chais:
+            if chai.image:
+                try:
+                    compress_image(chai.image.path)
+                except OSError as e:
+                    logger.warning("Failed to compress image for %s: %s", chai.name, e)
+            chai.updated = now
+        ChaiVariety.objects.bulk_update(chais, ['updated'])
+        progress(len(ids))
+
+
+@job_handler('delete_reviews')
+def delete_reviews_by_users(params, progress):
+    """Delete every review written by the given users, in every branch database too"""
+    for alias in branch_databases():
+        reviews = ChaiReview.all_branches.using(alias).filter(user_id__in=params['user_ids']).order_by('pk')
+        while True:
+            ids = list(reviews.values_list('pk', flat=True)[:settings.BACKGROUND_JOB_CHUNK_SIZE])
+            if not ids:
+                break
+            # Progress is recorded on default; should that fail after the
+            # branch database committed, the retry just finds fewer reviews
+            with transaction.atomic(), transaction.atomic(using=alias):
+                ChaiReview.all_branches.using(alias).filter(pk__in=ids).delete()
+                progress(len(ids))
+    # Worker threads never see request_finished, so apply the buffered deltas now
+    review_aggregates.flush()
+    trending_events.flush()
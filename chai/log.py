@@ -0,0 +1,207 @@
+"""Non-blocking, structured logging.
+
+``QueueListenerHandler`` is the only handler loggers write to. Emitting a
+record just snapshots it onto an in-memory queue; a listener thread does the
+formatting and file/console I/O, so a slow disk never stalls a request.
+
+``RequestLogMiddleware`` gives every request an id (taken from an incoming
+``X-Request-ID`` header when there is one), remembers the resolved view and
+logs one ``chai.request`` line with the status and duration when the
+response is ready. ``RequestContextFilter`` copies the id, view and elapsed
+time onto every record logged while the request runs, and ``JsonFormatter``
+writes records as one JSON object per line.
+
+``RotatingFileHandler`` creates its log directory and opens the file when the
+first record arrives rather than while settings are loaded.
+
+``SampleFilter`` keeps a fixed fraction of low-level records. It samples per
+request, so a sampled request keeps all of its debug records.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+import uuid
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+request_logger = logging.getLogger('chai.request')
+
+_request_context = ContextVar('request_log_context', default=None)
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class QueueListenerHandler(QueueHandler):
+    """Queue records and write them to ``targets`` from a background thread.
+
+    ``targets`` are handler instances, or ``cfg://handlers.<name>``
+    references to other handlers in the same LOGGING config. dictConfig
+    resolves a reference when it is read and may not have built that handler
+    yet when this one is constructed, so they are read on first use. When the
+    queue is full, records are dropped and counted rather than blocking the
+    caller.
+    """
+
+    def __init__(self, targets=(), maxsize=10000, queue=None):
+        super().__init__(queue if queue is not None else Queue(maxsize))
+        self.targets = targets
+        self.listener = None
+        self.dropped = 0
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self.listener is not None:
+                return
+            # Indexing, not iterating, is what makes dictConfig resolve a reference
+            targets = [self.targets[index] for index in range(len(self.targets))]
+            for target in targets:
+                if not isinstance(target, logging.Handler):
+                    raise ValueError(f"QueueListenerHandler target {target!r} is not a configured handler")
+            self.listener = QueueListener(self.queue, *targets, respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Write out everything still queued and stop the listener thread"""
+        with self._start_lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def prepare(self, record):
+        # Render the message (args may be mutated later) and the traceback now,
+        # but leave the formatting itself to the target handlers
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if self.listener is None:
+            self._start()
+        super().emit(record)
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotating file handler that creates its directory and opens the file lazily"""
+
+    def __init__(self, filename, *args, delay=True, **kwargs):
+        super().__init__(filename, *args, delay=delay, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class RequestContextFilter(logging.Filter):
+    """Attach the current request's id, view name and elapsed time to records"""
+
+    def filter(self, record):
+        context = _request_context.get()
+        if context is None:
+            record.request_id = record.view = record.elapsed_ms = None
+        else:
+            record.request_id = context['request_id']
+            record.view = context['view']
+            record.elapsed_ms = round((time.perf_counter() - context['start']) * 1000, 2)
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Keep ``rate`` of the records at or below ``level``; pass everything above it"""
+
+    def __init__(self, rate=0.01, level='DEBUG'):
+        super().__init__()
+        self.rate = float(rate)
+        self.levelno = logging.getLevelName(level) if isinstance(level, str) else level
+
+    def filter(self, record):
+        if record.levelno > self.levelno:
+            return True
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            # Same decision for every record of a request
+            return zlib.crc32(request_id.encode()) % 10000 < self.rate * 10000
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and value is not None:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class RequestLogMiddleware:
+    """Tag log records with the request and log each request's outcome and timing"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        context = {'request_id': request_id, 'view': None, 'start': time.perf_counter()}
+        token = _request_context.set(context)
+        try:
+            response = self.get_response(request)
+            response['X-Request-ID'] = request_id
+            if request_logger.isEnabledFor(logging.INFO):
+                request_logger.info(
+                    "%s %s %s", request.method, request.path, response.status_code,
+                    extra={
+                        'method': request.method,
+                        'path': request.path,
+                        'status': response.status_code,
+                        'duration_ms': round((time.perf_counter() - context['start']) * 1000, 2),
+                    },
+                )
+            return response
+        finally:
+            _request_context.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        context = _request_context.get()
+        if context is not None and request.resolver_match:
+            context['view'] = request.resolver_match.view_name
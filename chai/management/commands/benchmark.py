@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from chai.benchmarks import SCENARIOS, scratch_database
+
+
+class Command(BaseCommand):
+    help = "Run a performance benchmark scenario against a scratch database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', choices=sorted(SCENARIOS))
+        parser.add_argument('--size', type=int, default=500, help="Workload size; meaning depends on the scenario")
+
+    def handle(self, *args, scenario, size, **options):
+        if not scenario:
+            for name, (_, description) in sorted(SCENARIOS.items()):
+                self.stdout.write(f"{name:12} {description}")
+            return
+
+        func, description = SCENARIOS[scenario]
+        self.stdout.write(self.style.MIGRATE_HEADING(description))
+        with scratch_database():
+            func(self.stdout.write, size)
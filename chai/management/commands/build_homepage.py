@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.homepage import build_all_snapshots
+
+
+class Command(BaseCommand):
+    help = "Rebuild the cached homepage snapshots (trending chais, top stores, newest chais, totals) of every branch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Keep rebuilding every --interval seconds")
+        parser.add_argument('--interval', type=int, default=120)
+
+    def handle(self, *args, loop, interval, **options):
+        while True:
+            started = time.perf_counter()
+            snapshots = build_all_snapshots()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Built {len(snapshots)} homepage snapshots in {elapsed * 1000:.1f} ms"
+            ))
+            for slug, snapshot in snapshots.items():
+                self.stdout.write(
+                    f"  {slug or '(all branches)'}: {len(snapshot['trending'])} trending, "
+                    f"{len(snapshot['top_stores'])} stores, {len(snapshot['newest'])} newest"
+                )
+            if not loop:
+                break
+            time.sleep(interval)
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.votes import compact_votes
+
+
+class Command(BaseCommand):
+    help = "Fold sharded helpful-vote counters back into ReviewComment.is_helpful"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Comments compacted per transaction")
+        parser.add_argument('--loop', action='store_true', help="Keep compacting every --interval seconds")
+        parser.add_argument('--interval', type=int, default=60)
+
+    def handle(self, *args, batch_size, loop, interval, **options):
+        while True:
+            started = time.perf_counter()
+            compacted = compact_votes(batch_size=batch_size)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(f"Compacted votes for {compacted} comments in {elapsed:.2f}s"))
+            if not loop:
+                break
+            time.sleep(interval)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chai.exports import DATASETS, EXPORT_CHUNK_SIZE, FORMATS, export_watermark, format_watermark, parse_since, stream_export
+
+
+class Command(BaseCommand):
+    help = "Stream reviews or store ratings as CSV/NDJSON, optionally only rows added since a watermark"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', dest='fmt', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--since', help="Only export rows after this watermark, as printed by the previous export")
+        parser.add_argument('--output', help="Write to this file instead of stdout")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, dataset, fmt, since, output, chunk_size, **options):
+        if since:
+            since = parse_since(since)
+            if since is None:
+                raise CommandError("--since must be a watermark from a previous export")
+
+        until = export_watermark(dataset)
+        chunks = stream_export(dataset, fmt, since, until, chunk_size=chunk_size)
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as out:
+                out.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+
+        # The watermark goes to stderr so stdout stays a clean data stream
+        if until:
+            self.stderr.write(f"watermark: {format_watermark(until)}")
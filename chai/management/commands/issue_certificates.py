@@ -0,0 +1,56 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chai.certificates import certificate_context, issue_certificates
+from chai.models import ChaiVariety
+from chai.rendering import render_certificate_file
+
+
+class Command(BaseCommand):
+    help = "Bulk-issue chai certificates and optionally render them as PNG/PDF in a worker pool"
+
+    def add_arguments(self, parser):
+        parser.add_argument('chai_id', type=int, help="Chai variety the certificates are for")
+        recipients = parser.add_mutually_exclusive_group(required=True)
+        recipients.add_argument('--users-file', help="File with one username per line")
+        recipients.add_argument('--all-users', action='store_true', help="Every user without a certificate")
+        parser.add_argument('--valid-days', type=int, default=365)
+        parser.add_argument('--render', choices=['png', 'pdf'], help="Also render the issued certificates")
+        parser.add_argument('--output-dir', default='certificates')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    def handle(self, *args, chai_id, users_file, all_users, valid_days, render, output_dir, workers, **options):
+        try:
+            chai = ChaiVariety.objects.get(pk=chai_id)
+        except ChaiVariety.DoesNotExist:
+            raise CommandError(f"Chai variety {chai_id} does not exist")
+
+        if all_users:
+            users = User.objects.filter(chai_certificate__isnull=True).order_by('pk')
+        else:
+            with open(users_file, encoding='utf-8') as handle:
+                usernames = {line.strip() for line in handle if line.strip()}
+            users = User.objects.filter(username__in=usernames).order_by('pk')
+            missing = len(usernames) - users.count()
+            if missing:
+                self.stderr.write(f"Skipping {missing} unknown usernames")
+
+        started = time.perf_counter()
+        certificates = issue_certificates(users, chai, valid_days)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Issued {len(certificates)} certificates in {elapsed:.2f}s"))
+
+        if render and certificates:
+            os.makedirs(output_dir, exist_ok=True)
+            jobs = [(certificate_context(certificate), render, output_dir) for certificate in certificates]
+            started = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rendered = sum(1 for _ in pool.map(render_certificate_file, jobs, chunksize=16))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Rendered {rendered} {render.upper()} files to {output_dir} in {elapsed:.2f}s with {workers} workers"
+            ))
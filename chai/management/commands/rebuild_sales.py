@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from chai.orders import rebuild_daily_sales
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-store daily sales rollup from the orders table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First day to rebuild (YYYY-MM-DD); default is every day")
+        parser.add_argument('--until', help="Last day to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, since, until, **options):
+        days = []
+        for value in (since, until):
+            try:
+                day = parse_date(value) if value else None
+            except ValueError:
+                day = None
+            if value and day is None:
+                raise CommandError(f"Not a date: {value}")
+            days.append(day)
+        rows = rebuild_daily_sales(*days)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} store-day sales rows"))
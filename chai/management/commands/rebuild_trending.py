@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.trending import rebuild_scores
+
+
+class Command(BaseCommand):
+    help = "Recompute every chai and store trending score from reviews, favorites and store ratings"
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        scored = rebuild_scores()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f"Scored {scored} chais and stores in {elapsed:.2f}s"))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from chai.aggregates import recount_review_aggregates, review_aggregates
+
+
+class Command(BaseCommand):
+    help = "Rebuild the denormalized review counters on every chai from the reviews table"
+
+    def handle(self, *args, **options):
+        review_aggregates.flush()
+        updated = recount_review_aggregates()
+        self.stdout.write(self.style.SUCCESS(f"Recounted review aggregates for {updated} chais"))
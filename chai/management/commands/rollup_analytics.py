@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.analytics import rollup
+
+
+class Command(BaseCommand):
+    help = "Update the daily per-chai and per-chai-type review and favorite rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help="Discard the checkpoint and rebuild every day from scratch")
+        parser.add_argument('--loop', action='store_true', help="Keep rolling up every --interval seconds")
+        parser.add_argument('--interval', type=int, default=300)
+
+    def handle(self, *args, full, loop, interval, **options):
+        while True:
+            started = time.perf_counter()
+            result = rollup(full=full)
+            elapsed = time.perf_counter() - started
+            if result is None:
+                self.stdout.write("No new reviews or favorites since the last rollup")
+            else:
+                first_day, last_day, rows = result
+                self.stdout.write(self.style.SUCCESS(
+                    f"Rolled up {first_day} to {last_day}: {rows} chai-day rows in {elapsed:.2f}s"
+                ))
+            if not loop:
+                break
+            full = False
+            time.sleep(interval)
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.jobs import requeue_stale_jobs, run_job
+from chai.models import BackgroundJob
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs from the admin's bulk actions, requeueing ones whose worker died"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help="Keep polling for new jobs every --interval seconds")
+        parser.add_argument('--interval', type=int, default=5)
+
+    def handle(self, *args, loop, interval, **options):
+        while True:
+            self.run_queued()
+            if not loop:
+                break
+            time.sleep(interval)
+
+    def run_queued(self):
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Requeued {requeued} stale running jobs"))
+        queued = BackgroundJob.objects.filter(status=BackgroundJob.STATUS_QUEUED).order_by('created')
+        for job_id in queued.values_list('pk', flat=True):
+            started = time.perf_counter()
+            if not run_job(job_id):
+                continue
+            job = BackgroundJob.objects.get(pk=job_id)
+            elapsed = time.perf_counter() - started
+            style = self.style.SUCCESS if job.status == BackgroundJob.STATUS_DONE else self.style.ERROR
+            self.stdout.write(style(
+                f"{job}: {job.processed}/{job.total} items in {elapsed:.2f}s"
+                + (f" - {job.error}" if job.error else "")
+            ))
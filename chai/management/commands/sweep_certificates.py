@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chai.certificates import sweep_certificates
+
+
+class Command(BaseCommand):
+    help = "Mark expired (checkpointed) and expiring certificates in indexed batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expiring-days', type=int, default=30,
+                            help="Flag certificates that expire within this many days")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--full', action='store_true',
+                            help="Ignore the saved checkpoint and rescan every certificate")
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping every --interval seconds")
+        parser.add_argument('--interval', type=int, default=3600)
+
+    def handle(self, *args, expiring_days, batch_size, full, loop, interval, **options):
+        self.verbosity = options['verbosity']
+        while True:
+            self.sweep(expiring_days, batch_size, full)
+            if not loop:
+                break
+            full = False
+            time.sleep(interval)
+
+    def sweep(self, expiring_days, batch_size, full):
+        started = time.perf_counter()
+
+        def progress(processed):
+            if self.verbosity > 1:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"  {processed} rows, {processed / elapsed:.0f} rows/s")
+
+        counts = sweep_certificates(expiring_days=expiring_days, batch_size=batch_size, full=full, progress=progress)
+        elapsed = time.perf_counter() - started
+        total = sum(counts.values())
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Marked {counts['expired']} expired and {counts['expiring']} expiring certificates "
+            f"in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        ))
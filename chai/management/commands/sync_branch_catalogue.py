@@ -0,0 +1,42 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from chai.branches import branch_aliases
+from chai.models import Branch, ChaiVariety
+
+# Shared tables that rows in a branch database point at. Saves and deletes are
+# copied as they happen (chai.signals); this command catches a database up.
+SHARED_MODELS = (User, Branch, ChaiVariety)
+
+
+class Command(BaseCommand):
+    help = "Copy users, branches and the chai catalogue from the default database into each branch database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, batch_size, **options):
+        aliases = branch_aliases()
+        if not aliases:
+            raise CommandError("No branch databases configured; set BRANCH_DATABASES")
+
+        for alias in aliases:
+            started = time.perf_counter()
+            with transaction.atomic(using=alias):
+                for model in SHARED_MODELS:
+                    rows = list(model._base_manager.using(DEFAULT_DB_ALIAS).order_by('pk'))
+                    fields = [f.name for f in model._meta.concrete_fields if not f.primary_key]
+                    model._base_manager.using(alias).bulk_create(
+                        rows, batch_size=batch_size, update_conflicts=True, unique_fields=['id'], update_fields=fields,
+                    )
+                    # Rows deleted on default go here too, cascading like they did there
+                    gone = sorted(
+                        set(model._base_manager.using(alias).values_list('pk', flat=True)) - {row.pk for row in rows}
+                    )
+                    for first in range(0, len(gone), batch_size):
+                        model._base_manager.using(alias).filter(pk__in=gone[first:first + batch_size]).delete()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(f"Synced {alias} in {elapsed:.2f}s"))
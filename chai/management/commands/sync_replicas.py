@@ -0,0 +1,40 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chai.routers import replica_aliases
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database into the local replica stand-ins"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep copying every --interval seconds to simulate replication lag")
+        parser.add_argument('--interval', type=float, default=5)
+
+    def handle(self, *args, loop, interval, **options):
+        primary = settings.DATABASES['default']
+        replicas = replica_aliases()
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError("sync_replicas only copies SQLite databases; real replicas replicate themselves")
+        if not replicas:
+            raise CommandError("No replicas configured; set DATABASE_REPLICAS")
+
+        while True:
+            source = sqlite3.connect(primary['NAME'])
+            try:
+                for alias in replicas:
+                    target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(self.style.SUCCESS(f"Synced {', '.join(replicas)} from the primary"))
+            if not loop:
+                break
+            time.sleep(interval)
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-19 01:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0007_favorite_reviewcomment_storerating'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reviewcomment',
+            index=models.Index(fields=['user', '-date_added'], name='chai_review_user_id_fcf156_idx'),
+        ),
+    ]
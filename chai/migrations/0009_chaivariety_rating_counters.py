@@ -0,0 +1,37 @@
+# Generated by Django 5.2.3 on 2026-10-19 01:41
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_rating_counters(apps, schema_editor):
+    db = schema_editor.connection.alias
+    ChaiVariety = apps.get_model('chai', 'ChaiVariety')
+    ChaiReview = apps.get_model('chai', 'ChaiReview')
+    per_chai = ChaiReview.objects.using(db).filter(chai_variety=OuterRef('pk')).order_by().values('chai_variety')
+    ChaiVariety.objects.using(db).update(
+        rating_count=Coalesce(Subquery(per_chai.annotate(n=Count('pk')).values('n')), Value(0), output_field=IntegerField()),
+        rating_sum=Coalesce(Subquery(per_chai.annotate(total=Sum('rating')).values('total')), Value(0), output_field=IntegerField()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0008_reviewcomment_chai_review_user_id_fcf156_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaivariety',
+            name='rating_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chaivariety',
+            name='rating_sum',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_counters, migrations.RunPython.noop),
+    ]
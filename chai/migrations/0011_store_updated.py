@@ -0,0 +1,20 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0010_chaivariety_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-19 01:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0012_sequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.JSONField(default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chaicertificate',
+            name='status',
+            field=models.CharField(choices=[('active', 'Active'), ('expiring', 'Expiring soon'), ('expired', 'Expired')], default='active', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='chaicertificate',
+            index=models.Index(fields=['valid_until'], name='chai_chaice_valid_u_de1b54_idx'),
+        ),
+    ]
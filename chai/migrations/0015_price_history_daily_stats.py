@@ -0,0 +1,74 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def seed_price_history(apps, schema_editor):
+    """Record each chai's current price as the start of its history"""
+    db = schema_editor.connection.alias
+    ChaiVariety = apps.get_model('chai', 'ChaiVariety')
+    PriceHistory = apps.get_model('chai', 'PriceHistory')
+    PriceHistory.objects.using(db).bulk_create(
+        (PriceHistory(chai_variety_id=pk, price=price, changed_at=date_added)
+         for pk, price, date_added in ChaiVariety.objects.using(db).values_list('pk', 'price', 'date_added').iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0014_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyChaiTypeStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chai_type', models.CharField(choices=[('ML', 'Masala'), ('GR', 'Ginger'), ('KL', 'Kiwi'), ('PL', 'Plain'), ('EL', 'Elaichi')], max_length=2)),
+                ('day', models.DateField()),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('favorite_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day'],
+                'indexes': [models.Index(fields=['day'], name='chai_dailyc_day_8ff9a3_idx')],
+                'unique_together': {('chai_type', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyChaiStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_sum', models.IntegerField(default=0)),
+                ('favorite_count', models.IntegerField(default=0)),
+                ('price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('chai_variety', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='chai.chaivariety')),
+            ],
+            options={
+                'ordering': ['-day'],
+                'indexes': [models.Index(fields=['day'], name='chai_dailyc_day_7ff86a_idx')],
+                'unique_together': {('chai_variety', 'day')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chai_variety', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='chai.chaivariety')),
+            ],
+            options={
+                'ordering': ['-changed_at'],
+                'indexes': [models.Index(fields=['chai_variety', '-changed_at'], name='chai_priceh_chai_va_fa80e6_idx')],
+            },
+        ),
+        migrations.RunPython(seed_price_history, migrations.RunPython.noop),
+    ]
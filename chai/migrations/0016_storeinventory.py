@@ -0,0 +1,70 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_listings(apps, schema_editor):
+    """Carry every existing store listing over to the inventory table"""
+    db = schema_editor.connection.alias
+    Store = apps.get_model('chai', 'Store')
+    StoreInventory = apps.get_model('chai', 'StoreInventory')
+    Listing = Store.chai_varieties.through
+    StoreInventory.objects.using(db).bulk_create(
+        (StoreInventory(store_id=store_id, chai_variety_id=chai_id)
+         for store_id, chai_id in Listing.objects.using(db).values_list('store_id', 'chaivariety_id').iterator()),
+        batch_size=1000,
+    )
+
+
+def copy_listings_back(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Store = apps.get_model('chai', 'Store')
+    StoreInventory = apps.get_model('chai', 'StoreInventory')
+    Listing = Store.chai_varieties.through
+    Listing.objects.using(db).bulk_create(
+        (Listing(store_id=store_id, chaivariety_id=chai_id)
+         for store_id, chai_id in StoreInventory.objects.using(db).values_list('store_id', 'chai_variety_id').iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    """Replace the implicit Store.chai_varieties table with StoreInventory.
+
+    Django can't switch an existing M2M to a custom through model in place,
+    so the listings are copied into the new table before the old field is
+    dropped and re-added on top of it.
+    """
+
+    dependencies = [
+        ('chai', '0015_price_history_daily_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreInventory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('stock', models.PositiveIntegerField(blank=True, null=True)),
+                ('is_available', models.BooleanField(default=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('chai_variety', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='chai.chaivariety')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory', to='chai.store')),
+            ],
+            options={
+                'verbose_name_plural': 'store inventory',
+                'indexes': [models.Index(fields=['chai_variety', 'is_available', 'store'], name='chai_storei_chai_va_c2f1cf_idx')],
+                'unique_together': {('store', 'chai_variety')},
+            },
+        ),
+        migrations.RunPython(copy_listings, copy_listings_back),
+        migrations.RemoveField(
+            model_name='store',
+            name='chai_varieties',
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='chai_varieties',
+            field=models.ManyToManyField(related_name='stores', through='chai.StoreInventory', to='chai.chaivariety'),
+        ),
+    ]
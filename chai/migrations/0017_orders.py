@@ -0,0 +1,63 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:08
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0016_storeinventory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_id', models.CharField(max_length=64)),
+                ('placed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('received', models.DateTimeField(default=django.utils.timezone.now)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='chai.store')),
+            ],
+            options={
+                'ordering': ['-placed_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('chai_variety', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_lines', to='chai.chaivariety')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='chai.order')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyStoreSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('order_count', models.IntegerField(default=0)),
+                ('cup_count', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='chai.store')),
+            ],
+            options={
+                'ordering': ['-day'],
+                'indexes': [models.Index(fields=['day'], name='chai_dailys_day_88f833_idx')],
+                'unique_together': {('store', 'day')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['store', '-placed_at'], name='chai_order_store_i_385468_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='order',
+            unique_together={('store', 'external_id')},
+        ),
+    ]
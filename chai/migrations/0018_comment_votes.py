@@ -0,0 +1,59 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:14
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0017_orders'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentVote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_added', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommentVoteShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reviewcomment',
+            index=models.Index(fields=['review', '-is_helpful', '-date_added'], name='chai_review_review__c71d50_idx'),
+        ),
+        migrations.AddField(
+            model_name='commentvote',
+            name='comment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='votes', to='chai.reviewcomment'),
+        ),
+        migrations.AddField(
+            model_name='commentvote',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='comment_votes', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='commentvoteshard',
+            name='comment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vote_shards', to='chai.reviewcomment'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='commentvote',
+            unique_together={('comment', 'user')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='commentvoteshard',
+            unique_together={('comment', 'shard')},
+        ),
+    ]
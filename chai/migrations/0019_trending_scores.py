@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0018_comment_votes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaivariety',
+            name='trending_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='trending_score',
+            field=models.FloatField(db_index=True, default=0),
+        ),
+    ]
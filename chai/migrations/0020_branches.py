@@ -0,0 +1,86 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:29
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0019_trending_scores'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Branch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.SlugField(unique=True)),
+                ('date_added', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name_plural': 'branches',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='chaireview',
+            name='branch',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='reviews', to='chai.branch'),
+        ),
+        migrations.AddField(
+            model_name='favorite',
+            name='branch',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='favorites', to='chai.branch'),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='branch',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='stores', to='chai.branch'),
+        ),
+        migrations.AddField(
+            model_name='storerating',
+            name='branch',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='store_ratings', to='chai.branch'),
+        ),
+        migrations.AddIndex(
+            model_name='chaireview',
+            index=models.Index(fields=['branch', '-date_added'], name='chai_chaire_branch__a3e6f3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chaireview',
+            index=models.Index(fields=['branch', 'chai_variety', '-date_added'], name='chai_chaire_branch__cb93f5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chaireview',
+            index=models.Index(fields=['branch', 'user', '-date_added'], name='chai_chaire_branch__56fda1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['branch', '-date_added'], name='chai_favori_branch__3da442_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['branch', 'chai_variety'], name='chai_favori_branch__7cbfc5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['branch', '-date_added'], name='chai_store_branch__8fc9ad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['branch', '-trending_score'], name='chai_store_branch__846f9b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storerating',
+            index=models.Index(fields=['branch', '-date_added'], name='chai_storer_branch__a31a4c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storerating',
+            index=models.Index(fields=['branch', 'user', '-date_added'], name='chai_storer_branch__9dc79a_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.3 on 2026-10-19 02:50
+
+import math
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def _half_lives_now():
+    epoch = datetime.fromisoformat(settings.TRENDING_EPOCH)
+    if epoch.tzinfo is None:
+        epoch = epoch.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - epoch).total_seconds() / (settings.TRENDING_HALF_LIFE_HOURS * 3600)
+
+
+def convert_scores(apps, schema_editor):
+    """Turn epoch-scaled scores into (weight, time) pairs and their log score.
+
+    A scaled score ``s`` is the row's activity times ``2 ** now`` in half-lives,
+    so ``log2(s)`` is already the new score and the order doesn't change.
+    """
+    db = schema_editor.connection.alias
+    now = _half_lives_now()
+    for name in ('ChaiVariety', 'Store'):
+        model = apps.get_model('chai', name)
+        rows = []
+        for row in model.objects.using(db).only('pk', 'trending_score').iterator():
+            if row.trending_score and row.trending_score > 0:
+                row.trending_score = math.log2(row.trending_score)
+                row.trending_weight, row.trending_time = 2.0 ** (row.trending_score - now), now
+            else:
+                row.trending_score = None
+            rows.append(row)
+        model.objects.using(db).bulk_update(rows, ['trending_score', 'trending_weight', 'trending_time'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    """Store trending activity as bounded (weight, time) pairs.
+
+    Scores scaled to a fixed epoch doubled every half-life and overflowed a
+    float after 1024 of them.
+    """
+
+    dependencies = [
+        ('chai', '0021_backgroundjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chaivariety',
+            name='trending_time',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chaivariety',
+            name='trending_weight',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='trending_time',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='trending_weight',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='chaivariety',
+            name='trending_score',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='store',
+            name='trending_score',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(convert_scores, migrations.RunPython.noop),
+    ]
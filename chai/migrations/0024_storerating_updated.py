@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chai', '0023_chaireview_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storerating',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,11 +1,35 @@
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
-from PIL import Image
 import logging
 
+from .branches import BranchManager
+
 logger = logging.getLogger(__name__)
 
+def compress_image(path):
+    """Re-encode an image file in place as a JPEG at most 800px wide"""
+    # Imported here so commands and workers that never touch images don't pay for Pillow
+    from PIL import Image
+
+    img = Image.open(path)
+
+    # Convert RGBA to RGB if necessary (for JPEG compatibility)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+        rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        img = rgb_img
+
+    # Compress image: max width 800px, quality 85
+    max_width = 800
+    if img.width > max_width:
+        ratio = max_width / img.width
+        new_height = int(img.height * ratio)
+        img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+
+    # Save compressed image
+    img.save(path, 'JPEG', quality=85, optimize=True)
+
 class ChaiVariety(models.Model):
     CHAI_TYPE_CHOICE = [
         ('ML', 'Masala'),
@@ -17,9 +41,19 @@ class ChaiVariety(models.Model):
     name = models.CharField(max_length=100)
     image = models.ImageField(upload_to='chais/')
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
+    # Bumped on every change that affects how the chai renders, including
+    # review counter flushes and favorites; used to version cached fragments
+    updated = models.DateTimeField(auto_now=True, db_index=True)
     chai_type = models.CharField(max_length=2, choices=CHAI_TYPE_CHOICE, default='ML', db_index=True)
     description = models.TextField(blank=True, default='')
     price = models.DecimalField(max_digits=10, decimal_places=2, default=100.00)
+    # Denormalized review aggregates, maintained in batches by chai.aggregates
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    # Review and favorite activity, decayed over time; see chai.trending
+    trending_weight = models.FloatField(default=0)
+    trending_time = models.FloatField(default=0)
+    trending_score = models.FloatField(null=True, blank=True, db_index=True)
 
     class Meta:
         ordering = ['-date_added']
@@ -39,6 +73,10 @@ class ChaiVariety(models.Model):
     def get_review_count(self):
         """Get total number of reviews"""
         return self.reviews.count()
+
+    def get_cached_average_rating(self):
+        """Get average rating from the denormalized counters, without a query"""
+        return round(self.rating_sum / self.rating_count, 2) if self.rating_count else 0
     
     def get_favorite_count(self):
         """Get total number of favorites"""
@@ -51,40 +89,46 @@ class ChaiVariety(models.Model):
         # Compress image if it exists
         if self.image:
             try:
-                img = Image.open(self.image.path)
-                
-                # Convert RGBA to RGB if necessary (for JPEG compatibility)
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                    rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = rgb_img
-                
-                # Compress image: max width 800px, quality 85
-                max_width = 800
-                if img.width > max_width:
-                    ratio = max_width / img.width
-                    new_height = int(img.height * ratio)
-                    img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                
-                # Save compressed image
-                img.save(self.image.path, 'JPEG', quality=85, optimize=True)
-                logger.info(f"Image compressed for ChaiVariety: {self.name}")
+                compress_image(self.image.path)
+                logger.info("Image compressed for ChaiVariety: %s", self.name)
             except Exception as e:
-                logger.warning(f"Failed to compress image for {self.name}: {str(e)}")
+                logger.warning("Failed to compress image for %s: %s", self.name, e)
+
+class Branch(models.Model):
+    """One branch of the chain; stores, ratings, reviews and favorites belong to one (see chai.branches)"""
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True)
+    date_added = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'branches'
+
+    def __str__(self):
+        return self.name
 
 class ChaiReview(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='reviews')
+    # Indexed through the branch-led composite indexes below
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True, db_index=False, related_name='reviews')
     review_text = models.TextField()
     rating = models.IntegerField(default=1, choices=[(i, i) for i in range(1, 6)])
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
     comment_count = models.IntegerField(default=0)
 
+    objects = BranchManager()
+    all_branches = models.Manager()
+
     class Meta:
         ordering = ['-date_added']
         indexes = [
             models.Index(fields=['chai_variety', '-date_added']),
             models.Index(fields=['user', '-date_added']),
+            models.Index(fields=['branch', '-date_added']),
+            models.Index(fields=['branch', 'chai_variety', '-date_added']),
+            models.Index(fields=['branch', 'user', '-date_added']),
         ]
 
     def __str__(self):
@@ -92,14 +136,26 @@ class ChaiReview(models.Model):
 
 class Store(models.Model):
     name = models.CharField(max_length=100)
-    chai_varieties = models.ManyToManyField(ChaiVariety, related_name='stores')
+    chai_varieties = models.ManyToManyField(ChaiVariety, related_name='stores', through='StoreInventory')
     store_location = models.CharField(max_length=255)
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True, db_index=False, related_name='stores')
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
+    # Bumped on edits, rating changes and chai list changes; versions the store page
+    updated = models.DateTimeField(auto_now=True)
+    # Rating activity, decayed over time; see chai.trending
+    trending_weight = models.FloatField(default=0)
+    trending_time = models.FloatField(default=0)
+    trending_score = models.FloatField(null=True, blank=True, db_index=True)
+
+    objects = BranchManager()
+    all_branches = models.Manager()
 
     class Meta:
         ordering = ['-date_added']
         indexes = [
             models.Index(fields=['-date_added']),
+            models.Index(fields=['branch', '-date_added']),
+            models.Index(fields=['branch', '-trending_score']),
         ]
 
     def __str__(self):
@@ -115,17 +171,55 @@ class Store(models.Model):
         """Get total number of ratings"""
         return self.ratings.count()
 
+class StoreInventory(models.Model):
+    """A chai listed by a store, with the store's own price and stock"""
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='inventory')
+    chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='inventory')
+    # Store-specific price; falls back to the chai's list price when empty
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # Units on hand as last reported by the store's POS; empty when not tracked
+    stock = models.PositiveIntegerField(null=True, blank=True)
+    is_available = models.BooleanField(default=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'store inventory'
+        unique_together = ('store', 'chai_variety')
+        indexes = [
+            # Availability lookups start from the chais a customer wants
+            models.Index(fields=['chai_variety', 'is_available', 'store']),
+        ]
+
+    def __str__(self):
+        return f"{self.chai_variety.name} at {self.store.name}"
+
+    def get_price(self):
+        """Get the price this store charges"""
+        return self.price if self.price is not None else self.chai_variety.price
+
 class ChaiCertificate(models.Model):
+    STATUS_ACTIVE = 'active'
+    STATUS_EXPIRING = 'expiring'
+    STATUS_EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (STATUS_ACTIVE, 'Active'),
+        (STATUS_EXPIRING, 'Expiring soon'),
+        (STATUS_EXPIRED, 'Expired'),
+    ]
+
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='chai_certificate')
     certificate_number = models.CharField(max_length=20, unique=True, db_index=True)
     date_issued = models.DateTimeField(default=timezone.now, db_index=True)
     chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='certificates')
     valid_until = models.DateTimeField()
+    # Maintained by the sweep_certificates command
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_ACTIVE)
 
     class Meta:
         ordering = ['-date_issued']
         indexes = [
             models.Index(fields=['user', '-date_issued']),
+            models.Index(fields=['valid_until']),
         ]
 
     def __str__(self):
@@ -135,13 +229,20 @@ class Favorite(models.Model):
     """Users can mark chais as favorites"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='favorite_chais')
     chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='favorited_by')
+    # Where the favorite was made; a user favorites a chai once across branches
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True, db_index=False, related_name='favorites')
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
 
+    objects = BranchManager()
+    all_branches = models.Manager()
+
     class Meta:
         unique_together = ('user', 'chai_variety')
         ordering = ['-date_added']
         indexes = [
             models.Index(fields=['user', '-date_added']),
+            models.Index(fields=['branch', '-date_added']),
+            models.Index(fields=['branch', 'chai_variety']),
         ]
 
     def __str__(self):
@@ -153,24 +254,58 @@ class ReviewComment(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     comment_text = models.TextField()
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
-    is_helpful = models.IntegerField(default=0)  # Upvote count
+    # Helpful votes as of the last compaction; newer votes sit in CommentVoteShard
+    is_helpful = models.IntegerField(default=0)
 
     class Meta:
         ordering = ['-date_added']
         indexes = [
             models.Index(fields=['review', '-date_added']),
+            models.Index(fields=['user', '-date_added']),
+            models.Index(fields=['review', '-is_helpful', '-date_added']),
         ]
 
     def __str__(self):
         return f"{self.user.username} commented on {self.review}"
 
+class CommentVote(models.Model):
+    """One user's helpful vote on a comment; the unique pair stops double voting"""
+    comment = models.ForeignKey(ReviewComment, on_delete=models.CASCADE, related_name='votes')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comment_votes')
+    date_added = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('comment', 'user')
+
+    def __str__(self):
+        return f"{self.user.username} found comment {self.comment_id} helpful"
+
+class CommentVoteShard(models.Model):
+    """One of several counter rows per comment, so concurrent voters don't queue on one row"""
+    comment = models.ForeignKey(ReviewComment, on_delete=models.CASCADE, related_name='vote_shards')
+    shard = models.PositiveSmallIntegerField()
+    # Votes not yet compacted into ReviewComment.is_helpful; may go negative after unvotes
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('comment', 'shard')
+
+    def __str__(self):
+        return f"Comment {self.comment_id} shard {self.shard}: {self.count}"
+
 class StoreRating(models.Model):
     """Rate stores based on quality, service, etc."""
     store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='ratings')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Always the store's branch
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True, db_index=False, related_name='store_ratings')
     rating = models.IntegerField(choices=[(i, i) for i in range(1, 6)])
     comment = models.TextField(blank=True)
     date_added = models.DateTimeField(default=timezone.now, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = BranchManager()
+    all_branches = models.Manager()
 
     class Meta:
         unique_together = ('store', 'user')
@@ -178,7 +313,206 @@ class StoreRating(models.Model):
         indexes = [
             models.Index(fields=['store', '-date_added']),
             models.Index(fields=['user', '-date_added']),
+            models.Index(fields=['branch', '-date_added']),
+            models.Index(fields=['branch', 'user', '-date_added']),
         ]
 
     def __str__(self):
         return f"{self.user.username} rated {self.store.name} - {self.rating}"
+
+class Sequence(models.Model):
+    """Named counter handing out blocks of numbers without gaps or collisions"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} at {self.value}"
+
+    @classmethod
+    def allocate(cls, name, count=1):
+        """Reserve ``count`` consecutive numbers and return them as a range.
+
+        The UPDATE takes a write lock on the row, so concurrent callers are
+        serialized and always get disjoint blocks.
+        """
+        from django.db import router, transaction
+        from django.db.models import F
+
+        # Read the new value back from the database that was just written
+        db = router.db_for_write(cls)
+        with transaction.atomic(using=db):
+            cls.objects.using(db).get_or_create(name=name)
+            cls.objects.using(db).filter(name=name).update(value=F('value') + count)
+            end = cls.objects.using(db).values_list('value', flat=True).get(name=name)
+        return range(end - count + 1, end + 1)
+
+class Checkpoint(models.Model):
+    """Resumable position for long-running batch jobs, keyed by job name"""
+    name = models.CharField(max_length=100, unique=True)
+    position = models.JSONField(default=dict)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} checkpoint"
+
+    @classmethod
+    def load(cls, name):
+        """Return the saved position for ``name``, or an empty dict"""
+        return cls.objects.filter(name=name).values_list('position', flat=True).first() or {}
+
+    @classmethod
+    def store(cls, name, position):
+        cls.objects.update_or_create(name=name, defaults={'position': position})
+
+class BackgroundJob(models.Model):
+    """A bulk operation queued from the admin and run outside the request"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    description = models.CharField(max_length=255, blank=True)
+    params = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+    started = models.DateTimeField(null=True, blank=True)
+    # Bumped with every chunk; a running job whose heartbeat stops was lost with its process
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['status', 'created']),
+        ]
+
+    def __str__(self):
+        return f"{self.description or self.kind} ({self.get_status_display()})"
+
+    def get_progress(self):
+        """Get percentage of the selection processed so far"""
+        return round(self.processed * 100 / self.total) if self.total else 0
+
+    def get_throughput(self):
+        """Get items processed per second, or None before the job starts"""
+        if not self.started:
+            return None
+        elapsed = ((self.finished or timezone.now()) - self.started).total_seconds()
+        return round(self.processed / elapsed, 1) if elapsed > 0 else None
+
+class PriceHistory(models.Model):
+    """Append-only log of every price a chai has had"""
+    chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='price_history')
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-changed_at']
+        indexes = [
+            models.Index(fields=['chai_variety', '-changed_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.chai_variety.name} at ₹{self.price} from {self.changed_at:%Y-%m-%d}"
+
+class DailyChaiStats(models.Model):
+    """Per-chai daily review and favorite rollup, maintained by rollup_analytics"""
+    chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='daily_stats')
+    day = models.DateField()
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    favorite_count = models.IntegerField(default=0)
+    # Price in effect at the end of the day
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = ('chai_variety', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.chai_variety.name} on {self.day}"
+
+    def get_average_rating(self):
+        return round(self.rating_sum / self.review_count, 2) if self.review_count else 0
+
+class DailyChaiTypeStats(models.Model):
+    """Per-chai-type daily rollup, built from DailyChaiStats"""
+    chai_type = models.CharField(max_length=2, choices=ChaiVariety.CHAI_TYPE_CHOICE)
+    day = models.DateField()
+    review_count = models.IntegerField(default=0)
+    rating_sum = models.IntegerField(default=0)
+    favorite_count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = ('chai_type', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_chai_type_display()} on {self.day}"
+
+    def get_average_rating(self):
+        return round(self.rating_sum / self.review_count, 2) if self.review_count else 0
+
+class Order(models.Model):
+    """A sale rung up at a store's counter, ingested in batches from its POS"""
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='orders')
+    # The till's own order id, so a batch sent twice isn't counted twice
+    external_id = models.CharField(max_length=64)
+    placed_at = models.DateTimeField(default=timezone.now)
+    total = models.DecimalField(max_digits=12, decimal_places=2)
+    received = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-placed_at']
+        unique_together = ('store', 'external_id')
+        indexes = [
+            models.Index(fields=['store', '-placed_at']),
+        ]
+
+    def __str__(self):
+        return f"Order {self.external_id} at {self.store.name}"
+
+class OrderLine(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='lines')
+    chai_variety = models.ForeignKey(ChaiVariety, on_delete=models.CASCADE, related_name='order_lines')
+    quantity = models.PositiveIntegerField()
+    # Price per cup charged at the counter, checked against the store's price on ingestion
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.chai_variety.name}"
+
+class DailyStoreSales(models.Model):
+    """Per-store daily sales rollup, updated as orders are ingested"""
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='daily_sales')
+    day = models.DateField()
+    order_count = models.IntegerField(default=0)
+    cup_count = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-day']
+        unique_together = ('store', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.store.name} sales on {self.day}"
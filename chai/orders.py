@@ -0,0 +1,284 @@
+"""Batched order ingestion from store POS systems.
+
+Every counter sends its sales in batches. ``ingest_orders`` validates a whole
+batch against per-store price maps held in the cache, so checking prices
+costs one ``get_many`` rather than a lookup per line. It skips orders already
+ingested, using each till's own order id, and writes what is left in a single
+transaction: one ``bulk_create`` for the orders, one for their lines and one
+UPDATE per store and day for the ``DailyStoreSales`` rollup.
+
+A store's price map is ``{chai_id: price}`` over everything it lists, with
+the chai's list price where the store doesn't set its own.
+``invalidate_price_maps`` drops maps when listings or prices change. Other
+processes only see that through a shared cache backend, and otherwise keep an
+old map for up to ORDER_PRICE_MAP_SECONDS.
+"""
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DailyStoreSales, Order, OrderLine, StoreInventory
+
+PRICE_MAP_VERSION_KEY = 'orders:prices:version'
+CENT = Decimal('0.01')
+
+
+def _price_map_version():
+    version = cache.get(PRICE_MAP_VERSION_KEY)
+    if version is None:
+        cache.add(PRICE_MAP_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(PRICE_MAP_VERSION_KEY)
+    return version
+
+
+def _price_map_key(store_id, version):
+    return f"orders:prices:{version}:{store_id}"
+
+
+def price_maps(store_ids):
+    """Map each of ``store_ids`` to ``{chai_id: price}``, building missing maps in one query"""
+    version = _price_map_version()
+    keys = {store_id: _price_map_key(store_id, version) for store_id in store_ids}
+    cached = cache.get_many(keys.values())
+    maps = {store_id: cached[key] for store_id, key in keys.items() if key in cached}
+
+    missing = set(keys) - set(maps)
+    if missing:
+        built = {store_id: {} for store_id in missing}
+        listings = StoreInventory.objects.filter(store__in=missing).values_list(
+            'store_id', 'chai_variety_id', Coalesce('price', 'chai_variety__price'),
+        )
+        for store_id, chai_id, price in listings:
+            # SQLite hands back COALESCE results without the field's decimal places
+            built[store_id][chai_id] = price.quantize(CENT)
+        cache.set_many({keys[store_id]: prices for store_id, prices in built.items()}, settings.ORDER_PRICE_MAP_SECONDS)
+        maps.update(built)
+    return maps
+
+
+def invalidate_price_maps(store_ids=None):
+    """Drop the cached price maps of ``store_ids``, or of every store"""
+    if store_ids is None:
+        # Chai list prices are in every map; a new version orphans them all
+        cache.set(PRICE_MAP_VERSION_KEY, time.time_ns(), None)
+    else:
+        version = _price_map_version()
+        cache.delete_many([_price_map_key(store_id, version) for store_id in store_ids])
+
+
+def _parse_price(value):
+    try:
+        price = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError("'unit_price' must be a decimal")
+    if not price.is_finite() or price < 0 or -price.as_tuple().exponent > 2:
+        raise ValueError("'unit_price' must be non-negative with at most 2 decimal places")
+    return price
+
+
+def _parse_order(data):
+    """Validate one order from a POS batch, returning a dict or raising ValueError"""
+    if not isinstance(data, dict):
+        raise ValueError("Each order must be an object")
+    try:
+        store_id = int(data['store'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Each order needs an integer 'store' id")
+    external_id = data.get('id')
+    if not isinstance(external_id, str) or not 0 < len(external_id) <= 64:
+        raise ValueError("Each order needs an 'id' string of at most 64 characters")
+
+    placed_at = timezone.now()
+    if data.get('placed_at') is not None:
+        try:
+            placed_at = parse_datetime(data['placed_at'])
+        except (TypeError, ValueError):
+            placed_at = None
+        if placed_at is None:
+            raise ValueError("'placed_at' must be an ISO 8601 timestamp")
+        if timezone.is_naive(placed_at):
+            placed_at = timezone.make_aware(placed_at)
+
+    lines = data.get('lines')
+    if not isinstance(lines, list) or not 0 < len(lines) <= settings.ORDER_MAX_LINES:
+        raise ValueError(f"Each order needs between 1 and {settings.ORDER_MAX_LINES} 'lines'")
+    parsed_lines = []
+    for line in lines:
+        if not isinstance(line, dict):
+            raise ValueError("Each line must be an object")
+        try:
+            chai_id = int(line['chai'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each line needs an integer 'chai' id")
+        quantity = line.get('quantity', 1)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            raise ValueError("'quantity' must be a positive integer")
+        if 'unit_price' not in line:
+            raise ValueError("Each line needs a 'unit_price'")
+        parsed_lines.append((chai_id, quantity, _parse_price(line['unit_price'])))
+    return {'store': store_id, 'id': external_id, 'placed_at': placed_at, 'lines': parsed_lines}
+
+
+def _check_prices(order, prices):
+    """Return why ``order`` can't be accepted at ``prices``, or None"""
+    for chai_id, _, unit_price in order['lines']:
+        listed = prices.get(chai_id)
+        if listed is None:
+            return f"Store {order['store']} doesn't sell chai {chai_id}"
+        if unit_price != listed:
+            return f"Chai {chai_id} costs ₹{listed} at store {order['store']}, not ₹{unit_price}"
+    return None
+
+
+def _add_to_daily_sales(orders):
+    """Add ``orders`` (saved Order objects with ``_cups``) to the per-store daily rollup"""
+    totals = defaultdict(lambda: [0, 0, Decimal(0)])
+    for order in orders:
+        row = totals[order.store_id, timezone.localdate(order.placed_at)]
+        row[0] += 1
+        row[1] += order._cups
+        row[2] += order.total
+    # Make sure every row exists, then increment it in place so concurrent batches add up
+    DailyStoreSales.objects.bulk_create(
+        [DailyStoreSales(store_id=store_id, day=day) for store_id, day in totals], ignore_conflicts=True,
+    )
+    for (store_id, day), (order_count, cups, revenue) in totals.items():
+        DailyStoreSales.objects.filter(store_id=store_id, day=day).update(
+            order_count=F('order_count') + order_count,
+            cup_count=F('cup_count') + cups,
+            revenue=F('revenue') + revenue,
+        )
+
+
+def _write_orders(accepted, batch_size):
+    """Insert ``accepted`` orders, skipping ones already stored; returns the created Orders"""
+    keys = {(order['store'], order['id']) for order in accepted}
+    existing = set(
+        Order.objects.filter(
+            store__in={store_id for store_id, _ in keys}, external_id__in={external_id for _, external_id in keys},
+        ).values_list('store_id', 'external_id')
+    )
+
+    now = timezone.now()
+    orders, seen = [], set(existing)
+    for order in accepted:
+        key = (order['store'], order['id'])
+        if key in seen:
+            continue
+        seen.add(key)
+        row = Order(
+            store_id=order['store'],
+            external_id=order['id'],
+            placed_at=order['placed_at'],
+            total=sum(quantity * unit_price for _, quantity, unit_price in order['lines']),
+            received=now,
+        )
+        row._lines = order['lines']
+        row._cups = sum(quantity for _, quantity, _ in order['lines'])
+        orders.append(row)
+
+    with transaction.atomic():
+        # Primary keys come back from the INSERT on PostgreSQL and SQLite 3.35+
+        Order.objects.bulk_create(orders, batch_size=batch_size)
+        OrderLine.objects.bulk_create(
+            [
+                OrderLine(order_id=order.pk, chai_variety_id=chai_id, quantity=quantity, unit_price=unit_price)
+                for order in orders for chai_id, quantity, unit_price in order._lines
+            ],
+            batch_size=batch_size,
+        )
+        _add_to_daily_sales(orders)
+    return orders
+
+
+def ingest_orders(orders, batch_size=1000, store_ids=None):
+    """Validate and store a batch of POS orders.
+
+    Returns ``(created, duplicates, rejected)``: the number of orders stored,
+    the ``(store, id)`` pairs that were already stored, and ``{index:
+    message}`` for orders that were invalid, charged the wrong price or, when
+    ``store_ids`` is given, belong to any other store. Valid orders are stored
+    even when others in the batch are rejected.
+    """
+    parsed, rejected = [], {}
+    for index, data in enumerate(orders):
+        try:
+            order = _parse_order(data)
+            if store_ids is not None and order['store'] not in store_ids:
+                raise ValueError(f"Not allowed to send orders for store {order['store']}")
+            parsed.append((index, order))
+        except ValueError as e:
+            rejected[index] = str(e)
+
+    maps = price_maps({order['store'] for _, order in parsed})
+    accepted = []
+    for index, order in parsed:
+        error = _check_prices(order, maps[order['store']])
+        if error:
+            rejected[index] = error
+        else:
+            accepted.append(order)
+    if not accepted:
+        return 0, [], rejected
+
+    try:
+        created = _write_orders(accepted, batch_size)
+    except IntegrityError:
+        # Another batch stored some of the same orders since we checked; check again
+        created = _write_orders(accepted, batch_size)
+    created_keys = {(order.store_id, order.external_id) for order in created}
+    duplicates = sorted({(order['store'], order['id']) for order in accepted} - created_keys)
+    return len(created), duplicates, rejected
+
+
+def rebuild_daily_sales(first_day=None, last_day=None):
+    """Recompute ``DailyStoreSales`` from the orders, for all days or a range.
+
+    Returns the number of store-day rows written.
+    """
+    orders = Order.objects.all()
+    lines = OrderLine.objects.all()
+    if first_day:
+        start = timezone.make_aware(datetime.combine(first_day, datetime.min.time()))
+        orders = orders.filter(placed_at__gte=start)
+        lines = lines.filter(order__placed_at__gte=start)
+    if last_day:
+        end = timezone.make_aware(datetime.combine(last_day + timedelta(days=1), datetime.min.time()))
+        orders = orders.filter(placed_at__lt=end)
+        lines = lines.filter(order__placed_at__lt=end)
+
+    totals = {
+        (row['store'], row['day']): [row['count'], 0, row['revenue']]
+        for row in orders.annotate(day=TruncDate('placed_at')).values('store', 'day')
+        .annotate(count=Count('pk'), revenue=Sum('total')).order_by()
+    }
+    cups = lines.annotate(day=TruncDate('order__placed_at')).values('order__store', 'day').annotate(
+        cups=Sum('quantity'),
+    ).order_by()
+    for row in cups:
+        totals[row['order__store'], row['day']][1] = row['cups']
+
+    stale = DailyStoreSales.objects.all()
+    if first_day:
+        stale = stale.filter(day__gte=first_day)
+    if last_day:
+        stale = stale.filter(day__lte=last_day)
+    with transaction.atomic():
+        stale.delete()
+        DailyStoreSales.objects.bulk_create(
+            [
+                DailyStoreSales(store_id=store_id, day=day, order_count=count, cup_count=cup_count, revenue=revenue)
+                for (store_id, day), (count, cup_count, revenue) in totals.items()
+            ],
+            batch_size=1000,
+        )
+    return len(totals)
@@ -0,0 +1,157 @@
+"""Pagination helpers for long histories and large tables.
+
+Offset pagination gets slower the deeper you page because the database has to
+walk and throw away every skipped row. These helpers page by the last row seen
+instead, ordered by ``(-date_added, -pk)``, so every page is a bounded range
+read on the ``(user, -date_added)`` style indexes no matter how long the
+history is. ``EstimatedCountPaginator`` covers the other expensive part of
+paging big tables, the COUNT(*).
+"""
+import base64
+import binascii
+import heapq
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+
+TimelineEntry = namedtuple('TimelineEntry', ['kind', 'date_added', 'obj'])
+
+
+def encode_cursor(date_added, rank, pk):
+    """Encode a ``(date_added, rank, pk)`` position as an opaque URL-safe token"""
+    raw = f"{date_added.isoformat()}|{rank}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a cursor token, returning None when it is missing or malformed"""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        date_part, rank, pk = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(date_part), int(rank), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def keyset_filter(queryset, cursor, rank=0):
+    """Restrict a queryset to rows that sort after ``cursor``.
+
+    Rows are ordered by ``(date_added, rank, pk)`` descending, where ``rank``
+    is constant per source. That lets the tie-break across sources collapse
+    into a plain range condition on ``date_added`` for every source except the
+    one the cursor came from.
+    """
+    if cursor is None:
+        return queryset
+    date_added, cursor_rank, pk = cursor
+    if rank < cursor_rank:
+        return queryset.filter(date_added__lte=date_added)
+    if rank > cursor_rank:
+        return queryset.filter(date_added__lt=date_added)
+    return queryset.filter(Q(date_added__lt=date_added) | Q(date_added=date_added, pk__lt=pk))
+
+
+class KeysetPage:
+    """A page of results plus the cursor for the page after it"""
+
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _fetch(queryset, cursor, rank, per_page):
+    queryset = keyset_filter(queryset, cursor, rank).order_by('-date_added', '-pk')
+    return list(queryset[:per_page + 1])
+
+
+def keyset_page(queryset, cursor=None, per_page=20):
+    """Return one page of ``queryset`` ordered newest first"""
+    rows = _fetch(queryset, cursor, 0, per_page)
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.date_added, 0, last.pk)
+    return KeysetPage(rows, next_cursor)
+
+
+def merged_keyset_page(sources, cursor=None, per_page=20):
+    """Return one page of a k-way merge over several querysets.
+
+    ``sources`` is a list of ``(kind, queryset)`` pairs; a source's position in
+    the list is its rank for tie-breaking. Each source contributes at most
+    ``per_page + 1`` rows, so a page costs ``len(sources)`` indexed range reads.
+    """
+    streams = []
+    for rank, (kind, queryset) in enumerate(sources):
+        rows = _fetch(queryset, cursor, rank, per_page)
+        streams.append([(row.date_added, rank, row.pk, kind, row) for row in rows])
+
+    merged = heapq.merge(*streams, key=lambda item: item[:3], reverse=True)
+    items = list(islice(merged, per_page + 1))
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        date_added, rank, pk = items[-1][:3]
+        next_cursor = encode_cursor(date_added, rank, pk)
+    entries = [TimelineEntry(kind, date_added, row) for date_added, _, _, kind, row in items]
+    return KeysetPage(entries, next_cursor)
+
+
+def estimate_row_count(queryset):
+    """Cheaply estimate the number of rows in a queryset's table, or None.
+
+    PostgreSQL keeps a planner estimate in pg_class; on SQLite the largest
+    rowid is an upper bound that costs one index probe. Both avoid the full
+    scan a COUNT(*) needs.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute(f"SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}")
+        else:
+            return None
+        row = cursor.fetchone()
+    # reltuples is -1 for tables that have never been analyzed
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the count of large unfiltered querysets.
+
+    Filtered querysets, and tables estimated to be small, still get an exact
+    COUNT(*).
+    """
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimate_row_count(queryset)
+            if estimate is not None and estimate > self.exact_count_threshold:
+                return estimate
+        return super().count
@@ -0,0 +1,61 @@
+"""Cache-backed token bucket rate limiting and duplicate suppression.
+
+Each bucket is stored as ``(tokens, last_refill)`` in the default cache, so the
+limit is shared by every worker that shares the cache. The read-modify-write
+is not atomic; under a race a client can occasionally get one extra request
+through, which is fine for throttling spam.
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+
+
+class TokenBucket:
+    """Allow bursts of up to ``capacity`` requests, refilled at ``rate`` tokens per second"""
+
+    def __init__(self, name, capacity, rate):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+
+    def _key(self, ident):
+        return f"ratelimit:{self.name}:{ident}"
+
+    def consume(self, ident, tokens=1):
+        """Take tokens from ``ident``'s bucket.
+
+        Returns ``(allowed, retry_after)`` where ``retry_after`` is the number
+        of seconds until enough tokens will be available.
+        """
+        key = self._key(ident)
+        now = time.time()
+        available, last_refill = cache.get(key, (self.capacity, now))
+        available = min(self.capacity, available + (now - last_refill) * self.rate)
+
+        if available >= tokens:
+            allowed, retry_after = True, 0
+            available -= tokens
+        else:
+            allowed = False
+            retry_after = (tokens - available) / self.rate
+
+        # Keep the bucket around only as long as it takes to refill completely
+        timeout = max(1, int((self.capacity - available) / self.rate) + 1)
+        cache.set(key, (available, now), timeout)
+        return allowed, retry_after
+
+    def reset(self, ident):
+        cache.delete(self._key(ident))
+
+
+def claim_fingerprint(namespace, content, timeout):
+    """Claim a content hash for ``timeout`` seconds.
+
+    Returns ``(claimed, key)``. ``claimed`` is False if the same content was
+    already claimed in that window, which is how double submits and copy-paste
+    spam are suppressed without a query. Delete ``key`` to release the claim.
+    """
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    key = f"fingerprint:{namespace}:{digest}"
+    return cache.add(key, True, timeout), key
@@ -0,0 +1,53 @@
+"""Certificate image rendering.
+
+Kept free of Django imports so the functions can run in worker processes
+without setting Django up; callers pass plain dicts from
+``chai.certificates.certificate_context``.
+"""
+import io
+import os
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+@lru_cache(maxsize=None)
+def _font(size):
+    return ImageFont.load_default(size=size)
+
+
+def render_certificate(data, fmt='png'):
+    """Render a certificate as PNG or PDF bytes"""
+    image = Image.new('RGB', (1600, 1100), (255, 247, 237))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((40, 40, 1560, 1060), outline=(249, 115, 22), width=12)
+
+    def centered(y, text, size, fill=(31, 41, 55)):
+        font = _font(size)
+        width = draw.textlength(text, font=font)
+        draw.text(((1600 - width) / 2, y), text, font=font, fill=fill)
+
+    centered(150, "Chai Aur Django", 56, fill=(220, 38, 38))
+    centered(280, "Certificate of Chai Excellence", 72)
+    centered(440, "This certifies that", 40)
+    centered(520, data['holder'], 80, fill=(249, 115, 22))
+    centered(660, f"has mastered {data['chai']}", 48)
+    centered(800, f"Issued {data['issued']}  -  Valid until {data['valid_until']}", 36)
+    centered(900, data['number'], 40, fill=(75, 85, 99))
+
+    buffer = io.BytesIO()
+    if fmt == 'pdf':
+        image.save(buffer, 'PDF', resolution=150.0)
+    else:
+        # Flat colours compress well even at a low zlib level, and it is much faster
+        image.save(buffer, 'PNG', compress_level=3)
+    return buffer.getvalue()
+
+
+def render_certificate_file(job):
+    """Render one certificate to disk; ``job`` is ``(data, fmt, output_dir)``"""
+    data, fmt, output_dir = job
+    path = os.path.join(output_dir, f"{data['number']}.{fmt}")
+    with open(path, 'wb') as handle:
+        handle.write(render_certificate(data, fmt))
+    return path
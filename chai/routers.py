@@ -0,0 +1,90 @@
+"""Primary/replica database routing with read-your-writes stickiness.
+
+Writes always go to ``default``. Reads go to a random replica: any alias in
+``settings.DATABASES`` whose ``TEST['MIRROR']`` is ``default``. Replicas lag
+behind the primary, so a visitor who just posted a review or a favorite would
+not see it on the next page. ``ReplicaStickinessMiddleware`` therefore pins
+every unsafe request to the primary and sets a short-lived cookie that keeps
+that browser's reads on the primary for READ_YOUR_WRITES_SECONDS afterwards.
+
+Code outside a request that reads its own writes, such as background jobs,
+wraps itself in ``use_primary()``.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PRIMARY_COOKIE = 'pin_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+_pinned = ContextVar('pinned_to_primary', default=False)
+
+
+def replica_aliases():
+    """Return the database aliases configured as replicas of the primary"""
+    return [
+        alias for alias, config in settings.DATABASES.items()
+        if config.get('TEST', {}).get('MIRROR') == DEFAULT_DB_ALIAS
+    ]
+
+
+@contextmanager
+def use_primary():
+    """Send every read inside the block to the primary"""
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """Route reads to replicas and everything else to the primary"""
+
+    def __init__(self, replicas=None):
+        self.replicas = replicas if replicas is not None else replica_aliases()
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations from the database the instance was loaded from
+            return instance._state.db
+        if _pinned.get() or not self.replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaStickinessMiddleware:
+    """Pin writes, and reads shortly after a browser's last write, to the primary"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        writing = request.method not in SAFE_METHODS
+        token = _pinned.set(writing or PRIMARY_COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            _pinned.reset(token)
+        if writing:
+            response.set_cookie(
+                PRIMARY_COOKIE, '1',
+                max_age=settings.READ_YOUR_WRITES_SECONDS,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
@@ -0,0 +1,228 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .aggregates import review_aggregates
+from .auth import user_cache_key
+from .branches import branch_aliases, copy_shared_rows, current_branch, delete_shared_rows, forget_branches
+from .certificates import invalidate_certificate_filter
+from .homepage import mark_stale
+from .orders import invalidate_price_maps
+from .trending import FAVORITE_WEIGHT, REVIEW_WEIGHT, STORE_RATING_WEIGHT, trending_events
+from .models import (
+    Branch, ChaiCertificate, ChaiReview, ChaiVariety, Favorite, PriceHistory, Store, StoreInventory, StoreRating,
+)
+
+
+@receiver(pre_save, sender=ChaiReview)
+def remember_review_rating(sender, instance, raw=False, **kwargs):
+    """Stash the stored rating so an edit can be applied as a delta"""
+    instance._stored_rating = None
+    if instance.pk and not raw:
+        instance._stored_rating = (
+            ChaiReview.objects.filter(pk=instance.pk).values_list('chai_variety_id', 'rating').first()
+        )
+
+
+@receiver(post_save, sender=ChaiReview)
+def buffer_review_saved(sender, instance, created, raw=False, **kwargs):
+    """Queue counter deltas for a new or edited review once the write commits"""
+    if raw:
+        return
+    deltas = []
+    if created:
+        deltas.append((instance.chai_variety_id, 1, instance.rating))
+    elif getattr(instance, '_stored_rating', None):
+        chai_id, rating = instance._stored_rating
+        if (chai_id, rating) != (instance.chai_variety_id, instance.rating):
+            deltas.append((chai_id, -1, -rating))
+            deltas.append((instance.chai_variety_id, 1, instance.rating))
+    for delta in deltas:
+        transaction.on_commit(lambda delta=delta: review_aggregates.add(*delta))
+
+
+@receiver(post_delete, sender=ChaiReview)
+def buffer_review_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: review_aggregates.add(instance.chai_variety_id, -1, -instance.rating))
+
+
+@receiver(post_save, sender=ChaiReview)
+def score_review_saved(sender, instance, created, raw=False, **kwargs):
+    """A new review adds to its chai's trending score; moving it to another chai moves the score"""
+    if raw:
+        return
+    if created:
+        _buffer_event(ChaiVariety, instance.chai_variety_id, REVIEW_WEIGHT, instance.date_added)
+    elif getattr(instance, '_stored_rating', None) and instance._stored_rating[0] != instance.chai_variety_id:
+        _buffer_event(ChaiVariety, instance._stored_rating[0], -REVIEW_WEIGHT, instance.date_added)
+        _buffer_event(ChaiVariety, instance.chai_variety_id, REVIEW_WEIGHT, instance.date_added)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=StoreRating)
+def score_event_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        _score_event(sender, instance, 1)
+
+
+@receiver(post_delete, sender=ChaiReview)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=StoreRating)
+def score_event_deleted(sender, instance, **kwargs):
+    """Take back exactly what the event added"""
+    _score_event(sender, instance, -1)
+
+
+def _score_event(sender, instance, sign):
+    if sender is StoreRating:
+        # The store lives in the rating's database, which may be its branch's own
+        _buffer_event(Store, instance.store_id, sign * STORE_RATING_WEIGHT, instance.date_added, instance._state.db)
+    else:
+        weight = REVIEW_WEIGHT if sender is ChaiReview else FAVORITE_WEIGHT
+        _buffer_event(ChaiVariety, instance.chai_variety_id, sign * weight, instance.date_added)
+
+
+def _buffer_event(model, pk, weight, when, using=None):
+    """Trending scores are written behind, once the event's write has committed"""
+    transaction.on_commit(lambda: trending_events.add(model, pk, weight, when, using))
+
+
+@receiver(pre_save, sender=ChaiVariety)
+def remember_chai_price(sender, instance, raw=False, **kwargs):
+    """Stash the stored price so a change can be recorded after the save"""
+    instance._stored_price = None
+    if instance.pk and not raw:
+        instance._stored_price = ChaiVariety.objects.filter(pk=instance.pk).values_list('price', flat=True).first()
+
+
+@receiver(post_save, sender=ChaiVariety)
+def record_price_change(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created or getattr(instance, '_stored_price', None) != instance.price:
+        PriceHistory.objects.create(chai_variety=instance, price=instance.price)
+        instance._stored_price = instance.price
+        invalidate_price_maps()
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def bump_favorited_chai(sender, instance, **kwargs):
+    """Favorite counts are part of the cached chai card, so bump its version"""
+    ChaiVariety.objects.filter(pk=instance.chai_variety_id).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=StoreRating)
+@receiver(post_delete, sender=StoreRating)
+@receiver(post_save, sender=StoreInventory)
+@receiver(post_delete, sender=StoreInventory)
+def bump_store(sender, instance, **kwargs):
+    """Ratings and inventory both show on the store page, so bump its version"""
+    Store.objects.filter(pk=instance.store_id).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=StoreInventory)
+@receiver(post_delete, sender=StoreInventory)
+def drop_store_price_map(sender, instance, **kwargs):
+    """Order ingestion checks prices against a cached map of what the store lists"""
+    invalidate_price_maps([instance.store_id])
+
+
+@receiver(post_save, sender=ChaiVariety)
+@receiver(post_delete, sender=ChaiVariety)
+@receiver(post_save, sender=Store)
+@receiver(post_delete, sender=Store)
+@receiver(post_save, sender=StoreRating)
+@receiver(post_delete, sender=StoreRating)
+@receiver(post_save, sender=ChaiReview)
+@receiver(post_delete, sender=ChaiReview)
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def mark_homepage_stale(sender, instance, raw=False, **kwargs):
+    """The homepage snapshot shows these; serve it stale and rebuild it in the background"""
+    if not raw:
+        transaction.on_commit(mark_stale)
+
+
+@receiver(m2m_changed, sender=Store.chai_varieties.through)
+def bump_store_chai_list(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Changed from the chai side: instance is a ChaiVariety
+        stores = Store.objects.filter(pk__in=pk_set) if pk_set else instance.stores.all()
+    else:
+        stores = Store.objects.filter(pk=instance.pk)
+    stores.update(updated=timezone.now())
+
+
+@receiver(pre_save, sender=ChaiCertificate)
+def reactivate_renewed_certificate(sender, instance, **kwargs):
+    """A certificate pushed back into validity is active again until the next sweep"""
+    if instance.status != ChaiCertificate.STATUS_ACTIVE and instance.valid_until > timezone.now():
+        instance.status = ChaiCertificate.STATUS_ACTIVE
+
+
+@receiver(post_save, sender=ChaiCertificate)
+def refresh_certificate_filter(sender, instance, created, **kwargs):
+    # Only new numbers are missing from the filter; sweeps and renewals don't
+    # change any. Deleted numbers may stay: a false positive only costs a lookup
+    if created:
+        invalidate_certificate_filter()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    """Sessions load the user from the cache; make the next request read the new row"""
+    transaction.on_commit(lambda: cache.delete(user_cache_key(instance.pk)))
+
+
+@receiver(pre_save, sender=Store)
+@receiver(pre_save, sender=StoreRating)
+@receiver(pre_save, sender=ChaiReview)
+@receiver(pre_save, sender=Favorite)
+def assign_branch(sender, instance, raw=False, **kwargs):
+    """New rows belong to the active branch; store ratings to their store's branch"""
+    if raw or instance.branch_id is not None:
+        return
+    if sender is StoreRating:
+        instance.branch_id = instance.store.branch_id
+    else:
+        branch = current_branch()
+        instance.branch_id = branch.pk if branch else None
+
+
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def drop_cached_branches(sender, instance, **kwargs):
+    transaction.on_commit(forget_branches)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Branch)
+@receiver(post_save, sender=ChaiVariety)
+def copy_shared_row(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Branch databases hold copies of the rows their stores, ratings and reviews point at"""
+    # Every sign-in saves last_login, which no branch database needs
+    if raw or not branch_aliases() or update_fields == frozenset(['last_login']):
+        return
+    transaction.on_commit(lambda: copy_shared_rows(sender, [instance]))
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Branch)
+@receiver(post_delete, sender=ChaiVariety)
+def delete_shared_row(sender, instance, **kwargs):
+    if branch_aliases():
+        transaction.on_commit(lambda: delete_shared_rows(sender, [instance.pk]))
+
+
+@receiver(request_finished)
+def flush_review_aggregates(sender, **kwargs):
+    review_aggregates.flush_if_due()
+    trending_events.flush_if_due()
@@ -0,0 +1,132 @@
+"""Fingerprinted, precompressed static files.
+
+``CompressedManifestStaticFilesStorage`` is Django's manifest storage (file
+names carry a hash of their content, so they can be cached forever) that also
+writes ``.gz`` and, when the ``brotli`` package is installed, ``.br`` copies
+of every compressible file at ``collectstatic`` time. Compression then costs
+nothing per request, and can use the slowest, smallest settings.
+
+``serve`` hands out those files when Django serves static itself
+(SERVE_STATIC), choosing the smallest variant the client's Accept-Encoding
+allows. Hashed names get a one-year immutable Cache-Control. A front-end
+server can do the same from STATIC_ROOT (nginx ``gzip_static on`` /
+``brotli_static on``).
+"""
+import functools
+import gzip
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.svg', '.html', '.txt', '.json', '.xml', '.ico')
+MIN_COMPRESS_BYTES = 256
+# Precompressed variants in order of preference, as (Content-Encoding, suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest storage that also writes gzip and brotli variants of each hashed file"""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if not dry_run:
+            self.compress_files(set(self.hashed_files.values()))
+
+    def compress_files(self, names):
+        """Write compressed variants of ``names`` where they are smaller; returns the number written"""
+        written = 0
+        compressors = list(_compressors())
+        for name in names:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = self.path(name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < MIN_COMPRESS_BYTES:
+                continue
+            for suffix, compress in compressors:
+                compressed = compress(data)
+                if len(compressed) < len(data) * 0.95:
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+                elif os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        return written
+
+
+def accepted_encodings(header):
+    """Content codings the client accepts, from an Accept-Encoding header"""
+    accepted = set()
+    for part in header.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding)
+    return accepted
+
+
+@functools.cache
+def _hashed_names():
+    # The manifest is read once, when the storage is first used
+    return frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+
+@require_safe
+def serve(request, path):
+    """Serve a collected static file, precompressed if the client accepts it"""
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except ValueError:
+        raise Http404("Not a static file")
+    if not os.path.isfile(full_path):
+        raise Http404("Not a static file")
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    encoding, variant = None, full_path
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    for coding, suffix in ENCODINGS:
+        if coding in accepted and os.path.isfile(full_path + suffix):
+            encoding, variant = coding, full_path + suffix
+            break
+
+    mtime = os.stat(full_path).st_mtime
+    if not was_modified_since(request.headers.get('If-Modified-Since'), mtime):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(variant, 'rb'), content_type=content_type or 'application/octet-stream')
+        response['Last-Modified'] = http_date(mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if path in _hashed_names():
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.STATIC_MAX_AGE_SECONDS)
+    return response
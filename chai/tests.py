@@ -1,3 +1,1753 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import logging
+from contextlib import contextmanager
+from io import StringIO
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.admin import helpers
+from django.contrib.auth.models import Permission, User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import DatabaseError, connection, connections
+from django.http import HttpResponse
+from django.template import engines
+from django.template.loaders import cached, filesystem
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .branches import BranchRouter, branches_by_slug, use_branch
+from .certificates import (
+    CROCKFORD, FILTER_VERSION_CACHE_KEY, FILTER_VERSION_SEQUENCE, certificate_filter_version, format_number,
+    issue_certificates, normalize_number, permute, sweep_certificates, verify_certificate,
+)
+from .homepage import get_snapshot, mark_stale
+from .inventory import find_stores
+from .analytics import chai_type_daily_stats, price_change_impact, rollup
+from .aggregates import AggregateBuffer, recount_review_aggregates, review_aggregates
+from .log import JsonFormatter, QueueListenerHandler, RequestContextFilter, SampleFilter
+from .jobs import JOB_HANDLERS, requeue_stale_jobs, run_job
+from .models import (
+    ChaiVariety, ChaiReview, Store, StoreInventory, ChaiCertificate, Favorite, ReviewComment, StoreRating,
+    DailyStoreSales, Order, OrderLine, CommentVoteShard, Branch, BackgroundJob, Checkpoint, DailyChaiStats,
+    PriceHistory, Sequence,
+)
+from .orders import ingest_orders, rebuild_daily_sales
+from .pagination import decode_cursor, keyset_page, merged_keyset_page
+from .ratelimit import TokenBucket, claim_fingerprint
+from .staticfiles import _hashed_names, accepted_encodings, serve
+from .routers import PRIMARY_COOKIE, PrimaryReplicaRouter, ReplicaStickinessMiddleware, use_primary
+from .trending import (
+    FAVORITE_WEIGHT, REVIEW_WEIGHT, STORE_RATING_WEIGHT, current_score, rebuild_scores, trending, trending_events,
+)
+from .votes import comments_for_review, compact_votes, helpful_counts, unvote, vote
+
+
+# Test data only exists in the primary's open transaction, so keep reads off
+# replicas when DATABASE_REPLICAS is set
+@override_settings(DATABASE_ROUTERS=[])
+class AdminQueryCountTests(TestCase):
+    """Admin pages should cost the same number of queries however many rows they show"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        # bulk_create skips ChaiVariety.save() and its image processing
+        cls.chai = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name='Masala', image='chais/medium_masala.jpeg', chai_type='ML', description='Spiced', price=50),
+        ])[0]
+        cls.store = Store.objects.create(name='Corner', store_location='Pune')
+
+    def setUp(self):
+        # Signed-in users are cached by pk, and test databases reuse pks
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def add_rows(self, count):
+        start = User.objects.count()
+        users = User.objects.bulk_create(User(username=f"user{start + i}") for i in range(count))
+        reviews = ChaiReview.objects.bulk_create(
+            ChaiReview(user=user, chai_variety=self.chai, rating=4, review_text='Nice') for user in users
+        )
+        ReviewComment.objects.bulk_create(
+            ReviewComment(review=review, user=review.user, comment_text='Agreed') for review in reviews
+        )
+        Favorite.objects.bulk_create(Favorite(user=user, chai_variety=self.chai) for user in users)
+        StoreRating.objects.bulk_create(StoreRating(store=self.store, user=user, rating=5) for user in users)
+        ChaiCertificate.objects.bulk_create(
+            ChaiCertificate(user=user, chai_variety=self.chai, certificate_number=f"CERT-{user.pk}", valid_until='2030-01-01T00:00:00Z')
+            for user in users
+        )
+
+    def count_queries(self, url):
+        # The first request also pays for one-off lookups such as content types
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url):
+        self.add_rows(2)
+        few = self.count_queries(url)
+        self.add_rows(20)
+        many = self.count_queries(url)
+        self.assertEqual(few, many)
+
+    def test_review_changelist(self):
+        self.assertConstantQueries(reverse('admin:chai_chaireview_changelist'))
+
+    def test_review_comment_changelist(self):
+        self.assertConstantQueries(reverse('admin:chai_reviewcomment_changelist'))
+
+    def test_favorite_changelist(self):
+        self.assertConstantQueries(reverse('admin:chai_favorite_changelist'))
+
+    def test_store_rating_changelist(self):
+        self.assertConstantQueries(reverse('admin:chai_storerating_changelist'))
+
+    def test_certificate_changelist(self):
+        self.assertConstantQueries(reverse('admin:chai_chaicertificate_changelist'))
+
+    def test_chai_change_page(self):
+        # Each inline row's raw-id widget looks up its label, so the cost is
+        # bounded by the inline page size rather than by the number of reviews
+        url = reverse('admin:chai_chaivariety_change', args=[self.chai.pk])
+        self.add_rows(25)
+        few = self.count_queries(url)
+        self.add_rows(200)
+        many = self.count_queries(url)
+        self.assertEqual(few, many)
+
+    def test_chai_change_page_pages_reviews(self):
+        self.add_rows(45)
+        url = reverse('admin:chai_chaivariety_change', args=[self.chai.pk])
+        response = self.client.get(url)
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual(formset.total_count, 45)
+        self.assertEqual(formset.page_count, 3)
+        self.assertEqual(len(formset.get_queryset()), 20)
+
+        response = self.client.get(url, {'chaireview_page': 3})
+        formset = response.context['inline_admin_formsets'][0].formset
+        self.assertEqual(len(formset.get_queryset()), 5)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class KeysetPaginationTests(TestCase):
+    """Keyset pages, merged or not, list every row exactly once and in order, even with tied timestamps"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, other = User.objects.create_user('paginator', password='pw'), User.objects.create_user('other')
+        chais = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=f"Chai {i}", image='chais/medium_masala.jpeg', chai_type='ML', price=40) for i in range(6)
+        ])
+        stores = [Store.objects.create(name=f"Stall {i}", store_location='Pune') for i in range(3)]
+        tie = timezone.now() - timedelta(days=1)
+        hour = timedelta(hours=1)
+        reviews = ChaiReview.objects.bulk_create(
+            [ChaiReview(user=cls.user, chai_variety=chai, review_text="Tied", rating=4, date_added=tie) for chai in chais[:4]]
+            + [
+                ChaiReview(user=cls.user, chai_variety=chais[4], review_text="Newer", rating=4, date_added=tie + hour),
+                ChaiReview(user=cls.user, chai_variety=chais[5], review_text="Older", rating=4, date_added=tie - hour),
+                ChaiReview(user=other, chai_variety=chais[0], review_text="Not mine", rating=4, date_added=tie),
+            ]
+        )
+        Favorite.objects.bulk_create(
+            [Favorite(user=cls.user, chai_variety=chai, date_added=tie) for chai in chais[:3]]
+            + [Favorite(user=cls.user, chai_variety=chais[3], date_added=tie - 2 * hour)]
+        )
+        StoreRating.objects.bulk_create([StoreRating(user=cls.user, store=store, rating=5, date_added=tie) for store in stores[:2]])
+        ReviewComment.objects.bulk_create([
+            ReviewComment(review=reviews[-1], user=cls.user, comment_text=f"Comment {i}", date_added=tie) for i in range(3)
+        ])
+        cls.kinds = ['review', 'favorite', 'store_rating', 'comment']
+        models = [ChaiReview, Favorite, StoreRating, ReviewComment]
+        # Newest first; ties go to the later source, then the higher id
+        cls.timeline = sorted(
+            (
+                (date_added, rank, pk)
+                for rank, model in enumerate(models)
+                for pk, date_added in model.objects.filter(user=cls.user).values_list('pk', 'date_added')
+            ),
+            reverse=True,
+        )
+
+    def sources(self):
+        return [
+            ('review', ChaiReview.objects.filter(user=self.user)),
+            ('favorite', Favorite.objects.filter(user=self.user)),
+            ('store_rating', StoreRating.objects.filter(user=self.user)),
+            ('comment', ReviewComment.objects.filter(user=self.user)),
+        ]
+
+    def test_merged_pages_list_each_row_once_in_order(self):
+        expected = [(self.kinds[rank], pk) for _, rank, pk in self.timeline]
+        self.assertEqual(len(expected), 15)
+        for per_page in (1, 2, 4, 7, 15, 20):
+            seen, cursor = [], None
+            while True:
+                with self.assertNumQueries(4):
+                    page = merged_keyset_page(self.sources(), decode_cursor(cursor), per_page)
+                seen.extend((entry.kind, entry.obj.pk) for entry in page)
+                cursor = page.next_cursor
+                if not cursor:
+                    break
+            self.assertEqual(seen, expected, f"per_page={per_page}")
+
+    def test_single_source_pages_with_ties(self):
+        reviews = ChaiReview.objects.filter(user=self.user)
+        expected = [pk for _, rank, pk in self.timeline if rank == 0]
+        for per_page in (1, 2, 3):
+            seen, cursor = [], None
+            while True:
+                page = keyset_page(reviews, decode_cursor(cursor), per_page)
+                seen.extend(review.pk for review in page)
+                cursor = page.next_cursor
+                if not cursor:
+                    break
+            self.assertEqual(seen, expected, f"per_page={per_page}")
+
+    def test_activity_view_follows_cursors(self):
+        cache.clear()
+        self.client.login(username='paginator', password='pw')
+        seen, params = [], {}
+        with mock.patch('chai.views.HISTORY_PAGE_SIZE', 4):
+            while True:
+                response = self.client.get(reverse('user_activity'), params)
+                self.assertEqual(response.status_code, 200)
+                page = response.context['page']
+                seen.extend((entry.kind, entry.obj.pk) for entry in page)
+                if not page.has_next:
+                    break
+                params = {'cursor': page.next_cursor}
+        self.assertEqual(seen, [(self.kinds[rank], pk) for _, rank, pk in self.timeline])
+        self.assertIsNone(decode_cursor('not a cursor'))
+
+
+class AdminActionPermissionTests(TestCase):
+    """Bulk actions are only offered to, and only run for, staff holding the model permission"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('viewer', password='pw', is_staff=True)
+        cls.staff.user_permissions.add(*Permission.objects.filter(codename__in=['view_chaireview', 'view_chaivariety']))
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name='Masala', image='chais/medium_masala.jpeg', chai_type='ML', price=50),
+        ])
+        cls.review = ChaiReview.objects.create(user=cls.staff, chai_variety=cls.chai, rating=4, review_text='Nice')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.staff)
+
+    def post_action(self, model, action, pk):
+        url = reverse(f"admin:chai_{model}_changelist")
+        self.client.post(url, {'action': action, helpers.ACTION_CHECKBOX_NAME: [pk], 'apply': '1', 'confirm': True})
+        action_form = self.client.get(url).context['action_form']
+        return [name for name, _ in action_form.fields['action'].choices] if action_form else []
+
+    def test_view_only_staff_cannot_queue_jobs(self):
+        offered = self.post_action('chaireview', 'delete_reviews_by_authors', self.review.pk)
+        self.assertNotIn('delete_reviews_by_authors', offered)
+        offered = self.post_action('chaivariety', 'reprocess_images', self.chai.pk)
+        self.assertNotIn('reprocess_images', offered)
+        self.assertFalse(BackgroundJob.objects.exists())
+
+        self.staff.user_permissions.add(Permission.objects.get(codename='delete_chaireview'))
+        offered = self.post_action('chaireview', 'delete_reviews_by_authors', self.review.pk)
+        self.assertIn('delete_reviews_by_authors', offered)
+        self.assertEqual(BackgroundJob.objects.get().kind, 'delete_reviews')
+
+
+@override_settings(DATABASE_ROUTERS=[], BACKGROUND_JOB_CHUNK_SIZE=1)
+class BackgroundJobRecoveryTests(TestCase):
+    """Jobs whose worker died are requeued and resume after their last committed chunk"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.chais = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=f"Chai {i}", image='chais/medium_masala.jpeg', chai_type='ML', price=100)
+            for i in range(3)
+        ])
+
+    def test_stale_running_job_is_requeued_and_resumed(self):
+        ids = [chai.pk for chai in self.chais]
+        # A worker repriced the first chunk, then its process was killed
+        ChaiVariety.objects.filter(pk=ids[0]).update(price=110)
+        long_ago = timezone.now() - timedelta(hours=1)
+        job = BackgroundJob.objects.create(
+            kind='reprice', params={'ids': ids, 'mode': 'percent', 'value': '10'}, total=3, processed=1,
+            status=BackgroundJob.STATUS_RUNNING, started=long_ago, heartbeat=long_ago,
+        )
+        busy = BackgroundJob.objects.create(
+            kind='reprice', params={'ids': [], 'mode': 'set', 'value': '1'},
+            status=BackgroundJob.STATUS_RUNNING, started=timezone.now(), heartbeat=timezone.now(),
+        )
+        self.assertFalse(run_job(job.pk))
+
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertTrue(run_job(job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (BackgroundJob.STATUS_DONE, 3))
+        self.assertEqual(list(ChaiVariety.objects.order_by('pk').values_list('price', flat=True)), [110, 110, 110])
+        busy.refresh_from_db()
+        self.assertEqual(busy.status, BackgroundJob.STATUS_RUNNING)
+
+    def test_requeued_worker_stops_without_finishing(self):
+        job = BackgroundJob.objects.create(kind='test', params={'ids': [1, 2]}, total=2)
+        carried_on = []
+
+        def handler(params, progress):
+            # Another process requeues and claims the job meanwhile
+            BackgroundJob.objects.filter(pk=job.pk).update(started=timezone.now())
+            progress(1)
+            carried_on.append(True)
+
+        with mock.patch.dict(JOB_HANDLERS, {'test': handler}):
+            self.assertTrue(run_job(job.pk))
+        self.assertFalse(carried_on)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (BackgroundJob.STATUS_RUNNING, 0))
+
+
+class CertificateNumberTests(SimpleTestCase):
+    """Certificate numbers are unique, check-summed and tolerant of Crockford misreadings"""
+
+    def test_permute_is_one_to_one(self):
+        values = [*range(20000), *range(2 ** 40 - 1000, 2 ** 40)]
+        permuted = {permute(value) for value in values}
+        self.assertEqual(len(permuted), len(values))
+        self.assertTrue(all(0 <= value < 2 ** 40 for value in permuted))
+        self.assertNotEqual([permute(value) for value in range(1, 4)], [1, 2, 3])
+
+    def test_checksum_rejects_single_character_typos(self):
+        number = format_number(permute(12345))
+        self.assertEqual(normalize_number(number), number)
+        accepted = []
+        for i, char in enumerate(number):
+            if char == '-' or i < 5:
+                continue
+            for typo in CROCKFORD:
+                mistyped = number[:i] + typo + number[i + 1:]
+                if typo != char and normalize_number(mistyped):
+                    accepted.append((char, typo))
+        # A mod-31 check can't tell digits 31 apart, which in base 32 is only 0 and Z
+        self.assertTrue(all({char, typo} == {'0', 'Z'} for char, typo in accepted))
+
+    def test_normalize_number(self):
+        number = next(
+            number for number in map(format_number, map(permute, range(1000))) if {'0', '1'} <= set(number[5:-2])
+        )
+        self.assertEqual(normalize_number(f"  {number.lower()} "), number)
+        misread = number[:5] + number[5:-2].replace('0', 'O').replace('1', 'l') + number[-2:]
+        self.assertEqual(normalize_number(misread), number)
+        for malformed in ('', 'CHAI-1234-5678', number.replace('CHAI', 'CHAO'), number[:5] + 'U' + number[6:],
+                          number + '0', number.replace('-', '')):
+            self.assertIsNone(normalize_number(malformed), malformed)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class CertificateVerificationTests(TestCase):
+    """The Bloom filter rejects unknown numbers without a lookup and never misses issued ones"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"holder{i}", password='pw') for i in range(3)]
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_issued_numbers_verify_everywhere(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            [first] = issue_certificates(self.users[:1], self.chai, valid_days=30)
+        self.assertEqual(verify_certificate(first.certificate_number), first)
+        unknown = format_number(permute(10 ** 9))
+        with self.assertNumQueries(0):
+            self.assertIsNone(verify_certificate(unknown))
+
+        # Issuance in another process with its own cache: this one keeps its
+        # cached version until that expires, then reads the new one
+        later = issue_certificates(self.users[1:], self.chai, valid_days=30)
+        self.assertIsNone(verify_certificate(later[0].certificate_number))
+        cache.delete(FILTER_VERSION_CACHE_KEY)
+        for certificate in later:
+            self.assertEqual(verify_certificate(certificate.certificate_number), certificate)
+
+    def test_only_new_certificates_bump_the_version(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            [certificate] = issue_certificates(self.users[:1], self.chai, valid_days=30)
+        version = certificate_filter_version()
+        certificate.valid_until += timedelta(days=365)
+        certificate.save()
+        self.assertEqual(Sequence.objects.get(name=FILTER_VERSION_SEQUENCE).value, version)
+        with self.captureOnCommitCallbacks(execute=True):
+            added = ChaiCertificate.objects.create(
+                user=self.users[1], chai_variety=self.chai, certificate_number=format_number(permute(7)),
+                valid_until=timezone.now() + timedelta(days=30),
+            )
+        self.assertEqual(certificate_filter_version(), version + 1)
+        self.assertEqual(verify_certificate(added.certificate_number), added)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class CertificateSweepTests(TestCase):
+    """The sweep marks expired and expiring certificates, including ones that land behind earlier runs"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"holder{i}", password='pw') for i in range(6)]
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+        now = timezone.now()
+        cls.certificates = ChaiCertificate.objects.bulk_create([
+            ChaiCertificate(user=user, chai_variety=cls.chai, certificate_number=f"CERT-{i}", valid_until=now + offset)
+            for i, (user, offset) in enumerate(zip(cls.users, [
+                timedelta(days=-3), timedelta(days=-1), timedelta(days=20), timedelta(days=25), timedelta(days=90),
+            ]))
+        ])
+
+    def statuses(self):
+        return list(ChaiCertificate.objects.order_by('valid_until').values_list('status', flat=True))
+
+    def test_sweep_and_late_arrivals(self):
+        self.assertEqual(sweep_certificates(), {'expired': 2, 'expiring': 2})
+        self.assertEqual(self.statuses(), ['expired', 'expired', 'expiring', 'expiring', 'active'])
+        self.assertEqual(sweep_certificates(), {'expired': 0, 'expiring': 0})
+
+        # Issued after the last run, yet expiring before certificates it already marked
+        [short] = issue_certificates(self.users[5:], self.chai, valid_days=10)
+        # Renewed into the window again, which makes it active until the next sweep
+        renewed = ChaiCertificate.objects.get(pk=self.certificates[2].pk)
+        renewed.valid_until = timezone.now() + timedelta(days=5)
+        renewed.save()
+        self.assertEqual(renewed.status, ChaiCertificate.STATUS_ACTIVE)
+        self.assertEqual(sweep_certificates(), {'expired': 0, 'expiring': 2})
+        short.refresh_from_db()
+        renewed.refresh_from_db()
+        self.assertEqual((short.status, renewed.status), ('expiring', 'expiring'))
+
+    def test_interrupted_expired_pass_resumes(self):
+        def crash_after_first_chunk(processed):
+            raise RuntimeError("killed")
+
+        with self.assertRaises(RuntimeError):
+            sweep_certificates(batch_size=1, progress=crash_after_first_chunk)
+        self.assertEqual(self.statuses()[:2], ['expired', 'active'])
+        self.assertEqual(sweep_certificates(batch_size=1), {'expired': 1, 'expiring': 2})
+
+
+@override_settings(REVIEW_RATE_LIMIT_BURST=2, REVIEW_RATE_LIMIT_SECONDS=30)
+class ReviewSubmissionTests(TestCase):
+    """Reviews are throttled per user, deduped by content and counted behind the write"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reviewer', password='pw')
+        cls.chai = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])[0]
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(review_aggregates.flush)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('test', capacity=2, rate=0.5)
+        with mock.patch('chai.ratelimit.time.time', return_value=1000.0):
+            self.assertEqual(bucket.consume('a'), (True, 0))
+            self.assertEqual(bucket.consume('a'), (True, 0))
+            self.assertEqual(bucket.consume('a'), (False, 2.0))
+            # Buckets are per identity
+            self.assertEqual(bucket.consume('b'), (True, 0))
+        with mock.patch('chai.ratelimit.time.time', return_value=1001.0):
+            self.assertEqual(bucket.consume('a'), (False, 1.0))
+        with mock.patch('chai.ratelimit.time.time', return_value=1100.0):
+            # Refills stop at capacity however long the bucket sat idle
+            self.assertEqual([bucket.consume('a')[0] for _ in range(3)], [True, True, False])
+
+    def test_fingerprints(self):
+        claimed, key = claim_fingerprint('test', 'same text', 60)
+        self.assertTrue(claimed)
+        self.assertEqual(claim_fingerprint('test', 'same text', 60), (False, key))
+        self.assertTrue(claim_fingerprint('other', 'same text', 60)[0])
+        cache.delete(key)
+        self.assertTrue(claim_fingerprint('test', 'same text', 60)[0])
+
+    def test_endpoint_throttles_and_dedupes(self):
+        self.client.login(username='reviewer', password='pw')
+        url = reverse('submit_review', args=[self.chai.pk])
+
+        def post(text, rating=4):
+            return self.client.post(url, {'rating': rating, 'review_text': text}, content_type='application/json')
+
+        self.assertEqual(post("Lovely and strong").status_code, 201)
+        # Case and spacing don't make a new review
+        self.assertEqual(post("  lovely AND   strong ").status_code, 409)
+        self.assertEqual(post("Lovely", rating=9).status_code, 400)
+        self.assertEqual(self.client.post(url, 'not json', content_type='application/json').status_code, 400)
+        # Only saved reviews spend tokens, so the rejected ones above left one
+        self.assertEqual(post("Second cup").status_code, 201)
+        response = post("Third cup")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        # Still invalid or duplicate, whatever the bucket holds
+        self.assertEqual(post("Third cup", rating=0).status_code, 400)
+        self.assertEqual(post("Second cup").status_code, 409)
+        self.assertEqual(ChaiReview.objects.filter(chai_variety=self.chai).count(), 2)
+        # A throttled review wasn't posted, so it isn't a duplicate once the bucket refills
+        TokenBucket('review', capacity=2, rate=1 / 30).reset(self.user.pk)
+        self.assertEqual(post("Third cup").status_code, 201)
+
+    def test_counters_are_written_behind(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            review = ChaiReview.objects.create(user=self.user, chai_variety=self.chai, review_text="Good", rating=4)
+        self.chai.refresh_from_db()
+        self.assertEqual((self.chai.rating_count, self.chai.rating_sum), (0, 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            review.rating = 2
+            review.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(review_aggregates.flush(), 1)
+        self.assertEqual([q['sql'].split()[0] for q in queries if 'chai_chaivariety' in q['sql']], ['UPDATE'])
+        self.chai.refresh_from_db()
+        self.assertEqual((self.chai.rating_count, self.chai.rating_sum), (1, 2))
+
+        # A failed flush keeps its deltas for the next one
+        with self.captureOnCommitCallbacks(execute=True):
+            review.delete()
+        with mock.patch.object(AggregateBuffer, '_apply', side_effect=DatabaseError), self.assertLogs('chai.aggregates', 'ERROR'):
+            with self.assertRaises(DatabaseError):
+                review_aggregates.flush()
+        self.assertEqual(review_aggregates.flush(), 1)
+        self.chai.refresh_from_db()
+        self.assertEqual((self.chai.rating_count, self.chai.rating_sum), (0, 0))
+
+
+class PrimaryReplicaRouterTests(SimpleTestCase):
+    """Reads go to replicas unless the request or block is pinned to the primary"""
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter(replicas=['replica1', 'replica2'])
+        self.seen = []
+
+        def view(request):
+            self.seen.append(self.router.db_for_read(ChaiVariety))
+            return HttpResponse()
+        self.middleware = ReplicaStickinessMiddleware(view)
+        self.factory = RequestFactory()
+
+    def test_reads_use_replicas_and_writes_use_primary(self):
+        self.assertIn(self.router.db_for_read(ChaiVariety), ['replica1', 'replica2'])
+        self.assertEqual(self.router.db_for_write(ChaiVariety), 'default')
+
+    def test_use_primary_pins_reads(self):
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(ChaiVariety), 'default')
+        self.assertNotEqual(self.router.db_for_read(ChaiVariety), 'default')
+
+    def test_post_pins_request_and_following_reads(self):
+        with self.settings(READ_YOUR_WRITES_SECONDS=10):
+            response = self.middleware(self.factory.post('/chai/1/favorite/'))
+        self.assertEqual(response.cookies[PRIMARY_COOKIE]['max-age'], 10)
+
+        self.middleware(self.factory.get('/chai/1/'))
+        request = self.factory.get('/chai/1/')
+        request.COOKIES[PRIMARY_COOKIE] = '1'
+        self.middleware(request)
+        self.assertEqual(self.seen[0], 'default')
+        self.assertNotEqual(self.seen[1], 'default')
+        self.assertEqual(self.seen[2], 'default')
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class StoreInventoryTests(TestCase):
+    """Availability lookups are a single query; POS sync writes in bulk"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.masala, cls.ginger, cls.plain = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=name, image='chais/medium_masala.jpeg', chai_type=code, price=50)
+            for name, code in (('Masala', 'ML'), ('Ginger', 'GR'), ('Plain', 'PL'))
+        ])
+        cls.corner = Store.objects.create(name='Corner', store_location='Pune')
+        cls.station = Store.objects.create(name='Station', store_location='Mumbai')
+        StoreInventory.objects.bulk_create([
+            StoreInventory(store=cls.corner, chai_variety=cls.masala, price=40, stock=3),
+            StoreInventory(store=cls.corner, chai_variety=cls.ginger),
+            StoreInventory(store=cls.station, chai_variety=cls.masala, stock=10),
+            StoreInventory(store=cls.station, chai_variety=cls.plain, is_available=False),
+        ])
+
+    def setUp(self):
+        self.enterContext(override_settings(POS_API_TOKENS={
+            'till-token': frozenset([self.corner.pk, self.station.pk]),
+            'corner-token': frozenset([self.corner.pk]),
+        }))
+
+    def test_find_stores_all_and_any(self):
+        with self.assertNumQueries(1):
+            stores = find_stores([self.masala.pk, self.ginger.pk])
+        self.assertEqual([store['name'] for store in stores], ['Corner'])
+        self.assertEqual([item['price'] for item in stores[0]['items']], [40, 50])
+
+        with self.assertNumQueries(1):
+            stores = find_stores([self.ginger.pk, self.plain.pk], match='any')
+        self.assertEqual([store['name'] for store in stores], ['Corner'])
+
+    def test_availability_endpoint(self):
+        url = reverse('store_availability')
+        response = self.client.get(url, {'chais': f"{self.masala.pk}", 'match': 'any'})
+        self.assertEqual([store['name'] for store in response.json()['stores']], ['Corner', 'Station'])
+        self.assertEqual(self.client.get(url, {'chais': 'x'}).status_code, 400)
+
+    def test_pos_stock_update(self):
+        url = reverse('pos_stock_update')
+        items = [
+            {'store': self.corner.pk, 'chai': self.masala.pk, 'stock': 0},
+            {'store': self.station.pk, 'chai': self.plain.pk, 'stock': 7, 'price': '55.50'},
+            {'store': self.station.pk, 'chai': self.ginger.pk, 'stock': 1},
+        ]
+        self.assertEqual(self.client.post(url, {'items': items}, content_type='application/json').status_code, 401)
+
+        # One read, one UPDATE per table, plus the savepoint pair
+        with self.assertNumQueries(5):
+            response = self.client.post(
+                url, {'items': items}, content_type='application/json', HTTP_AUTHORIZATION='Bearer till-token',
+            )
+        self.assertEqual(response.json(), {
+            'success': True, 'updated': 2, 'unknown': [{'store': self.station.pk, 'chai': self.ginger.pk}],
+        })
+        self.assertFalse(StoreInventory.objects.get(store=self.corner, chai_variety=self.masala).is_available)
+        listing = StoreInventory.objects.get(store=self.station, chai_variety=self.plain)
+        self.assertEqual((listing.stock, str(listing.price), listing.is_available), (7, '55.50', True))
+
+        response = self.client.post(
+            url, {'items': [{'store': 'x'}]}, content_type='application/json', HTTP_AUTHORIZATION='Bearer till-token',
+        )
+        self.assertEqual(response.status_code, 400)
+        for price in ('NaN', 'sNaN', 'Infinity', '-Infinity', 1e30, '100000000.00', '-1', '1.005'):
+            response = self.client.post(
+                url, {'items': [{'store': self.corner.pk, 'chai': self.masala.pk, 'price': price}]},
+                content_type='application/json', HTTP_AUTHORIZATION='Bearer till-token',
+            )
+            self.assertEqual(response.status_code, 400, price)
+            self.assertIn("'price' must be", response.json()['errors']['0'])
+
+        # A store's token can't touch another store's stock, and nothing is written
+        response = self.client.post(
+            url, {'items': items[:2]}, content_type='application/json', HTTP_AUTHORIZATION='Bearer corner-token',
+        )
+        self.assertEqual(response.json(), {'success': False, 'errors': {'1': f"Not allowed to update store {self.station.pk}"}})
+        self.assertEqual(StoreInventory.objects.get(store=self.station, chai_variety=self.plain).stock, 7)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class OrderIngestionTests(TestCase):
+    """POS batches are price-checked from the cache, deduplicated and rolled up per store and day"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.masala, cls.ginger = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name='Masala', image='chais/medium_masala.jpeg', chai_type='ML', price=50),
+            ChaiVariety(name='Ginger', image='chais/medium_masala.jpeg', chai_type='GR', price=60),
+        ])
+        cls.store = Store.objects.create(name='Corner', store_location='Pune')
+        StoreInventory.objects.bulk_create([
+            StoreInventory(store=cls.store, chai_variety=cls.masala, price=40),
+            StoreInventory(store=cls.store, chai_variety=cls.ginger),
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.enterContext(override_settings(POS_API_TOKENS={
+            'till-token': frozenset([self.store.pk]),
+            'other-till': frozenset([self.store.pk + 1]),
+        }))
+
+    def orders(self, count, start=0, day='2026-03-01'):
+        return [
+            {
+                'store': self.store.pk,
+                'id': f"till-1-{n}",
+                'placed_at': f"{day}T09:{n % 60:02}:00+05:30",
+                'lines': [
+                    {'chai': self.masala.pk, 'quantity': 2, 'unit_price': '40.00'},
+                    {'chai': self.ginger.pk, 'quantity': 1, 'unit_price': 60},
+                ],
+            }
+            for n in range(start, start + count)
+        ]
+
+    def test_ingest_and_rollup(self):
+        created, duplicates, rejected = ingest_orders(self.orders(30))
+        self.assertEqual((created, duplicates, rejected), (30, [], {}))
+        self.assertEqual(OrderLine.objects.count(), 60)
+
+        # Resending a batch with a few new orders only stores the new ones
+        created, duplicates, _ = ingest_orders(self.orders(10, start=25))
+        self.assertEqual(created, 5)
+        self.assertEqual(len(duplicates), 5)
+
+        sales = DailyStoreSales.objects.get(store=self.store)
+        self.assertEqual((sales.order_count, sales.cup_count, sales.revenue), (35, 105, 35 * 140))
+        rebuilt = rebuild_daily_sales()
+        self.assertEqual(rebuilt, 1)
+        self.assertEqual(
+            DailyStoreSales.objects.values_list('order_count', 'cup_count', 'revenue').get(),
+            (35, 105, 35 * 140),
+        )
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        ingest_orders(self.orders(1, start=1000))
+        with CaptureQueriesContext(connection) as small:
+            ingest_orders(self.orders(5))
+        # Small enough for one INSERT per table even with SQLite's 999 parameter limit
+        with CaptureQueriesContext(connection) as large:
+            ingest_orders(self.orders(60, start=5))
+        self.assertEqual(len(small), len(large))
+        self.assertFalse(any('chai_storeinventory' in query['sql'] for query in large.captured_queries))
+
+    def test_rejects_wrong_prices_and_unlisted_chais(self):
+        orders = self.orders(3)
+        orders[1]['lines'][0]['unit_price'] = '45.00'
+        orders[2]['lines'][0]['chai'] = 999
+        created, _, rejected = ingest_orders(orders + ['not an order'])
+        self.assertEqual(created, 1)
+        self.assertEqual(sorted(rejected), [1, 2, 3])
+        self.assertIn('costs ₹40.00', rejected[1])
+
+    def test_price_change_reaches_cached_map(self):
+        ingest_orders(self.orders(1))
+        listing = StoreInventory.objects.get(store=self.store, chai_variety=self.masala)
+        listing.price = 45
+        listing.save()
+        created, _, rejected = ingest_orders(self.orders(1, start=1))
+        self.assertEqual(created, 0)
+        self.assertIn('costs ₹45.00', rejected[0])
+
+    def test_endpoint(self):
+        url = reverse('pos_orders')
+        body = {'orders': self.orders(2)}
+        self.assertEqual(self.client.post(url, body, content_type='application/json').status_code, 401)
+        response = self.client.post(
+            url, body, content_type='application/json', HTTP_AUTHORIZATION='Bearer till-token',
+        )
+        self.assertEqual(response.json(), {'success': True, 'created': 2, 'duplicates': [], 'rejected': {}})
+        self.assertEqual(Order.objects.get(external_id='till-1-0').total, 140)
+
+        # Another store's till can't send this store's orders
+        response = self.client.post(
+            url, {'orders': self.orders(1, start=2)}, content_type='application/json', HTTP_AUTHORIZATION='Bearer other-till',
+        )
+        self.assertEqual(response.json(), {
+            'success': False, 'created': 0, 'duplicates': [],
+            'rejected': {'0': f"Not allowed to send orders for store {self.store.pk}"},
+        })
+
+
+class AnalyticsRollupTests(TestCase):
+    """Daily rollups match the raw tables, even for rows that commit out of id order"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"drinker{i}", password='pw') for i in range(6)]
+        cls.masala, cls.ginger, cls.plain = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=name, image='chais/medium_masala.jpeg', chai_type=code, price=40)
+            for name, code in (('Masala', 'ML'), ('Ginger', 'ML'), ('Plain', 'PL'))
+        ])
+
+    def at(self, days_ago):
+        # Midday, clear of any day boundary
+        day = timezone.localdate() - timedelta(days=days_ago)
+        return timezone.make_aware(datetime.combine(day, datetime.min.time()) + timedelta(hours=12))
+
+    def review(self, user, chai, rating, days_ago=0, **kwargs):
+        return ChaiReview.objects.create(
+            user=user, chai_variety=chai, review_text="Rollup", rating=rating, date_added=self.at(days_ago), **kwargs,
+        )
+
+    def test_rollup_per_chai_and_type(self):
+        self.review(self.users[0], self.masala, 5, days_ago=3)
+        self.review(self.users[1], self.masala, 3, days_ago=3)
+        self.review(self.users[2], self.ginger, 4, days_ago=3)
+        self.review(self.users[3], self.plain, 2)
+        Favorite.objects.create(user=self.users[0], chai_variety=self.ginger, date_added=self.at(3))
+
+        first_day, last_day, rows = rollup()
+        self.assertEqual((first_day, last_day, rows), (self.at(3).date(), self.at(0).date(), 3))
+        self.assertEqual(
+            DailyChaiStats.objects.values_list('chai_variety', 'review_count', 'rating_sum', 'favorite_count').get(
+                chai_variety=self.ginger,
+            ),
+            (self.ginger.pk, 1, 4, 1),
+        )
+        self.assertEqual(
+            list(chai_type_daily_stats('ML').values_list('day', 'review_count', 'rating_sum', 'favorite_count')),
+            [(self.at(3).date(), 3, 12, 1)],
+        )
+
+        # Only new rows and the trailing window are recomputed, and a full rebuild agrees
+        self.review(self.users[4], self.masala, 1, days_ago=3)
+        self.assertEqual(rollup()[0], self.at(3).date())
+        stats = lambda: sorted(DailyChaiStats.objects.values_list('chai_variety', 'day', 'review_count', 'rating_sum', 'favorite_count'))
+        incremental = stats()
+        rollup(full=True)
+        self.assertEqual(stats(), incremental)
+
+    def test_rows_committed_out_of_id_order(self):
+        self.review(self.users[0], self.masala, 5, pk=10)
+        self.review(self.users[1], self.masala, 4, pk=20)
+        rollup()
+        self.assertEqual(Checkpoint.load('analytics-rollup')['review'], 20)
+
+        # A writer that got id 15 before the run but committed after it
+        self.review(self.users[2], self.masala, 3, pk=15)
+        rollup()
+        today = DailyChaiStats.objects.get(chai_variety=self.masala, day=timezone.localdate())
+        self.assertEqual((today.review_count, today.rating_sum), (3, 12))
+
+        with override_settings(ANALYTICS_RESCAN_DAYS=0):
+            self.review(self.users[3], self.masala, 1, pk=16)
+            self.assertIsNone(rollup())
+
+    def test_price_change_impact(self):
+        PriceHistory.objects.bulk_create([
+            PriceHistory(chai_variety=self.masala, price=40, changed_at=self.at(60)),
+            PriceHistory(chai_variety=self.masala, price=50, changed_at=self.at(10)),
+        ])
+        # Two reviews and a favorite in the week before the change, one review after
+        self.review(self.users[0], self.masala, 5, days_ago=12)
+        self.review(self.users[1], self.masala, 4, days_ago=15)
+        Favorite.objects.create(user=self.users[2], chai_variety=self.masala, date_added=self.at(11))
+        self.review(self.users[3], self.masala, 2, days_ago=4)
+        # Outside both windows
+        self.review(self.users[4], self.masala, 1, days_ago=30)
+        rollup()
+
+        # The chai, its price history, then one rollup read per window
+        with self.assertNumQueries(4):
+            impact = price_change_impact(self.masala.pk, window_days=7)
+        self.assertEqual(impact, [{
+            'changed_at': self.at(10), 'old_price': Decimal('40.00'), 'new_price': Decimal('50.00'),
+            'before': {'reviews_per_day': round(2 / 7, 2), 'average_rating': 4.5, 'favorites': 1},
+            'after': {'reviews_per_day': round(1 / 7, 2), 'average_rating': 2.0, 'favorites': 0},
+        }])
+        self.assertEqual(DailyChaiStats.objects.get(chai_variety=self.masala, day=self.at(12).date()).price, Decimal('40.00'))
+        self.assertEqual(DailyChaiStats.objects.get(chai_variety=self.masala, day=self.at(4).date()).price, Decimal('50.00'))
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class ApiTests(TestCase):
+    """The v1 API pages by keyset, batch-fetches in one query and honours ETags"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.chais = ChaiVariety.objects.bulk_create([
+            ChaiVariety(
+                name=f"Chai {i}", image='chais/medium_masala.jpeg', chai_type='ML', price=50 + i,
+                rating_count=i % 3, rating_sum=(i % 3) * 4,
+            )
+            for i in range(25)
+        ])
+
+    def test_sparse_fields_and_batch_fetch(self):
+        url = reverse('api_list', args=['chais'])
+        wanted = [self.chais[3].pk, 999999, self.chais[1].pk]
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'ids': ','.join(map(str, wanted)), 'fields': 'id,name,average_rating'})
+        self.assertEqual(response.json(), {
+            'data': [
+                {'id': self.chais[3].pk, 'name': 'Chai 3', 'average_rating': None},
+                {'id': self.chais[1].pk, 'name': 'Chai 1', 'average_rating': 4.0},
+            ],
+            'missing': [999999],
+        })
+        self.assertEqual(self.client.get(url, {'fields': 'name,secret'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_list', args=['users'])).status_code, 404)
+
+    def test_keyset_pages_cover_every_row_once(self):
+        url = reverse('api_list', args=['chais'])
+        seen, cursor = [], None
+        while True:
+            params = {'fields': 'id', 'limit': 10}
+            if cursor:
+                params['cursor'] = cursor
+            with self.assertNumQueries(1):
+                body = self.client.get(url, params).json()
+            seen.extend(row['id'] for row in body['data'])
+            cursor = body['next']
+            if not cursor:
+                break
+        self.assertEqual(sorted(seen), sorted(chai.pk for chai in self.chais))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_etag(self):
+        url = reverse('api_detail', args=['chais', self.chais[0].pk])
+        response = self.client.get(url)
+        self.assertEqual(response.json()['data']['price'], '50.00')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        chai = ChaiVariety.objects.get(pk=self.chais[0].pk)
+        chai.price = 55
+        chai.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.json()['data']['price'], '55.00')
+
+    def test_page_etag_is_checked_before_the_page_query(self):
+        url = reverse('api_list', args=['chais'])
+        params = {'fields': 'id,name', 'limit': 10}
+        etag = self.client.get(url, params)['ETag']
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertNotIn('"name"', queries.captured_queries[0]['sql'])
+
+        # Rows past the page don't change it, an edit on the page does
+        self.chais[0].save()
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.chais[-1].save()
+        with self.assertNumQueries(2):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class ConditionalPageTests(TestCase):
+    """Chai pages answer 304 until the chai or any of its reviews changes"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"taster{i}", password='pw') for i in range(2)]
+        cls.chai = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])[0]
+        cls.review = ChaiReview.objects.create(user=cls.users[0], chai_variety=cls.chai, review_text="Strong", rating=4)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('chai_detail', args=[self.chai.pk])
+
+    def assertChangesEtag(self, change):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        change()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response
+
+    def test_review_edit_changes_etag(self):
+        def edit():
+            self.review.review_text = "Strong, with cardamom"
+            self.review.save()
+        self.assertContains(self.assertChangesEtag(edit), "Strong, with cardamom")
+
+    def test_reviews_added_and_deleted_change_etag(self):
+        # Backdated, so the newest date_added doesn't move
+        self.assertChangesEtag(lambda: ChaiReview.objects.create(
+            user=self.users[1], chai_variety=self.chai, review_text="Mild", rating=3, date_added=timezone.now() - timedelta(days=30),
+        ))
+        self.assertChangesEtag(lambda: ChaiReview.objects.filter(user=self.users[1]).delete())
+
+    def test_missing_chai(self):
+        self.assertEqual(self.client.get(reverse('chai_detail', args=[999999])).status_code, 404)
+
+
+@override_settings(EXPORT_RESCAN_IDS=0)
+class ExportTests(TestCase):
+    """Incremental exports pick up the rows added since the last watermark, and rescan a window before it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('analyst', password='pw', is_staff=True)
+        cls.chai = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])[0]
+        cls.when = timezone.now() - timedelta(days=1)
+        cls.reviews = ChaiReview.objects.bulk_create([
+            ChaiReview(user=cls.staff, chai_variety=cls.chai, review_text=f"Cup {i}", rating=4, date_added=cls.when)
+            for i in range(3)
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.client.login(username='analyst', password='pw')
+
+    def export(self, fmt='csv', **params):
+        response = self.client.get(reverse('export_data', args=['reviews', fmt]), params)
+        body = b''.join(response.streaming_content).decode() if response.streaming else None
+        return response, body
+
+    def test_incremental_export_by_id(self):
+        response, body = self.export()
+        rows = list(csv.reader(StringIO(body)))
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual([int(row[0]) for row in rows[1:]], [review.pk for review in self.reviews])
+        watermark = response['X-Export-Watermark']
+        self.assertEqual(watermark, str(self.reviews[-1].pk))
+
+        # Later rows may be backdated past the rows already exported
+        late = ChaiReview.objects.create(
+            user=self.staff, chai_variety=self.chai, review_text="Late", rating=3, date_added=self.when - timedelta(days=7),
+        )
+        response, body = self.export('ndjson', since=watermark)
+        self.assertEqual([json.loads(line)['id'] for line in body.splitlines()], [late.pk])
+        self.assertEqual(response['X-Export-Watermark'], str(late.pk))
+        self.assertEqual(self.export(since=late.pk)[1].splitlines(), ['id,branch_id,user_id,chai_variety_id,rating,review_text,comment_count,date_added'])
+
+    def test_rescan_window_catches_late_commits(self):
+        # The middle review's transaction was still open during the first export
+        late = self.reviews[1]
+        ChaiReview.objects.filter(pk=late.pk).delete()
+        watermark = self.export()[0]['X-Export-Watermark']
+        ChaiReview.objects.bulk_create([late])
+
+        ids = lambda body: [json.loads(line)['id'] for line in body.splitlines()]
+        self.assertEqual(ids(self.export('ndjson', since=watermark)[1]), [])
+        with override_settings(EXPORT_RESCAN_IDS=2):
+            # The window sends the last exported row again too
+            self.assertEqual(ids(self.export('ndjson', since=watermark)[1]), [late.pk, self.reviews[2].pk])
+
+    def test_bad_requests(self):
+        for since in ('2026-01-01T00:00:00 00:00', '-1'):
+            self.assertEqual(self.export(since=since)[0].status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_data', args=['users', 'csv'])).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.export()[0].status_code, 302)
+
+    def test_command(self):
+        out, err = StringIO(), StringIO()
+        call_command('export_data', 'reviews', '--format', 'ndjson', '--since', str(self.reviews[0].pk), stdout=out, stderr=err)
+        self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()], [r.pk for r in self.reviews[1:]])
+        self.assertEqual(err.getvalue().strip(), f"watermark: {self.reviews[-1].pk}")
+
+
+class CommentVoteTests(TestCase):
+    """Helpful votes are one per user, summed over shards and folded back by compaction"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"voter{i}", password='pw') for i in range(6)]
+        [chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+        cls.review = ChaiReview.objects.create(user=cls.users[0], chai_variety=chai, review_text="Good", rating=4)
+        cls.older = ReviewComment.objects.create(review=cls.review, user=cls.users[0], comment_text="First")
+        cls.newer = ReviewComment.objects.create(review=cls.review, user=cls.users[1], comment_text="Second")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_one_vote_per_user_and_totals_survive_compaction(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in self.users:
+                self.assertTrue(vote(user, self.older.pk))
+            self.assertFalse(vote(self.users[0], self.older.pk))
+            self.assertTrue(unvote(self.users[1], self.older.pk))
+            self.assertFalse(unvote(self.users[1], self.older.pk))
+        self.assertEqual(helpful_counts([self.older.pk]), {self.older.pk: 5})
+
+        cache.clear()
+        self.assertEqual(helpful_counts([self.older.pk]), {self.older.pk: 5})
+        self.assertEqual(compact_votes(), 1)
+        self.older.refresh_from_db()
+        self.assertEqual(self.older.is_helpful, 5)
+        self.assertFalse(CommentVoteShard.objects.exclude(count=0).exists())
+        cache.clear()
+        self.assertEqual(helpful_counts([self.older.pk]), {self.older.pk: 5})
+
+    def test_helpful_first_ordering(self):
+        self.assertEqual([c['id'] for c in comments_for_review(self.review.pk)], [self.newer.pk, self.older.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in self.users[:2]:
+                vote(user, self.older.pk)
+        compact_votes()
+        # The votes dropped the cached total; once read again it is cached
+        comments_for_review(self.review.pk)
+        with self.assertNumQueries(1):
+            comments = comments_for_review(self.review.pk)
+        self.assertEqual([(c['id'], c['helpful']) for c in comments], [(self.older.pk, 2), (self.newer.pk, 0)])
+        self.assertEqual(comments_for_review(self.review.pk, 'newest')[0]['id'], self.newer.pk)
+
+    def test_vote_endpoint_toggles(self):
+        url = reverse('vote_comment_helpful', args=[self.newer.pk])
+        self.assertEqual(self.client.post(url).status_code, 401)
+        self.client.force_login(self.users[2])
+        self.assertEqual(self.client.post(url).json(), {'success': True, 'voted': True, 'helpful_count': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url)
+        self.assertEqual(helpful_counts([self.newer.pk]), {self.newer.pk: 0})
+        self.assertTrue(self.client.post(url).json()['voted'])
+        comments = self.client.get(reverse('review_comments', args=[self.review.pk])).json()['comments']
+        self.assertEqual([(c['id'], c['voted']) for c in comments], [(self.newer.pk, True), (self.older.pk, False)])
+
+    def test_votes_drop_a_stale_cached_total(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            vote(self.users[0], self.older.pk)
+        # A read that summed the shards before that vote committed caches its total late
+        cache.set(f"comment-votes:{self.older.pk}", 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            vote(self.users[1], self.older.pk)
+        self.assertEqual(helpful_counts([self.older.pk]), {self.older.pk: 2})
+
+    def test_admin_shows_total_votes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in self.users[:3]:
+                vote(user, self.older.pk)
+        compact_votes()
+        vote(self.users[3], self.older.pk)
+        self.client.force_login(User.objects.create_superuser('votes-admin', password='pw'))
+        response = self.client.get(reverse('admin:chai_reviewcomment_changelist'))
+        totals = {comment.pk: comment.helpful_total for comment in response.context['cl'].result_list}
+        self.assertEqual(totals, {self.older.pk: 4, self.newer.pk: 0})
+        self.assertContains(response, 'Helpful votes')
+
+
+class TrendingScoreTests(TestCase):
+    """Incrementally maintained scores match a brute-force decay over every event"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f"fan{i}", password='pw') for i in range(4)]
+        cls.chais = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=f"Chai {i}", image='chais/medium_masala.jpeg', chai_type='ML', price=40)
+            for i in range(3)
+        ])
+        cls.store = Store.objects.create(name="Corner stall", store_location='Pune')
+
+    def setUp(self):
+        self.addCleanup(trending_events.flush)
+        self.addCleanup(review_aggregates.flush)
+
+    @contextmanager
+    def scored(self):
+        """Run the writes' on-commit hooks and flush the buffered events"""
+        with self.captureOnCommitCallbacks(execute=True):
+            yield
+        trending_events.flush()
+
+    def brute_force(self, events, now):
+        half_life = timedelta(hours=settings.TRENDING_HALF_LIFE_HOURS)
+        return sum(weight * 0.5 ** ((now - when) / half_life) for weight, when in events)
+
+    def test_decay_matches_brute_force(self):
+        now = timezone.now()
+        events = []
+        with self.scored():
+            for i, user in enumerate(self.users):
+                when = now - timedelta(hours=20 * i)
+                ChaiReview.objects.create(user=user, chai_variety=self.chais[0], review_text="Nice", rating=4, date_added=when)
+                events.append((REVIEW_WEIGHT, when))
+                when = now - timedelta(days=9, hours=i)
+                Favorite.objects.create(user=user, chai_variety=self.chais[0], date_added=when)
+                events.append((FAVORITE_WEIGHT, when))
+            StoreRating.objects.create(store=self.store, user=self.users[0], rating=5, date_added=now - timedelta(days=1))
+
+        chai = ChaiVariety.objects.get(pk=self.chais[0].pk)
+        for later in (now, now + timedelta(days=3), now + timedelta(days=30)):
+            self.assertAlmostEqual(
+                current_score(chai.trending_score, later) / self.brute_force(events, later), 1, places=9,
+            )
+        store = Store.objects.get(pk=self.store.pk)
+        self.assertAlmostEqual(current_score(store.trending_score, now), STORE_RATING_WEIGHT * 0.5 ** (24 / settings.TRENDING_HALF_LIFE_HOURS))
+
+        # Deletes take back exactly what was added, and a rebuild agrees
+        with self.scored():
+            Favorite.objects.filter(chai_variety=self.chais[0]).delete()
+        chai.refresh_from_db()
+        reviews_only = [event for event in events if event[0] == REVIEW_WEIGHT]
+        self.assertAlmostEqual(current_score(chai.trending_score, now) / self.brute_force(reviews_only, now), 1, places=9)
+        rebuild_scores()
+        rebuilt = ChaiVariety.objects.get(pk=chai.pk)
+        self.assertAlmostEqual(rebuilt.trending_score, chai.trending_score, places=9)
+        # Taking back every event leaves no score rather than rounding noise
+        with self.scored():
+            ChaiReview.objects.filter(chai_variety=self.chais[0]).delete()
+        chai.refresh_from_db()
+        self.assertEqual((chai.trending_score, chai.trending_weight), (None, 0))
+
+    @override_settings(TRENDING_HALF_LIFE_HOURS=1)
+    def test_scores_stay_finite_long_after_the_epoch(self):
+        # Over 1024 half-lives after TRENDING_EPOCH, where scaled scores overflowed
+        much_later = timezone.now() + timedelta(days=400)
+        with self.scored():
+            ChaiReview.objects.create(user=self.users[0], chai_variety=self.chais[1], review_text="Later", rating=4, date_added=much_later)
+            Favorite.objects.create(user=self.users[1], chai_variety=self.chais[1], date_added=much_later - timedelta(hours=2))
+        chai = ChaiVariety.objects.get(pk=self.chais[1].pk)
+        self.assertAlmostEqual(current_score(chai.trending_score, much_later), REVIEW_WEIGHT + FAVORITE_WEIGHT / 4)
+        self.assertEqual(current_score(chai.trending_score, much_later + timedelta(days=1000)), 0)
+
+    def test_recent_activity_outranks_older_activity(self):
+        now = timezone.now()
+        # Three reviews two weeks ago lose to one favorite today
+        with self.scored():
+            for user in self.users[:3]:
+                ChaiReview.objects.create(
+                    user=user, chai_variety=self.chais[1], review_text="Was good", rating=5, date_added=now - timedelta(days=14),
+                )
+            Favorite.objects.create(user=self.users[3], chai_variety=self.chais[2])
+        with self.assertNumQueries(1):
+            ranked = trending(ChaiVariety.objects.all())
+        self.assertEqual([chai.pk for chai in ranked], [self.chais[2].pk, self.chais[1].pk])
+        self.assertEqual(self.client.get(reverse('trending')).status_code, 200)
+
+    def test_events_are_written_behind_in_one_update(self):
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, user in enumerate(self.users):
+                Favorite.objects.create(user=user, chai_variety=self.chais[i % 2], date_added=now - timedelta(hours=i))
+        # Nothing touched the chai rows inside the writes
+        self.assertFalse(ChaiVariety.objects.filter(trending_score__isnull=False).exists())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(trending_events.flush(), 2)
+        self.assertEqual([q['sql'].split()[0] for q in queries if 'chai_chaivariety' in q['sql']], ['UPDATE'])
+        for chai, hours in ((self.chais[0], (0, 2)), (self.chais[1], (1, 3))):
+            chai.refresh_from_db()
+            expected = self.brute_force([(FAVORITE_WEIGHT, now - timedelta(hours=h)) for h in hours], now)
+            self.assertAlmostEqual(current_score(chai.trending_score, now) / expected, 1, places=9)
+
+
+@override_settings(HOMEPAGE_SNAPSHOT_REBUILD_SECONDS=0)
+class HomepageSnapshotTests(TestCase):
+    """Relevant writes make the next visit serve the stale snapshot while a rebuild runs"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('fan', password='pw')
+        cls.chai = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])[0]
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(trending_events.flush)
+        # Rebuilds run inline instead of on a thread
+        thread = self.enterContext(mock.patch('chai.homepage.threading.Thread'))
+        thread.side_effect = lambda target, args, **kwargs: mock.Mock(start=lambda: target(*args))
+        self.enterContext(mock.patch('chai.homepage.connection'))
+
+    def favorites_shown(self):
+        return get_snapshot()['totals']['favorites']
+
+    def test_favorites_serve_stale_then_revalidate(self):
+        self.assertEqual(self.favorites_shown(), 0)
+        time.sleep(0.01)
+        with self.captureOnCommitCallbacks(execute=True):
+            favorite = Favorite.objects.create(user=self.user, chai_variety=self.chai)
+        # The stale snapshot is served once while the rebuild starts
+        self.assertEqual(self.favorites_shown(), 0)
+        self.assertEqual(self.favorites_shown(), 1)
+
+        time.sleep(0.01)
+        with self.captureOnCommitCallbacks(execute=True):
+            favorite.delete()
+        self.assertEqual(self.favorites_shown(), 1)
+        self.assertEqual(self.favorites_shown(), 0)
+
+    def test_buffered_counters_mark_stale_when_they_land(self):
+        self.assertEqual(get_snapshot()['trending'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Favorite.objects.create(user=self.user, chai_variety=self.chai)
+        self.assertEqual(get_snapshot()['trending'], [])
+        # The rebuild ran before the buffered score was written; the flush asks for another
+        time.sleep(0.01)
+        trending_events.flush()
+        get_snapshot()
+        self.assertEqual([card['id'] for card in get_snapshot()['trending']], [self.chai.pk])
+
+
+class PrecompressedStaticTests(SimpleTestCase):
+    """collectstatic writes hashed, precompressed files and serve() picks the variant the client accepts"""
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('gzip, deflate, br;q=0.8'), {'gzip', 'deflate', 'br'})
+        self.assertEqual(accepted_encodings('br;q=0, gzip;q=1.0'), {'gzip'})
+        self.assertEqual(accepted_encodings(''), set())
+
+    def test_collect_and_serve(self):
+        storages = {**settings.STORAGES, 'staticfiles': {'BACKEND': 'chai.staticfiles.CompressedManifestStaticFilesStorage'}}
+        with tempfile.TemporaryDirectory() as tmp, override_settings(STATIC_ROOT=tmp, STORAGES=storages):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            _hashed_names.cache_clear()
+            self.addCleanup(_hashed_names.cache_clear)
+            hashed = staticfiles_storage.stored_name('interactive.css')
+            self.assertNotEqual(hashed, 'interactive.css')
+            self.assertTrue(os.path.exists(os.path.join(tmp, hashed + '.gz')))
+            # Too small to be worth compressing
+            self.assertFalse(os.path.exists(os.path.join(tmp, staticfiles_storage.stored_name('style.css') + '.gz')))
+
+            factory = RequestFactory()
+            response = serve(factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate'), hashed)
+            with open(os.path.join(tmp, hashed), 'rb') as f:
+                self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), f.read())
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Content-Type'], 'text/css')
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertIn('immutable', response['Cache-Control'])
+            response.close()
+
+            response = serve(factory.get('/'), 'interactive.css')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertNotIn('immutable', response['Cache-Control'])
+            response.close()
+
+
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+    AUTHENTICATION_BACKENDS=['chai.auth.CachedUserBackend', 'django.contrib.auth.backends.ModelBackend'],
+)
+class SessionUserCacheTests(TestCase):
+    """Signed-in page views read the session and user from the cache"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('regular', password='pw')
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+        cls.store = Store.objects.create(name="Corner stall", store_location='Pune')
+        reviewers = [User.objects.create_user(f"reviewer{i}", password='pw') for i in range(5)]
+        for reviewer in reviewers:
+            ChaiReview.objects.create(user=reviewer, chai_variety=cls.chai, review_text="Nice", rating=4)
+            StoreRating.objects.create(user=reviewer, store=cls.store, rating=4)
+        Favorite.objects.create(user=cls.user, chai_variety=cls.chai)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def page_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return [query['sql'] for query in ctx.captured_queries]
+
+    def test_user_and_session_come_from_cache(self):
+        url = reverse('chai_detail', args=[self.chai.pk])
+        self.page_queries(url)
+        queries = self.page_queries(url)
+        self.assertFalse([sql for sql in queries if 'django_session' in sql or 'FROM "auth_user" WHERE "auth_user"."id" =' in sql])
+        # Reviewer names come with the reviews, not one query each
+        self.assertEqual(len([sql for sql in queries if 'auth_user' in sql]), 1)
+
+        # update() skips the save signal, so the cached user is still served
+        User.objects.filter(pk=self.user.pk).update(first_name='Stale')
+        self.assertEqual(self.client.get(url).wsgi_request.user.first_name, '')
+        self.user.first_name = 'Fresh'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get(url).wsgi_request.user.first_name, 'Fresh')
+
+    def test_sessions_from_before_the_cached_backend_still_resolve(self):
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('chai_detail', args=[self.chai.pk]))
+        self.assertEqual(response.wsgi_request.user, self.user)
+
+    def test_favorite_and_rating_state(self):
+        response = self.client.get(reverse('chai_detail', args=[self.chai.pk]))
+        self.assertTrue(response.context['is_favorite'])
+
+        url = reverse('store_detail', args=[self.store.pk])
+        self.assertIsNotNone(self.client.get(url).context['rating_form'])
+        self.client.post(url, {'rating': 5, 'comment': 'Great'})
+        response = self.client.get(url)
+        self.assertEqual(response.context['user_rating'], 5)
+        self.assertIsNone(response.context['rating_form'])
+        # A second rating is ignored instead of failing on the unique constraint
+        self.assertEqual(self.client.post(url, {'rating': 1}).status_code, 200)
+        self.assertEqual(StoreRating.objects.get(store=self.store, user=self.user).rating, 5)
+
+
+class BranchTests(TestCase):
+    """Branch-scoped managers, automatic branch assignment, the middleware and the router"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.pune = Branch.objects.create(name="Pune", slug='pune')
+        cls.goa = Branch.objects.create(name="Goa", slug='goa')
+        cls.user = User.objects.create_user('local', password='pw')
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+        with use_branch(cls.pune):
+            cls.pune_store = Store.objects.create(name="FC Road", store_location='Pune')
+            ChaiReview.objects.create(user=cls.user, chai_variety=cls.chai, review_text="Pune review", rating=5)
+        with use_branch(cls.goa):
+            cls.goa_store = Store.objects.create(name="Panjim", store_location='Goa')
+            ChaiReview.objects.create(user=cls.user, chai_variety=cls.chai, review_text="Goa review", rating=3)
+        # Ratings follow their store, whichever branch is active
+        cls.rating = StoreRating.objects.create(store=cls.goa_store, user=cls.user, rating=4)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_scoped_managers(self):
+        self.assertEqual(self.pune_store.branch, self.pune)
+        self.assertEqual(self.rating.branch, self.goa)
+        self.assertEqual(Store.objects.count(), 2)
+        with use_branch(self.pune):
+            self.assertEqual(list(Store.objects.all()), [self.pune_store])
+            self.assertEqual([r.review_text for r in self.chai.reviews.all()], ["Pune review"])
+            self.assertFalse(StoreRating.objects.exists())
+            self.assertEqual(StoreRating.all_branches.count(), 1)
+
+    def test_cached_cards_are_per_branch(self):
+        with use_branch(self.pune):
+            Favorite.objects.create(user=self.user, chai_variety=self.chai)
+        url = reverse('all_chai')
+        self.assertContains(self.client.get(url, HTTP_X_BRANCH='pune'), '1 ♥')
+        # Goa's favorite count is its own, not Pune's cached card
+        self.assertContains(self.client.get(url, HTTP_X_BRANCH='goa'), '0 ♥')
+
+    def test_middleware(self):
+        url = reverse('store_detail', args=[self.pune_store.pk])
+        self.assertEqual(self.client.get(url, HTTP_X_BRANCH='pune').status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_X_BRANCH='goa').status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_X_BRANCH='nowhere').status_code, 404)
+        # Another worker added the branch; this one's cached map doesn't have it yet
+        Branch.objects.bulk_create([Branch(name="Nowhere", slug='nowhere')])
+        chai_url = reverse('chai_detail', args=[self.chai.pk])
+        self.assertEqual(self.client.get(chai_url, HTTP_X_BRANCH='nowhere').status_code, 200)
+        self.assertIn('nowhere', branches_by_slug())
+        response = self.client.get(reverse('chai_detail', args=[self.chai.pk]), HTTP_X_BRANCH='goa')
+        self.assertEqual([r.review_text for r in response.context['reviews']], ["Goa review"])
+
+    def test_homepage_snapshot_per_branch(self):
+        with use_branch(self.pune):
+            self.assertEqual(get_snapshot()['totals']['stores'], 1)
+        self.assertEqual(get_snapshot()['totals']['stores'], 2)
+        with use_branch(self.goa):
+            Store.objects.create(name="Calangute", store_location='Goa')
+            self.assertEqual(get_snapshot()['totals']['stores'], 2)
+
+        # Background rebuilds run under the branch that asked for them
+        mark_stale()
+        time.sleep(0.01)
+        with mock.patch('chai.homepage.threading.Thread') as thread, mock.patch('chai.homepage.connection'):
+            thread.side_effect = lambda target, args, **kwargs: mock.Mock(start=lambda: target(*args))
+            with use_branch(self.pune):
+                Store.objects.create(name="Camp", store_location='Pune')
+                self.assertEqual(get_snapshot()['totals']['stores'], 1)
+                self.assertEqual(get_snapshot()['totals']['stores'], 2)
+            self.assertEqual(get_snapshot()['totals']['stores'], 2)
+            self.assertEqual(get_snapshot()['totals']['stores'], 4)
+
+    def test_router_only_moves_branch_models_with_a_database(self):
+        router = BranchRouter()
+        with mock.patch.dict(settings.DATABASES, {'branch_goa': {}}):
+            self.assertIsNone(router.db_for_write(ChaiReview))
+            with use_branch(self.goa):
+                self.assertEqual(router.db_for_write(ChaiReview), 'branch_goa')
+                self.assertEqual(router.db_for_read(ReviewComment), 'branch_goa')
+                self.assertIsNone(router.db_for_read(ChaiVariety))
+            with use_branch(self.pune):
+                self.assertIsNone(router.db_for_read(Store))
+
+
+@override_settings(DATABASE_ROUTERS=['chai.branches.BranchRouter'])
+class BranchDatabaseTests(TestCase):
+    """Branches with their own databases: routed writes, shared rows copied across, favorites kept on default"""
+    # The branch databases are only added in setUpClass, after the runner has set up test databases
+    databases = '__all__'
+    branch_databases = ['branch_goa', 'branch_pune']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        aliases = {
+            alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.tmp.name, f'{alias}.sqlite3')}
+            for alias in cls.branch_databases
+        }
+        cls.databases_patch = mock.patch.dict(settings.DATABASES, aliases)
+        cls.databases_patch.start()
+        configured = connections.configure_settings({'default': {}, **{alias: dict(conf) for alias, conf in aliases.items()}})
+        for alias in aliases:
+            connections.settings[alias] = configured[alias]
+            call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.branch_databases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        cls.databases_patch.stop()
+        cls.tmp.cleanup()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.goa = Branch.objects.create(name="Goa", slug='goa')
+        cls.pune = Branch.objects.create(name="Pune", slug='pune')
+        cls.regular = User.objects.create_user('regular', password='pw')
+        [cls.chai] = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name="Masala", image='chais/medium_masala.jpeg', chai_type='ML', price=40),
+        ])
+        call_command('sync_branch_catalogue', stdout=StringIO())
+
+    def setUp(self):
+        cache.clear()
+        # Apply buffered counter deltas while this test's rows still exist
+        self.addCleanup(review_aggregates.flush)
+        self.addCleanup(trending_events.flush)
+
+    def test_new_users_reach_branch_databases(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            newcomer = User.objects.create_user('newcomer', password='pw')
+        self.assertTrue(User.objects.using('branch_goa').filter(username='newcomer').exists())
+
+        with use_branch(self.goa), self.captureOnCommitCallbacks(execute=True):
+            store = Store.objects.create(name="Panjim", store_location='Goa')
+            StoreRating.objects.create(store=store, user=newcomer, rating=4)
+            ChaiReview.objects.create(user=newcomer, chai_variety=self.chai, review_text="Goa review", rating=5)
+        self.assertEqual(ChaiReview.all_branches.using('branch_goa').get().review_text, "Goa review")
+        self.assertFalse(ChaiReview.all_branches.using('default').exists())
+        self.assertTrue(StoreRating.all_branches.using('branch_goa').filter(user=newcomer).exists())
+        # The rating's trending event reaches the store in the branch database
+        trending_events.flush()
+        self.assertIsNotNone(Store.all_branches.using('branch_goa').get().trending_score)
+
+    def test_favorites_stay_unique_across_branches(self):
+        with use_branch(self.goa):
+            Favorite.objects.create(user=self.regular, chai_variety=self.chai)
+        self.assertEqual(Favorite.all_branches.using('default').get().branch, self.goa)
+        self.assertFalse(Favorite.all_branches.using('branch_goa').exists())
+
+        self.client.force_login(self.regular)
+        url = reverse('add_favorite', args=[self.chai.pk])
+        # At another branch the same chai is already a favorite, so the toggle removes it
+        self.assertFalse(self.client.post(url, HTTP_X_BRANCH='pune').json()['favorited'])
+        self.assertFalse(Favorite.all_branches.exists())
+
+    def test_chai_counters_span_branches(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with use_branch(self.goa):
+                ChaiReview.objects.create(user=self.regular, chai_variety=self.chai, review_text="Goa", rating=5)
+            with use_branch(self.pune):
+                ChaiReview.objects.create(user=self.regular, chai_variety=self.chai, review_text="Pune", rating=3)
+        review_aggregates.flush()
+        with use_branch(self.goa):
+            chai = ChaiVariety.objects.get(pk=self.chai.pk)
+            self.assertEqual([review.review_text for review in chai.reviews.all()], ["Goa"])
+            self.assertEqual((chai.rating_count, chai.rating_sum), (2, 8))
+
+    def test_branch_export_streams_only_that_branch(self):
+        delhi = Branch.objects.create(name="Delhi", slug='delhi')
+        for branch in (self.goa, self.pune, delhi):
+            with use_branch(branch):
+                ChaiReview.objects.create(user=self.regular, chai_variety=self.chai, review_text=branch.name, rating=4)
+        self.client.force_login(User.objects.create_user('analyst', password='pw', is_staff=True))
+
+        url = reverse('export_data', args=['reviews', 'ndjson'])
+        for slug, watermark in (('goa', 'branch_goa:1'), ('delhi', '1')):
+            response = self.client.get(url, HTTP_X_BRANCH=slug)
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+            self.assertEqual([row['review_text'] for row in rows], [slug.title()])
+            self.assertEqual(response['X-Export-Watermark'], watermark)
+
+    def test_chain_wide_recomputes_read_every_database(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            stores = {}
+            for branch, rating in ((self.goa, 5), (self.pune, 3)):
+                with use_branch(branch):
+                    ChaiReview.objects.create(user=self.regular, chai_variety=self.chai, review_text=branch.name, rating=rating)
+                    stores[branch.slug] = Store.objects.create(name=branch.name, store_location=branch.name)
+                    StoreRating.objects.create(store=stores[branch.slug], user=self.regular, rating=rating)
+        self.assertEqual(ChaiReview.all_branches.using('branch_pune').count(), 1)
+        # Lose the buffered deltas, as a crashed process would
+        review_aggregates._pending.clear()
+        trending_events._pending.clear()
+
+        recount_review_aggregates()
+        self.chai.refresh_from_db()
+        self.assertEqual((self.chai.rating_count, self.chai.rating_sum), (2, 8))
+
+        self.assertEqual(rebuild_scores(), 3)
+        self.chai.refresh_from_db()
+        self.assertAlmostEqual(self.chai.trending_weight, 2 * REVIEW_WEIGHT, places=3)
+        for slug, store in stores.items():
+            self.assertIsNotNone(Store.all_branches.using(f'branch_{slug}').get(pk=store.pk).trending_score)
+
+        rollup()
+        stats = DailyChaiStats.objects.get(chai_variety=self.chai)
+        self.assertEqual((stats.review_count, stats.rating_sum), (2, 8))
+
+        out, err = StringIO(), StringIO()
+        call_command('export_data', 'reviews', '--format', 'ndjson', stdout=out, stderr=err)
+        exported = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(sorted(row['review_text'] for row in exported), ["Goa", "Pune"])
+        watermark = err.getvalue().split()[-1]
+        self.assertEqual(watermark, 'branch_goa:1,branch_pune:1')
+        out = StringIO()
+        with override_settings(EXPORT_RESCAN_IDS=0):
+            call_command('export_data', 'reviews', '--format', 'ndjson', '--since', watermark, stdout=out, stderr=err)
+        self.assertEqual(out.getvalue(), '')
+
+        job = BackgroundJob.objects.create(kind='delete_reviews', params={'user_ids': [self.regular.pk]}, total=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            run_job(job.pk)
+        review_aggregates.flush()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (BackgroundJob.STATUS_DONE, 2))
+        self.assertFalse(any(ChaiReview.all_branches.using(alias).exists() for alias in self.branch_databases))
+        self.chai.refresh_from_db()
+        self.assertEqual((self.chai.rating_count, self.chai.rating_sum), (0, 0))
+
+
+
+class CollectingHandler(logging.Handler):
+    """Keeps every record it handles, formatted, for assertions"""
+
+    def __init__(self, formatter=None):
+        super().__init__()
+        self.setFormatter(formatter or logging.Formatter('%(message)s'))
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class QueuedLoggingTests(TestCase):
+    """Records go through the queue to the real handlers, tagged with their request and sampled by level"""
+
+    def queue(self, formatter=None, filters=()):
+        target = CollectingHandler(formatter)
+        handler = QueueListenerHandler(targets=[target])
+        for log_filter in filters:
+            handler.addFilter(log_filter)
+        self.addCleanup(handler.close)
+        return handler, target
+
+    def test_records_reach_the_targets_from_the_listener_thread(self):
+        handler, target = self.queue()
+        logger = logging.getLogger('chai.tests.queue')
+        self.enterContext(mock.patch.object(logger, 'handlers', [handler]))
+        self.enterContext(mock.patch.object(logger, 'propagate', False))
+        args = ['first']
+        logger.warning("Queued %s", args)
+        # The message is rendered when logged, not when the listener gets to it
+        args.append('second')
+        handler.stop()
+        self.assertEqual(target.lines, ["Queued ['first']"])
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = QueueListenerHandler(targets=[CollectingHandler()], maxsize=1)
+        for _ in range(3):
+            handler.enqueue(logging.makeLogRecord({'msg': 'busy'}))
+        self.assertEqual(handler.dropped, 2)
+
+    def test_json_lines_carry_the_request_context(self):
+        handler, target = self.queue(JsonFormatter(), [RequestContextFilter()])
+        self.enterContext(mock.patch.object(logging.getLogger('chai'), 'handlers', [handler]))
+        response = self.client.get(reverse('all_chai'), HTTP_X_REQUEST_ID='req-42')
+        self.assertEqual(response['X-Request-ID'], 'req-42')
+        handler.stop()
+        [line] = [json.loads(line) for line in target.lines if json.loads(line)['logger'] == 'chai.request']
+        self.assertEqual(
+            {key: line[key] for key in ('level', 'message', 'request_id', 'view', 'method', 'status')},
+            {'level': 'INFO', 'message': f"GET {reverse('all_chai')} 200", 'request_id': 'req-42',
+             'view': 'all_chai', 'method': 'GET', 'status': 200},
+        )
+        self.assertIsInstance(line['elapsed_ms'], float)
+
+    def test_sampling_drops_info_but_never_warnings(self):
+        sample = SampleFilter(rate=0, level='INFO')
+        for levelno, kept in ((logging.DEBUG, False), (logging.INFO, False), (logging.WARNING, True), (logging.ERROR, True)):
+            for request_id in (None, 'req-1'):
+                record = logging.makeLogRecord({'levelno': levelno, 'request_id': request_id})
+                self.assertEqual(sample.filter(record), kept, (levelno, request_id))
+        # A sampled request keeps every one of its records
+        sample = SampleFilter(rate=0.5, level='INFO')
+        decisions = {sample.filter(logging.makeLogRecord({'levelno': logging.INFO, 'request_id': 'req-7'})) for _ in range(20)}
+        self.assertEqual(len(decisions), 1)
+
+
+def load_settings(**env):
+    """Evaluate the project's settings module afresh with ``env`` in the environment"""
+    from chaiaurDjango import settings as project_settings
+
+    with mock.patch.dict(os.environ, env):
+        return runpy.run_path(project_settings.__file__)
+
+
+class TemplateCachingTests(TestCase):
+    """Chai cards come from the fragment cache until the chai changes, and templates are compiled once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.chais = ChaiVariety.objects.bulk_create([
+            ChaiVariety(name=f"Chai {i}", image='chais/medium_masala.jpeg', chai_type='ML', price=40) for i in range(3)
+        ])
+
+    def setUp(self):
+        cache.clear()
+
+    def card_queries(self):
+        """Render the listing; return how many of its queries came from the cards"""
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('all_chai')).status_code, 200)
+        return sum('"chai_favorite"' in query['sql'] for query in queries.captured_queries)
+
+    def test_second_render_issues_no_card_queries(self):
+        self.assertEqual(self.card_queries(), len(self.chais))
+        self.assertEqual(self.card_queries(), 0)
+
+    def test_updating_a_chai_rerenders_its_card(self):
+        self.assertContains(self.client.get(reverse('all_chai')), "Chai 0")
+        ChaiVariety.objects.filter(pk=self.chais[0].pk).update(name="Renamed")
+        # Same version, so the cached card still stands
+        self.assertContains(self.client.get(reverse('all_chai')), "Chai 0")
+        ChaiVariety.objects.filter(pk=self.chais[0].pk).update(updated=timezone.now())
+        response = self.client.get(reverse('all_chai'))
+        self.assertContains(response, "Renamed")
+        self.assertNotContains(response, "Chai 0")
+
+    def test_templates_are_read_once_per_process(self):
+        self.assertIsInstance(engines['django'].engine.template_loaders[0], cached.Loader)
+        self.client.get(reverse('all_chai'))
+        with mock.patch.object(filesystem.Loader, 'get_contents', side_effect=AssertionError("template re-read")):
+            self.assertEqual(self.client.get(reverse('all_chai')).status_code, 200)
+
+    def test_production_settings_use_the_cached_loader(self):
+        [(loader, _)] = load_settings(DEBUG='False')['TEMPLATES'][0]['OPTIONS']['loaders']
+        self.assertEqual(loader, 'django.template.loaders.cached.Loader')
+
+
+class StartupImportTests(SimpleTestCase):
+    """Production settings and model imports leave out what only development or image work needs"""
+
+    def test_dev_tools_are_left_out_when_off(self):
+        production = load_settings(DEBUG='False', DEV_TOOLS='False')
+        self.assertFalse({'tailwind', 'django_browser_reload'} & set(production['INSTALLED_APPS']))
+        self.assertFalse([name for name in production['MIDDLEWARE'] if 'browser_reload' in name])
+        building = load_settings(DEBUG='False', DEV_TOOLS='True')
+        self.assertIn('tailwind', building['INSTALLED_APPS'])
+
+    def test_models_import_without_pillow(self):
+        # A fresh interpreter, since this one has imported Pillow for other tests
+        script = (
+            "import sys, django; django.setup(); import chai.models; "
+            "sys.exit('PIL' in sys.modules or 'django_browser_reload' in sys.modules)"
+        )
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': 'chaiaurDjango.settings', 'DEBUG': 'False', 'DEV_TOOLS': 'False'}
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
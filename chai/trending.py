@@ -0,0 +1,191 @@
+"""Time-decayed trending scores for chais and stores.
+
+An event of weight ``w`` at time ``t`` is worth ``w * 2 ** -((now - t) / h)``
+now, where ``h`` is TRENDING_HALF_LIFE_HOURS. Times are measured in
+half-lives since TRENDING_EPOCH. Each row keeps its decayed activity as a
+pair: ``trending_weight``, the sum of its events' worth at
+``trending_time``, the time of its latest event. An event is folded in with
+an UPDATE: whichever of the row and the event is older is decayed to the
+other's time before adding. Only decay factors of at most 1 are ever
+computed, so nothing grows with time or overflows however long the site
+runs.
+
+Rows decayed to different times can't be compared by weight, so each row
+also keeps ``trending_score = log2(trending_weight) + trending_time``. A row's
+current score is ``2 ** (trending_score - now)``; that factor is the same for
+every row, so ordering by the indexed column ranks by current score. Rows
+without activity have no score.
+
+Events don't touch the row inside the write that caused them. Once that
+write commits they go to ``trending_events``, a write-behind buffer like
+the review counters' (chai.aggregates): events for the same row are folded
+together in memory and each flush writes every pending row of a model in
+one UPDATE. Deleting a review, favorite or rating subtracts exactly what it
+added.
+``rebuild_scores`` recomputes every score from the events; run it
+(``python manage.py rebuild_trending``) after changing the half-life or
+the epoch.
+"""
+import atexit
+import math
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Greatest, Log, Power
+from django.db.models.lookups import GreaterThan
+from django.utils import timezone
+
+from .aggregates import AggregateBuffer
+from .branches import branch_databases
+from .models import ChaiReview, ChaiVariety, Favorite, Store, StoreRating
+
+REVIEW_WEIGHT = 3.0
+FAVORITE_WEIGHT = 2.0
+STORE_RATING_WEIGHT = 1.0
+# Weight left over once every event has been taken back, give or take rounding
+EMPTY_WEIGHT = 1e-9
+
+
+def half_lives_since_epoch(when):
+    epoch = datetime.fromisoformat(settings.TRENDING_EPOCH)
+    if timezone.is_naive(epoch):
+        epoch = epoch.replace(tzinfo=dt_timezone.utc)
+    return (when - epoch).total_seconds() / (settings.TRENDING_HALF_LIFE_HOURS * 3600)
+
+
+def combine(weight, time, event_weight, event_time):
+    """Fold an event into a ``(weight, time)`` pair; returns the new pair"""
+    latest = max(time, event_time)
+    return weight * 2.0 ** (time - latest) + event_weight * 2.0 ** (event_time - latest), latest
+
+
+def log_score(weight, time):
+    """The indexed ``trending_score`` of a pair, or None without activity"""
+    return math.log2(weight) + time if weight > EMPTY_WEIGHT else None
+
+
+def current_score(stored, now=None):
+    """A stored ``trending_score`` as the row's decayed activity at ``now``"""
+    if stored is None:
+        return 0.0
+    return 2.0 ** (stored - half_lives_since_epoch(now or timezone.now()))
+
+
+def pair_update(event_weight, event_time):
+    """UPDATE values folding an event into each row's pair, as ``combine`` does.
+
+    ``event_weight`` may be an expression, to fold a different weight into
+    each row at the same ``event_time``.
+    """
+    if not hasattr(event_weight, 'resolve_expression'):
+        event_weight = Value(event_weight)
+    time = Greatest(F('trending_time'), Value(event_time))
+    weight = (
+        F('trending_weight') * Power(Value(2.0), F('trending_time') - time)
+        + event_weight * Power(Value(2.0), Value(event_time) - time)
+    )
+    # Every expression reads the row as it was before the UPDATE. Rounding
+    # noise left in the weight after a take-back is harmless: it has no score
+    return {
+        'trending_weight': weight,
+        'trending_time': time,
+        'trending_score': Case(
+            When(GreaterThan(weight, Value(EMPTY_WEIGHT)), then=Log(Value(2.0), weight) + time), default=None,
+        ),
+    }
+
+
+class TrendingBuffer(AggregateBuffer):
+    """Collects trending events per row and folds them in with one UPDATE per model"""
+
+    def add(self, model, pk, weight, when, using=None):
+        """Record an event (or, with a negative weight, take one back) for ``model`` row ``pk``
+
+        ``using`` names the database holding the row, for stores kept in a
+        branch database; by default it's ``default``.
+        """
+        self._record((model, using or DEFAULT_DB_ALIAS, pk), (weight, half_lives_since_epoch(when)))
+
+    def _merge(self, key, delta):
+        self._pending[key] = combine(*self._pending.get(key, (0.0, delta[1])), *delta)
+        self._events += 1
+
+    def _is_empty(self, delta):
+        return delta[0] == 0
+
+    def _apply(self, pending):
+        by_model = {}
+        for (model, using, pk), pair in pending.items():
+            by_model.setdefault((model, using), {})[pk] = pair
+        for (model, using), pairs in by_model.items():
+            # Decay every pending pair to the latest of them, so one event
+            # time serves the whole statement
+            latest = max(time for _, time in pairs.values())
+            weights = Case(
+                *[When(pk=pk, then=Value(weight * 2.0 ** (time - latest))) for pk, (weight, time) in pairs.items()],
+                default=Value(0.0), output_field=FloatField(),
+            )
+            model._base_manager.using(using).filter(pk__in=pairs).update(**pair_update(weights, latest))
+
+
+trending_events = TrendingBuffer()
+
+
+def trending(queryset, limit=10, now=None):
+    """The ``limit`` top-scoring rows of ``queryset``, each with ``current_trending_score`` set"""
+    rows = list(queryset.filter(trending_score__isnull=False).order_by('-trending_score', '-pk')[:limit])
+    for row in rows:
+        row.current_trending_score = current_score(row.trending_score, now)
+    return rows
+
+
+def _chai_events():
+    for alias in branch_databases():
+        yield from ((chai_id, REVIEW_WEIGHT, when) for chai_id, when in
+                    ChaiReview.all_branches.using(alias).values_list('chai_variety_id', 'date_added').iterator())
+    yield from ((chai_id, FAVORITE_WEIGHT, when) for chai_id, when in
+                Favorite.all_branches.using(DEFAULT_DB_ALIAS).values_list('chai_variety_id', 'date_added').iterator())
+
+
+def _store_events(alias):
+    return ((store_id, STORE_RATING_WEIGHT, when) for store_id, when in
+            StoreRating.all_branches.using(alias).values_list('store_id', 'date_added').iterator())
+
+
+def _rescore(model, events, alias, batch_size):
+    pairs = {}
+    for pk, weight, when in events:
+        pairs[pk] = combine(*pairs.get(pk, (0.0, 0.0)), weight, half_lives_since_epoch(when))
+    rows = [
+        model(pk=pk, trending_weight=weight, trending_time=time, trending_score=log_score(weight, time))
+        for pk, (weight, time) in pairs.items()
+    ]
+    rescored = model._base_manager.using(alias)
+    with transaction.atomic(using=alias):
+        rescored.exclude(trending_score=None).update(trending_weight=0, trending_time=0, trending_score=None)
+        rescored.bulk_update(rows, ['trending_weight', 'trending_time', 'trending_score'], batch_size=batch_size)
+    return len(rows)
+
+
+def rebuild_scores(batch_size=1000):
+    """Recompute every chai and store score from its events; returns the number of rows scored"""
+    # Buffered events are already in the tables; the rebuild supersedes them
+    trending_events.flush()
+    # Chais are shared, so their events are gathered from every database
+    scored = _rescore(ChaiVariety, _chai_events(), DEFAULT_DB_ALIAS, batch_size)
+    # Stores live with their branch, and so do their ratings
+    for alias in branch_databases():
+        scored += _rescore(Store, _store_events(alias), alias, batch_size)
+    return scored
+
+
+def _flush_at_exit():
+    try:
+        trending_events.flush()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
@@ -6,10 +6,22 @@ urlpatterns = [
     path('', views.all_chai, name='all_chai'),
     path('<int:chai_id>/', views.chai_detail, name='chai_detail'),
     path('<int:chai_id>/favorite/', views.add_favorite, name='add_favorite'),
+    path('<int:chai_id>/reviews/', views.submit_review, name='submit_review'),
+    path('reviews/<int:review_id>/comments/', views.review_comments, name='review_comments'),
+    path('comments/<int:comment_id>/helpful/', views.vote_comment_helpful, name='vote_comment_helpful'),
     path('chai_stores/', views.chai_store_view, name='chai_stores'),
     path('stores/<int:store_id>/', views.store_detail, name='store_detail'),
+    path('stores/availability/', views.store_availability, name='store_availability'),
+    path('api/inventory/stock/', views.pos_stock_update, name='pos_stock_update'),
+    path('api/orders/', views.pos_orders, name='pos_orders'),
+    path('api/v1/<slug:resource>/', views.api_list, name='api_list'),
+    path('api/v1/<slug:resource>/<int:pk>/', views.api_detail, name='api_detail'),
     path('top-rated/', views.top_rated_chais, name='top_rated'),
+    path('trending/', views.trending_view, name='trending'),
     path('recently-added/', views.recently_added_chais, name='recently_added'),
     path('my-favorites/', views.user_favorites, name='user_favorites'),
     path('my-reviews/', views.user_reviews, name='user_reviews'),
+    path('my-activity/', views.user_activity, name='user_activity'),
+    path('certificates/verify/<str:number>/', views.verify_certificate_view, name='verify_certificate'),
+    path('export/<slug:dataset>.<slug:fmt>', views.export_data, name='export_data'),
 ]
\ No newline at end of file
@@ -1,13 +1,42 @@
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import render, get_object_or_404, redirect
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Q, Avg, Count
+from django.db import DatabaseError
+from django.db.models import Q, Avg, Count, F
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_POST, require_safe
+from django.utils import timezone
 from decimal import Decimal
 from .models import ChaiVariety, Store, ChaiReview, Favorite, ReviewComment, StoreRating
 from .forms import ChaiVarietyForm, ChaiReviewForm, ReviewCommentForm, StoreRatingForm, ChaiFilterForm
+from .api import (
+    RESOURCES, ApiError, fetch_ids, fetch_one, fetch_page, ids_version, page_version, parse_fields, parse_ids,
+    parse_limit, row_version,
+)
+from .auth import bearer_token_required
+from .branches import current_branch
+from .certificates import verify_certificate
+from .conditional import conditional_page, catalogue_validator, chai_validator, make_etag, store_validator
+from .exports import DATASETS, FORMATS, export_watermark, format_watermark, parse_since, stream_export
+from .inventory import MATCH_ALL, MATCH_ANY, apply_stock_updates, find_stores
+from .orders import ingest_orders
+from .pagination import decode_cursor, keyset_page, merged_keyset_page
+from .ratelimit import TokenBucket, claim_fingerprint
+from .trending import trending
+from .votes import comments_for_review, helpful_counts, unvote, vote, voted_comment_ids
+
+HISTORY_PAGE_SIZE = 20
+AVAILABILITY_MAX_CHAIS = 100
 
+@conditional_page(catalogue_validator)
 def all_chai(request):
     """Display all chai varieties with pagination, search, and filtering"""
     chais = ChaiVariety.objects.all()
@@ -37,13 +66,12 @@ def all_chai(request):
         elif price_range == '200+':
             chais = chais.filter(price__gte=200)
     
-    # Filter by minimum rating
+    # Filter by minimum rating, using the denormalized counters instead of a join
     min_rating = request.GET.get('min_rating')
     if min_rating:
         try:
             min_rating = int(min_rating)
-            # Annotate with average rating and filter
-            chais = chais.annotate(avg_rating=Avg('reviews__rating')).filter(avg_rating__gte=min_rating)
+            chais = chais.filter(rating_count__gt=0, rating_sum__gte=F('rating_count') * min_rating)
         except (ValueError, TypeError):
             pass
     
@@ -60,8 +88,8 @@ def all_chai(request):
     
     # Add ratings to chais
     for chai in page_obj.object_list:
-        chai.avg_rating = chai.get_average_rating()
-        chai.review_count = chai.get_review_count()
+        chai.avg_rating = chai.get_cached_average_rating()
+        chai.review_count = chai.rating_count
     
     context = {
         'page_obj': page_obj,
@@ -71,44 +99,35 @@ def all_chai(request):
     }
     return render(request, 'chai/all_chai.html', context)
 
+@conditional_page(chai_validator)
 def chai_detail(request, chai_id):
     """Display chai details with reviews and allow adding reviews"""
     chai = get_object_or_404(ChaiVariety, pk=chai_id)
-    reviews = chai.reviews.all()
+    
+    # Handle review submission (AJAX or POST)
+    if request.user.is_authenticated and request.method == 'POST':
+        if request.content_type == 'application/json':
+            data = _parse_json_body(request)
+            if data is None:
+                return JsonResponse({'success': False, 'error': 'Invalid JSON body'}, status=400)
+            return _create_review(request.user, chai, data)
+        review_form = ChaiReviewForm(request.POST)
+        if review_form.is_valid():
+            review = review_form.save(commit=False)
+            review.user = request.user
+            review.chai_variety = chai
+            review.save()
+            return redirect('chai_detail', chai_id=chai_id)
+    
+    reviews = chai.reviews.select_related('user')
     avg_rating = chai.get_average_rating()
     review_count = chai.get_review_count()
     favorite_count = chai.get_favorite_count()
     
-    # Check if user has favorited this chai
+    # Check if user has favorited this chai, at whichever branch they did it
     is_favorite = False
     if request.user.is_authenticated:
-        is_favorite = Favorite.objects.filter(user=request.user, chai_variety=chai).exists()
-    
-    # Handle review submission (AJAX or POST)
-    if request.user.is_authenticated and request.method == 'POST':
-        try:
-            import json
-            if request.content_type == 'application/json':
-                data = json.loads(request.body)
-                review = ChaiReview(
-                    user=request.user,
-                    chai_variety=chai,
-                    rating=data.get('rating'),
-                    review_text=data.get('review_text')
-                )
-                review.full_clean()
-                review.save()
-                return JsonResponse({'success': True, 'message': 'Review posted successfully!'})
-            else:
-                review_form = ChaiReviewForm(request.POST)
-                if review_form.is_valid():
-                    review = review_form.save(commit=False)
-                    review.user = request.user
-                    review.chai_variety = chai
-                    review.save()
-                    return redirect('chai_detail', chai_id=chai_id)
-        except Exception as e:
-            return JsonResponse({'success': False, 'error': str(e)}, status=400)
+        is_favorite = Favorite.all_branches.filter(user=request.user, chai_variety=chai).exists()
     
     context = {
         'chai': chai,
@@ -120,6 +139,65 @@ def chai_detail(request, chai_id):
     }
     return render(request, 'chai/chai_detail.html', context)
 
+def _parse_json_body(request):
+    """Return the decoded JSON object in the request body, or None if it isn't one"""
+    try:
+        data = json.loads(request.body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    return data if isinstance(data, dict) else None
+
+def _review_rate_limiter():
+    return TokenBucket(
+        'review',
+        capacity=settings.REVIEW_RATE_LIMIT_BURST,
+        rate=1 / settings.REVIEW_RATE_LIMIT_SECONDS,
+    )
+
+def _create_review(user, chai, data):
+    """Validate, dedupe, throttle and save a review submitted as JSON"""
+    form = ChaiReviewForm(data)
+    if not form.is_valid():
+        errors = form.errors.get_json_data()
+        first_error = next(iter(errors.values()))[0]['message']
+        return JsonResponse({'success': False, 'error': first_error, 'errors': errors}, status=400)
+    
+    # Same user, same chai, same text (ignoring case and spacing) is a duplicate
+    text = ' '.join(form.cleaned_data['review_text'].lower().split())
+    claimed, fingerprint = claim_fingerprint('review', f"{user.pk}:{chai.pk}:{text}", settings.REVIEW_DEDUPE_SECONDS)
+    if not claimed:
+        return JsonResponse({'success': False, 'error': 'You already posted this review.'}, status=409)
+    
+    # Only reviews that would be saved spend a token; a fixed typo can be resent
+    allowed, retry_after = _review_rate_limiter().consume(user.pk)
+    if not allowed:
+        cache.delete(fingerprint)
+        response = JsonResponse({'success': False, 'error': 'You are posting reviews too quickly. Please wait a moment.'}, status=429)
+        response['Retry-After'] = str(math.ceil(retry_after))
+        return response
+    
+    review = form.save(commit=False)
+    review.user = user
+    review.chai_variety = chai
+    try:
+        review.save()
+    except DatabaseError:
+        cache.delete(fingerprint)
+        raise
+    return JsonResponse({'success': True, 'message': 'Review posted successfully!', 'review_id': review.pk}, status=201)
+
+@require_POST
+def submit_review(request, chai_id):
+    """Accept a JSON review with per-user rate limiting and duplicate suppression"""
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+    
+    chai = get_object_or_404(ChaiVariety.objects.only('id'), pk=chai_id)
+    data = _parse_json_body(request)
+    if data is None:
+        return JsonResponse({'success': False, 'error': 'Invalid JSON body'}, status=400)
+    return _create_review(request.user, chai, data)
+
 @require_POST
 def add_favorite(request, chai_id):
     """Add/remove chai from user's favorites (AJAX)"""
@@ -127,7 +205,7 @@ def add_favorite(request, chai_id):
         return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
     
     chai = get_object_or_404(ChaiVariety, pk=chai_id)
-    favorite, created = Favorite.objects.get_or_create(user=request.user, chai_variety=chai)
+    favorite, created = Favorite.all_branches.get_or_create(user=request.user, chai_variety=chai)
     
     if not created:
         favorite.delete()
@@ -142,6 +220,33 @@ def add_favorite(request, chai_id):
         'favorite_count': chai.get_favorite_count()
     })
 
+def review_comments(request, review_id):
+    """Comments on a review with helpful counts, helpful-first unless ?order=newest (JSON)"""
+    review = get_object_or_404(ChaiReview.objects.only('pk'), pk=review_id)
+    order = 'newest' if request.GET.get('order') == 'newest' else 'helpful'
+    comments = comments_for_review(review.pk, order)
+    voted = voted_comment_ids(request.user, [comment['id'] for comment in comments])
+    for comment in comments:
+        comment['voted'] = comment['id'] in voted
+    return JsonResponse({'success': True, 'order': order, 'comments': comments})
+
+@require_POST
+def vote_comment_helpful(request, comment_id):
+    """Mark/unmark a review comment as helpful (AJAX)"""
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+
+    comment = get_object_or_404(ReviewComment.objects.only('pk'), pk=comment_id)
+    voted = vote(request.user, comment.pk)
+    if not voted:
+        unvote(request.user, comment.pk)
+
+    return JsonResponse({
+        'success': True,
+        'voted': voted,
+        'helpful_count': helpful_counts([comment.pk])[comment.pk],
+    })
+
 def top_rated_chais(request):
     """Display top-rated chai varieties"""
     chais = ChaiVariety.objects.annotate(
@@ -154,6 +259,15 @@ def top_rated_chais(request):
     context = {'chais': chais, 'title': 'Top Rated Chais'}
     return render(request, 'chai/top_rated.html', context)
 
+def trending_view(request):
+    """Chais and stores with the most review, favorite and rating activity lately"""
+    context = {
+        'chais': trending(ChaiVariety.objects.all()),
+        'stores': trending(Store.objects.all()),
+        'title': 'Trending',
+    }
+    return render(request, 'chai/trending.html', context)
+
 def recently_added_chais(request):
     """Display recently added chai varieties"""
     chais = ChaiVariety.objects.order_by('-date_added')[:10]
@@ -161,18 +275,13 @@ def recently_added_chais(request):
     return render(request, 'chai/recently_added.html', context)
 
 def chai_store_view(request):
-    """Find stores that sell selected chai variety with ratings"""
+    """Find stores that sell selected chai variety, with their prices"""
     stores = None
     if request.method == 'POST':
         form = ChaiVarietyForm(request.POST)
         if form.is_valid():
             chai_variety = form.cleaned_data['chai_variety']
-            stores = Store.objects.filter(chai_varieties=chai_variety).prefetch_related('chai_varieties')
-            
-            # Add ratings to stores
-            for store in stores:
-                store.avg_rating = store.get_average_rating()
-                store.rating_count = store.get_rating_count()
+            stores = find_stores([chai_variety.pk])
     else:
         form = ChaiVarietyForm()
 
@@ -182,16 +291,83 @@ def chai_store_view(request):
     }
     return render(request, 'chai/chai_stores.html', context)
 
+def store_availability(request):
+    """Stores carrying all (or any) of the requested chais, with prices (JSON)"""
+    match = request.GET.get('match', MATCH_ALL)
+    if match not in (MATCH_ALL, MATCH_ANY):
+        return JsonResponse({'success': False, 'error': "match must be 'all' or 'any'"}, status=400)
+    try:
+        chai_ids = {int(value) for value in request.GET.get('chais', '').split(',') if value.strip()}
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'chais must be a comma-separated list of ids'}, status=400)
+    if not chai_ids or len(chai_ids) > AVAILABILITY_MAX_CHAIS:
+        return JsonResponse(
+            {'success': False, 'error': f"Ask for between 1 and {AVAILABILITY_MAX_CHAIS} chais"}, status=400,
+        )
+
+    stores = find_stores(chai_ids, match)
+    for store in stores:
+        for item in store['items']:
+            item['price'] = str(item['price'])
+    return JsonResponse({'success': True, 'match': match, 'chais': sorted(chai_ids), 'stores': stores})
+
+@require_POST
+@bearer_token_required
+def pos_stock_update(request):
+    """Bulk stock, price and availability sync for store POS systems (JSON)"""
+    data = _parse_json_body(request)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return JsonResponse({'success': False, 'error': "Body must be an object with an 'items' list"}, status=400)
+    if len(items) > settings.POS_SYNC_MAX_ITEMS:
+        return JsonResponse(
+            {'success': False, 'error': f"At most {settings.POS_SYNC_MAX_ITEMS} items per call"}, status=413,
+        )
+
+    updated, unknown, errors = apply_stock_updates(items, store_ids=request.pos_store_ids)
+    if errors:
+        return JsonResponse({'success': False, 'errors': {str(index): message for index, message in errors.items()}}, status=400)
+    return JsonResponse({
+        'success': True,
+        'updated': updated,
+        'unknown': [{'store': store_id, 'chai': chai_id} for store_id, chai_id in unknown],
+    })
+
+@require_POST
+@bearer_token_required
+def pos_orders(request):
+    """Batched order ingestion for store POS systems (JSON)"""
+    data = _parse_json_body(request)
+    orders = data.get('orders') if isinstance(data, dict) else None
+    if not isinstance(orders, list):
+        return JsonResponse({'success': False, 'error': "Body must be an object with an 'orders' list"}, status=400)
+    if len(orders) > settings.ORDER_BATCH_MAX_ORDERS:
+        return JsonResponse(
+            {'success': False, 'error': f"At most {settings.ORDER_BATCH_MAX_ORDERS} orders per call"}, status=413,
+        )
+
+    created, duplicates, rejected = ingest_orders(orders, store_ids=request.pos_store_ids)
+    return JsonResponse({
+        'success': not rejected,
+        'created': created,
+        'duplicates': [{'store': store_id, 'id': external_id} for store_id, external_id in duplicates],
+        'rejected': {str(index): message for index, message in sorted(rejected.items())},
+    })
+
+@conditional_page(store_validator)
 def store_detail(request, store_id):
     """Display store details with ratings"""
     store = get_object_or_404(Store, pk=store_id)
-    ratings = store.ratings.all()
+    ratings = store.ratings.select_related('user')
     avg_rating = store.get_average_rating()
     rating_count = store.get_rating_count()
+    user_rating = None
+    if request.user.is_authenticated:
+        user_rating = store.ratings.filter(user=request.user).values_list('rating', flat=True).first()
     
-    # Handle rating submission
+    # Handle rating submission; one rating per user and store
     rating_form = None
-    if request.user.is_authenticated:
+    if request.user.is_authenticated and user_rating is None:
         if request.method == 'POST':
             rating_form = StoreRatingForm(request.POST)
             if rating_form.is_valid():
@@ -205,23 +381,147 @@ def store_detail(request, store_id):
     
     context = {
         'store': store,
+        'inventory': store.inventory.filter(is_available=True).select_related('chai_variety').order_by('chai_variety__name'),
         'ratings': ratings,
         'avg_rating': avg_rating,
         'rating_count': rating_count,
         'rating_form': rating_form,
+        'user_rating': user_rating,
     }
     return render(request, 'chai/store_detail.html', context)
 
 @login_required(login_url='login')
 def user_favorites(request):
-    """Display user's favorite chais"""
+    """Display user's favorite chais, newest first, one keyset page at a time"""
     favorites = Favorite.objects.filter(user=request.user).select_related('chai_variety')
-    context = {'favorites': favorites}
+    page = keyset_page(favorites, decode_cursor(request.GET.get('cursor')), HISTORY_PAGE_SIZE)
+    context = {'favorites': page.object_list, 'page': page}
     return render(request, 'chai/favorites.html', context)
 
 @login_required(login_url='login')
 def user_reviews(request):
-    """Display user's chai reviews"""
+    """Display user's chai reviews, newest first, one keyset page at a time"""
     reviews = ChaiReview.objects.filter(user=request.user).select_related('chai_variety')
-    context = {'reviews': reviews}
+    page = keyset_page(reviews, decode_cursor(request.GET.get('cursor')), HISTORY_PAGE_SIZE)
+    context = {'reviews': page.object_list, 'page': page}
     return render(request, 'chai/user_reviews.html', context)
+
+@login_required(login_url='login')
+def user_activity(request):
+    """Display a merged timeline of the user's reviews, favorites, store ratings and comments"""
+    user = request.user
+    sources = [
+        ('review', ChaiReview.objects.filter(user=user).select_related('chai_variety')),
+        ('favorite', Favorite.objects.filter(user=user).select_related('chai_variety')),
+        ('store_rating', StoreRating.objects.filter(user=user).select_related('store')),
+        ('comment', ReviewComment.objects.filter(user=user).select_related('review__chai_variety')),
+    ]
+    page = merged_keyset_page(sources, decode_cursor(request.GET.get('cursor')), HISTORY_PAGE_SIZE)
+    context = {'entries': page.object_list, 'page': page}
+    return render(request, 'chai/user_activity.html', context)
+
+@staff_member_required
+def export_data(request, dataset, fmt):
+    """Stream reviews or store ratings as CSV/NDJSON, optionally only rows after an id watermark"""
+    if dataset not in DATASETS or fmt not in FORMATS:
+        raise Http404("Unknown export")
+
+    since = None
+    if request.GET.get('since'):
+        since = parse_since(request.GET['since'])
+        if since is None:
+            return JsonResponse({'success': False, 'error': 'since must be a watermark from a previous export'}, status=400)
+
+    # Pin the upper bound up front so the export is a consistent slice and the
+    # caller can pass it back as ``since`` next time
+    # The rows are read after BranchMiddleware has returned, so the branch is passed along
+    branch = current_branch()
+    until = export_watermark(dataset, branch)
+    response = StreamingHttpResponse(stream_export(dataset, fmt, since, until, branch), content_type=FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{dataset}.{fmt}"'
+    if until:
+        response['X-Export-Watermark'] = format_watermark(until)
+    return response
+
+def _api_response(request, version, fetch):
+    """Compact JSON from ``fetch()``, or 304 when the client's ETag still matches.
+
+    ``version()`` reads only the version columns, so a client that already has
+    the response costs that one narrow query. ``fetch()`` returns ``(payload,
+    version)``, the version taken from the rows it read, so unconditional
+    requests stay at a single query. A None payload is a 404.
+    """
+    def etag(parts):
+        return quote_etag(make_etag(request, (request.path, *parts)))
+
+    if 'If-None-Match' in request.headers:
+        parts = version()
+        response = get_conditional_response(request, etag=etag(parts)) if parts is not None else None
+        if response is not None:
+            patch_cache_control(response, public=True, max_age=0)
+            return response
+    payload, parts = fetch()
+    if payload is None:
+        return JsonResponse({'success': False, 'error': 'Not found'}, status=404)
+    response = JsonResponse(payload, json_dumps_params={'separators': (',', ':')})
+    response['ETag'] = etag(parts)
+    patch_cache_control(response, public=True, max_age=0)
+    return response
+
+@require_safe
+def api_list(request, resource):
+    """API v1: a keyset page of a resource, or a batch of it by ?ids= (JSON)"""
+    if resource not in RESOURCES:
+        raise Http404("Unknown resource")
+
+    def batch():
+        rows, missing, version = fetch_ids(resource, ids, fields, request.GET)
+        return {'data': rows, 'missing': missing}, version
+
+    def page():
+        rows, next_cursor, version = fetch_page(resource, fields, request.GET, cursor, limit)
+        return {'data': rows, 'next': next_cursor}, version
+
+    try:
+        fields = parse_fields(resource, request.GET.get('fields'))
+        if request.GET.get('ids'):
+            ids = parse_ids(request.GET['ids'])
+            return _api_response(request, lambda: ids_version(resource, ids, request.GET), batch)
+        cursor = decode_cursor(request.GET.get('cursor'))
+        if request.GET.get('cursor') and cursor is None:
+            raise ApiError("Invalid cursor")
+        limit = parse_limit(request.GET.get('limit'))
+        return _api_response(request, lambda: page_version(resource, request.GET, cursor, limit), page)
+    except ApiError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+@require_safe
+def api_detail(request, resource, pk):
+    """API v1: one object of a resource (JSON)"""
+    if resource not in RESOURCES:
+        raise Http404("Unknown resource")
+
+    def one():
+        row, version = fetch_one(resource, pk, fields)
+        return ({'data': row} if row is not None else None), version
+
+    try:
+        fields = parse_fields(resource, request.GET.get('fields'))
+    except ApiError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    return _api_response(request, lambda: row_version(resource, pk), one)
+
+def verify_certificate_view(request, number):
+    """Public certificate check; unknown numbers are rejected without searching the certificate table"""
+    certificate = verify_certificate(number)
+    if certificate is None:
+        return JsonResponse({'valid': False, 'error': 'Certificate not found'}, status=404)
+    return JsonResponse({
+        'valid': certificate.valid_until > timezone.now(),
+        'status': certificate.status,
+        'certificate_number': certificate.certificate_number,
+        'holder': certificate.user.get_full_name() or certificate.user.username,
+        'chai': certificate.chai_variety.name,
+        'date_issued': certificate.date_issued.isoformat(),
+        'valid_until': certificate.valid_until.isoformat(),
+    })
@@ -0,0 +1,152 @@
+"""Helpful votes on review comments.
+
+``CommentVote`` holds one row per user and comment, so nobody can vote
+twice. The count itself is not a single hot row. Each vote adds 1 to one of
+COMMENT_VOTE_SHARDS counter rows for the comment, picked at random, so voters
+on a popular comment spread over N row locks instead of queueing on one. The
+total is ``ReviewComment.is_helpful`` plus the sum of the shards. Totals are
+cached per comment, and each vote drops the cached total once it commits.
+A read that sums the shards just before a vote commits can still cache a
+total that misses it; the next vote on the comment drops that total, where
+incrementing it in place would have carried the error along until
+COMMENT_VOTE_CACHE_SECONDS.
+
+``compact_votes`` periodically folds the shards back into ``is_helpful``. It
+subtracts exactly what it read from each shard instead of zeroing it, so
+votes landing during compaction are not lost. Helpful-first ordering sorts on
+``is_helpful`` through the ``(review, -is_helpful, -date_added)`` index, so it
+reflects the last compaction; the counts shown are always current.
+"""
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import CommentVote, CommentVoteShard, ReviewComment
+
+
+def _count_key(comment_id):
+    return f"comment-votes:{comment_id}"
+
+
+def _add_to_shard(comment_id, delta):
+    shard = random.randrange(settings.COMMENT_VOTE_SHARDS)
+    shards = CommentVoteShard.objects.filter(comment_id=comment_id, shard=shard)
+    # Shard rows are created on first use and never deleted, so after warm-up this is one UPDATE
+    if not shards.update(count=F('count') + delta):
+        try:
+            with transaction.atomic():
+                CommentVoteShard.objects.create(comment_id=comment_id, shard=shard, count=delta)
+        except IntegrityError:
+            # Another vote created it first
+            shards.update(count=F('count') + delta)
+    # The next read sums the shards again
+    transaction.on_commit(lambda: cache.delete(_count_key(comment_id)))
+
+
+def vote(user, comment_id):
+    """Record ``user``'s helpful vote; returns False if they had already voted"""
+    try:
+        with transaction.atomic():
+            CommentVote.objects.create(user=user, comment_id=comment_id)
+            _add_to_shard(comment_id, 1)
+    except IntegrityError:
+        return False
+    return True
+
+
+def unvote(user, comment_id):
+    """Withdraw ``user``'s vote; returns False if there was none"""
+    with transaction.atomic():
+        deleted, _ = CommentVote.objects.filter(user=user, comment_id=comment_id).delete()
+        if deleted:
+            _add_to_shard(comment_id, -1)
+    return bool(deleted)
+
+
+def voted_comment_ids(user, comment_ids):
+    """The subset of ``comment_ids`` that ``user`` has voted helpful"""
+    if not user.is_authenticated:
+        return set()
+    return set(
+        CommentVote.objects.filter(user=user, comment_id__in=comment_ids).values_list('comment_id', flat=True)
+    )
+
+
+def helpful_counts(comment_ids):
+    """Current helpful vote totals for ``comment_ids`` as ``{id: count}``"""
+    keys = {comment_id: _count_key(comment_id) for comment_id in comment_ids}
+    cached = cache.get_many(keys.values())
+    counts = {comment_id: cached[key] for comment_id, key in keys.items() if key in cached}
+
+    missing = [comment_id for comment_id in keys if comment_id not in counts]
+    if missing:
+        rows = ReviewComment.objects.filter(pk__in=missing).values_list(
+            'pk', F('is_helpful') + Coalesce(Sum('vote_shards__count'), 0),
+        ).order_by()
+        fresh = dict(rows)
+        for comment_id, count in fresh.items():
+            cache.add(keys[comment_id], count, settings.COMMENT_VOTE_CACHE_SECONDS)
+        counts.update(fresh)
+    return counts
+
+
+def compact_votes(batch_size=500):
+    """Fold shard counts into ``ReviewComment.is_helpful``; returns the number of comments updated"""
+    compacted = 0
+    last_comment = 0
+    while True:
+        comment_ids = list(
+            CommentVoteShard.objects.filter(comment_id__gt=last_comment).exclude(count=0)
+            .order_by('comment_id').values_list('comment_id', flat=True).distinct()[:batch_size]
+        )
+        if not comment_ids:
+            break
+        last_comment = comment_ids[-1]
+        with transaction.atomic():
+            shards = list(
+                CommentVoteShard.objects.filter(comment_id__in=comment_ids).exclude(count=0)
+                .values_list('pk', 'comment_id', 'count')
+            )
+            totals = {}
+            for _, comment_id, count in shards:
+                totals[comment_id] = totals.get(comment_id, 0) + count
+            # Subtract what was read rather than zeroing; a vote that lands meanwhile stays in its shard
+            CommentVoteShard.objects.filter(pk__in=[pk for pk, _, _ in shards]).update(
+                count=F('count') - Case(
+                    *[When(pk=pk, then=Value(count)) for pk, _, count in shards],
+                    default=Value(0), output_field=IntegerField(),
+                ),
+            )
+            ReviewComment.objects.filter(pk__in=totals).update(
+                is_helpful=F('is_helpful') + Case(
+                    *[When(pk=comment_id, then=Value(total)) for comment_id, total in totals.items()],
+                    default=Value(0), output_field=IntegerField(),
+                ),
+            )
+        compacted += len(totals)
+    return compacted
+
+
+def comments_for_review(review_id, order='helpful', limit=50):
+    """Comments on a review with current helpful counts, helpful-first or newest-first"""
+    comments = ReviewComment.objects.filter(review_id=review_id)
+    if order == 'helpful':
+        comments = comments.order_by('-is_helpful', '-date_added')
+    else:
+        comments = comments.order_by('-date_added')
+    rows = list(comments.values('pk', 'user__username', 'comment_text', 'date_added')[:limit])
+    counts = helpful_counts([row['pk'] for row in rows])
+    return [
+        {
+            'id': row['pk'],
+            'user': row['user__username'],
+            'comment_text': row['comment_text'],
+            'date_added': row['date_added'],
+            'helpful': counts.get(row['pk'], 0),
+        }
+        for row in rows
+    ]
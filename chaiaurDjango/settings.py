@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 from decouple import config
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -39,9 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'chai',
-    'tailwind',
     'theme',
-    'django_browser_reload',
 ]
 
 TAILWIND_APP_NAME ='theme'
@@ -51,6 +50,7 @@ NPM_BIN_PATH = config('NPM_BIN_PATH', default=r"C:\Program Files\nodejs\npm.cmd"
 
 
 MIDDLEWARE = [
+    'chai.log.RequestLogMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,10 +58,18 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
-    'django_browser_reload.middleware.BrowserReloadMiddleware',
 ]
 
+# Development tooling (Tailwind's build commands and live browser reload) is
+# only installed when DEV_TOOLS is on, which defaults to DEBUG, so production
+# workers and management commands don't import it. Set DEV_TOOLS=True to run
+# `python manage.py tailwind build` in a production build step.
+DEV_TOOLS = config('DEV_TOOLS', default=DEBUG, cast=bool)
+
+if DEV_TOOLS:
+    INSTALLED_APPS += ['tailwind', 'django_browser_reload']
+    MIDDLEWARE += ['django_browser_reload.middleware.BrowserReloadMiddleware']
+
 ROOT_URLCONF = 'chaiaurDjango.urls'
 
 TEMPLATES = [
@@ -79,6 +87,16 @@ TEMPLATES = [
     },
 ]
 
+# Outside DEBUG, compile each template once per process and keep it in memory
+if not DEBUG:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'chaiaurDjango.wsgi.application'
 
 
@@ -92,6 +110,102 @@ DATABASES = {
     }
 }
 
+# Write-ahead logging lets readers carry on while POS batches are written and
+# syncs to disk at checkpoints rather than on every commit. The database then
+# keeps -wal and -shm files next to it.
+SQLITE_WAL = config('SQLITE_WAL', default=True, cast=bool)
+if SQLITE_WAL:
+    DATABASES['default']['OPTIONS'] = {
+        'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+    }
+
+# Read replicas, as a comma-separated list of SQLite files standing in for real
+# replicas locally (`python manage.py sync_replicas` copies the primary into
+# them). Reads are spread across replicas; writes, and a browser's reads for
+# READ_YOUR_WRITES_SECONDS after it writes, go to the primary.
+DATABASE_REPLICAS = config('DATABASE_REPLICAS', default='', cast=lambda v: [s.strip() for s in v.split(',') if s.strip()])
+READ_YOUR_WRITES_SECONDS = config('READ_YOUR_WRITES_SECONDS', default=10, cast=int)
+
+for _index, _replica in enumerate(DATABASE_REPLICAS, start=1):
+    DATABASES[f'replica{_index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / _replica,
+        # Tests read the primary's test database through the replica alias
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Branches of the chain (see chai/branches.py). Requests carrying BRANCH_HEADER
+# only see that branch's stores, ratings, reviews and favorites.
+# BRANCH_DATABASES gives branches their own SQLite file as comma-separated
+# slug=path pairs. For another engine, add a DATABASES['branch_<slug>'] entry.
+# Run `migrate --database=branch_<slug>` and `sync_branch_catalogue` for each one.
+BRANCH_HEADER = config('BRANCH_HEADER', default='X-Branch')
+BRANCH_DATABASES = config(
+    'BRANCH_DATABASES', default='',
+    cast=lambda v: dict(pair.strip().split('=', 1) for pair in v.split(',') if pair.strip()),
+)
+MIDDLEWARE.insert(MIDDLEWARE.index('django.contrib.auth.middleware.AuthenticationMiddleware'), 'chai.branches.BranchMiddleware')
+
+for _slug, _path in BRANCH_DATABASES.items():
+    DATABASES[f'branch_{_slug}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / _path,
+        'OPTIONS': DATABASES['default'].get('OPTIONS', {}),
+    }
+
+DATABASE_ROUTERS = []
+if any(alias.startswith('branch_') for alias in DATABASES):
+    DATABASE_ROUTERS.append('chai.branches.BranchRouter')
+
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS.append('chai.routers.PrimaryReplicaRouter')
+    MIDDLEWARE.insert(2, 'chai.routers.ReplicaStickinessMiddleware')
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='chai-default'),
+    }
+}
+
+
+# Sessions and the signed-in user
+# SESSION_PROFILE picks where sessions live: 'db' (a query on every request),
+# 'cached_db' (read from the cache, written through to the database) or
+# 'signed_cookies' (in the cookie itself: no storage, but sessions can't be
+# revoked server-side and the cookie grows with the session).
+# Caching sessions or users needs a cache every worker shares: with a
+# per-process cache, a logout, deactivation or password change only clears
+# the copy in the worker that handled it. Both default to off without one.
+SHARED_CACHE = not CACHES['default']['BACKEND'].endswith(('.LocMemCache', '.DummyCache'))
+SESSION_PROFILE = config('SESSION_PROFILE', default='cached_db' if SHARED_CACHE else 'db')
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+if SESSION_PROFILE not in SESSION_ENGINES:
+    raise ImproperlyConfigured(f"SESSION_PROFILE must be one of {', '.join(SESSION_ENGINES)}")
+SESSION_ENGINE = SESSION_ENGINES[SESSION_PROFILE]
+
+# The user row behind each session can be cached too (chai/auth.py).
+# ModelBackend stays listed so sessions started under it still resolve.
+USER_CACHE = config('USER_CACHE', default=SHARED_CACHE, cast=bool)
+USER_CACHE_SECONDS = config('USER_CACHE_SECONDS', default=300, cast=int)
+AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.ModelBackend']
+if USER_CACHE:
+    AUTHENTICATION_BACKENDS.insert(0, 'chai.auth.CachedUserBackend')
+
+# A single development server has only one process to keep in step
+if not SHARED_CACHE and not DEBUG and (SESSION_PROFILE == 'cached_db' or USER_CACHE):
+    raise ImproperlyConfigured(
+        "SESSION_PROFILE=cached_db and USER_CACHE need a shared CACHE_BACKEND such as Redis or Memcached"
+    )
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -131,6 +245,26 @@ STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 
+# With STATIC_FINGERPRINT on, collectstatic writes content-hashed file names
+# plus .gz (and .br, if the brotli package is installed) variants, and pages
+# link to the hashed names; run collectstatic before starting the server.
+# SERVE_STATIC makes Django serve STATIC_ROOT itself (chai/staticfiles.py)
+# when there's no front-end server doing it.
+STATIC_FINGERPRINT = config('STATIC_FINGERPRINT', default=False, cast=bool)
+SERVE_STATIC = config('SERVE_STATIC', default=False, cast=bool)
+# Cache lifetime for static files without a content hash in their name
+STATIC_MAX_AGE_SECONDS = config('STATIC_MAX_AGE_SECONDS', default=3600, cast=int)
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': (
+            'chai.staticfiles.CompressedManifestStaticFilesStorage' if STATIC_FINGERPRINT
+            else 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        ),
+    },
+}
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -139,8 +273,100 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Mixed into every page ETag; bump it when a deploy changes page templates so
+# browsers don't keep serving HTML rendered by the old ones
+PAGE_ETAG_VERSION = config('PAGE_ETAG_VERSION', default='1')
+
+# Review submission
+# Each user may post REVIEW_RATE_LIMIT_BURST reviews back to back, then one
+# every REVIEW_RATE_LIMIT_SECONDS. Identical reviews within
+# REVIEW_DEDUPE_SECONDS are rejected as duplicates.
+
+REVIEW_RATE_LIMIT_BURST = config('REVIEW_RATE_LIMIT_BURST', default=5, cast=int)
+REVIEW_RATE_LIMIT_SECONDS = config('REVIEW_RATE_LIMIT_SECONDS', default=30, cast=float)
+REVIEW_DEDUPE_SECONDS = config('REVIEW_DEDUPE_SECONDS', default=600, cast=int)
+
+# Review counters on ChaiVariety are written behind in batches of this many
+# events, or after this many seconds, whichever comes first.
+REVIEW_AGGREGATE_FLUSH_SIZE = config('REVIEW_AGGREGATE_FLUSH_SIZE', default=100, cast=int)
+REVIEW_AGGREGATE_FLUSH_SECONDS = config('REVIEW_AGGREGATE_FLUSH_SECONDS', default=2.0, cast=float)
+
+# Helpful votes on review comments are spread over this many counter rows per
+# comment and folded back by `python manage.py compact_comment_votes`.
+COMMENT_VOTE_SHARDS = config('COMMENT_VOTE_SHARDS', default=8, cast=int)
+COMMENT_VOTE_CACHE_SECONDS = config('COMMENT_VOTE_CACHE_SECONDS', default=60, cast=int)
+
+# Certificates
+# The key scrambles certificate numbers; never change it once certificates have
+# been issued or new numbers may collide with old ones.
+CERTIFICATE_NUMBER_KEY = config('CERTIFICATE_NUMBER_KEY', default='chai-aur-django-certificates')
+CERTIFICATE_FILTER_SECONDS = config('CERTIFICATE_FILTER_SECONDS', default=300, cast=int)
+# How long a process trusts its cached filter version before checking the
+# database; with a per-process cache, new certificates verify elsewhere after this
+CERTIFICATE_FILTER_VERSION_SECONDS = config('CERTIFICATE_FILTER_VERSION_SECONDS', default=5, cast=int)
+
+# Homepage snapshot (see chai/homepage.py)
+# Older snapshots are still served but trigger a background rebuild; rebuilds
+# start at most once per HOMEPAGE_SNAPSHOT_REBUILD_SECONDS.
+HOMEPAGE_SNAPSHOT_FRESH_SECONDS = config('HOMEPAGE_SNAPSHOT_FRESH_SECONDS', default=300, cast=int)
+HOMEPAGE_SNAPSHOT_REBUILD_SECONDS = config('HOMEPAGE_SNAPSHOT_REBUILD_SECONDS', default=30, cast=int)
+HOMEPAGE_SNAPSHOT_MAX_AGE_SECONDS = config('HOMEPAGE_SNAPSHOT_MAX_AGE_SECONDS', default=86400, cast=int)
+
+# Trending scores (see chai/trending.py); the epoch is any fixed date that times
+# are measured from. Run `python manage.py rebuild_trending` after changing either
+TRENDING_HALF_LIFE_HOURS = config('TRENDING_HALF_LIFE_HOURS', default=72, cast=float)
+TRENDING_EPOCH = config('TRENDING_EPOCH', default='2025-01-01')
+
+# Analytics rollups (see chai/analytics.py): recent days recomputed on every run
+# to catch rows that committed after a run had already seen higher ids
+ANALYTICS_RESCAN_DAYS = config('ANALYTICS_RESCAN_DAYS', default=2, cast=int)
+
+# Incremental exports (see chai/exports.py): ids below the previous watermark
+# sent again, to catch rows that committed after that export had read past them
+EXPORT_RESCAN_IDS = config('EXPORT_RESCAN_IDS', default=1000, cast=int)
+
+# Store POS sync
+# Bearer tokens accepted by the bulk stock update and order endpoints, each
+# limited to the stores it syncs: comma-separated "token:store_id|store_id"
+def pos_token_stores(value):
+    tokens = {}
+    for entry in filter(None, (s.strip() for s in value.split(','))):
+        token, _, stores = entry.partition(':')
+        try:
+            tokens[token.strip()] = frozenset(int(store) for store in stores.split('|'))
+        except ValueError:
+            raise ImproperlyConfigured('POS_API_TOKENS entries look like "token:store_id|store_id"')
+    return tokens
+
+
+POS_API_TOKENS = config('POS_API_TOKENS', default='', cast=pos_token_stores)
+POS_SYNC_MAX_ITEMS = config('POS_SYNC_MAX_ITEMS', default=5000, cast=int)
+
+# POS order ingestion (see chai/orders.py)
+ORDER_BATCH_MAX_ORDERS = config('ORDER_BATCH_MAX_ORDERS', default=2000, cast=int)
+ORDER_MAX_LINES = config('ORDER_MAX_LINES', default=50, cast=int)
+ORDER_PRICE_MAP_SECONDS = config('ORDER_PRICE_MAP_SECONDS', default=300, cast=int)
+
+# Background jobs for bulk admin actions
+# Jobs run on this many threads inside the web process; set it to 0 to leave
+# them queued for `python manage.py run_jobs` instead.
+BACKGROUND_JOB_THREADS = config('BACKGROUND_JOB_THREADS', default=2, cast=int)
+BACKGROUND_JOB_CHUNK_SIZE = config('BACKGROUND_JOB_CHUNK_SIZE', default=500, cast=int)
+# A running job that hasn't finished a chunk for this long is requeued by run_jobs
+BACKGROUND_JOB_STALE_SECONDS = config('BACKGROUND_JOB_STALE_SECONDS', default=600, cast=int)
+
 # Logging Configuration
 # https://docs.djangoproject.com/en/5.2/topics/logging/
+# Loggers write to the 'queue' handler, which hands records to a background
+# thread for the console and file handlers (see chai/log.py). The file gets one
+# JSON object per line. Only LOG_DEBUG_SAMPLE_RATE of requests keep their
+# DEBUG records.
+
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+# Console (stdout) output, which production log collectors read; raise it to
+# WARNING to quiet the per-request lines in development or test runs
+LOG_CONSOLE_LEVEL = config('LOG_CONSOLE_LEVEL', default='INFO')
+LOG_DEBUG_SAMPLE_RATE = config('LOG_DEBUG_SAMPLE_RATE', default=0.01, cast=float)
 
 LOGGING = {
     'version': 1,
@@ -154,6 +380,9 @@ LOGGING = {
             'format': '{levelname} {asctime} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'chai.log.JsonFormatter',
+        },
     },
     'filters': {
         'require_debug_false': {
@@ -162,43 +391,49 @@ LOGGING = {
         'require_debug_true': {
             '()': 'django.utils.log.RequireDebugTrue',
         },
+        'request_context': {
+            '()': 'chai.log.RequestContextFilter',
+        },
+        'sample_debug': {
+            '()': 'chai.log.SampleFilter',
+            'rate': LOG_DEBUG_SAMPLE_RATE,
+            'level': 'DEBUG',
+        },
     },
     'handlers': {
         'console': {
-            'level': 'INFO',
+            'level': LOG_CONSOLE_LEVEL,
             'class': 'logging.StreamHandler',
             'formatter': 'simple',
         },
         'file': {
-            'level': 'WARNING',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'level': 'INFO',
+            'class': 'chai.log.RotatingFileHandler',
             'filename': BASE_DIR / 'logs' / 'django.log',
             'maxBytes': 1024 * 1024 * 15,  # 15MB
             'backupCount': 10,
-            'formatter': 'verbose',
+            'formatter': 'json',
+        },
+        'queue': {
+            'class': 'chai.log.QueueListenerHandler',
+            'targets': ['cfg://handlers.console', 'cfg://handlers.file'],
+            'filters': ['request_context', 'sample_debug'],
         },
     },
     'root': {
-        'handlers': ['console', 'file'],
+        'handlers': ['queue'],
         'level': 'INFO',
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': False,
         },
         'chai': {
-            'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
             'propagate': False,
         },
     },
 }
-
-# Ensure logs directory exists
-import os as _os
-_logs_dir = BASE_DIR / 'logs'
-if not _logs_dir.exists():
-    _logs_dir.mkdir(exist_ok=True)
-
@@ -1,8 +1,11 @@
 from django.http import HttpResponse
 from django.shortcuts import render
 
+from chai.homepage import get_snapshot
+
 def home(request):
-    return render(request,'website/index.html')
+    """Homepage rendered from the precomputed snapshot"""
+    return render(request,'website/index.html', {'home': get_snapshot()})
 
 def about(request):
     return HttpResponse("Hello, World. you are at gayatri's About page")